@@ -6,7 +6,7 @@
 
 import argparse, sys, signal
 from sniffle.constants import BLE_ADV_AA
-from sniffle.sniffle_hw import make_sniffle_hw, PhyMode, SnifferMode, PacketMessage, DebugMessage
+from sniffle.sniffle_hw import make_sniffle_hw, is_sdr_serport, PhyMode, SnifferMode, PacketMessage, DebugMessage
 from sniffle.packet_decoder import *
 from sniffle.pcap import PcapBleWriter
 from sniffle.advdata.decoder import decode_adv_data
@@ -75,7 +75,7 @@ def main():
 
     global pcwriter
     if not (args.output is None):
-        pcwriter = PcapBleWriter(args.output)
+        pcwriter = PcapBleWriter(args.output, nanosecond=is_sdr_serport(args.serport))
 
     # trap Ctrl-C
     signal.signal(signal.SIGINT, sigint_handler)
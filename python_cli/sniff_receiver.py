@@ -8,8 +8,8 @@ import argparse, sys
 from binascii import unhexlify
 from sniffle.constants import BLE_ADV_AA
 from sniffle.pcap import PcapBleWriter
-from sniffle.sniffle_hw import (make_sniffle_hw, PacketMessage, DebugMessage, StateMessage,
-                                MeasurementMessage, SnifferMode, PhyMode)
+from sniffle.sniffle_hw import (make_sniffle_hw, is_sdr_serport, PacketMessage, DebugMessage,
+                                StateMessage, MeasurementMessage, SnifferMode, PhyMode)
 from sniffle.packet_decoder import (AdvaMessage, AdvDirectIndMessage, AdvExtIndMessage,
                                     ScanRspMessage, DataMessage, str_mac)
 from sniffle.errors import UsageError, SourceDone
@@ -133,7 +133,7 @@ def main():
 
     global pcwriter
     if not (args.output is None):
-        pcwriter = PcapBleWriter(args.output)
+        pcwriter = PcapBleWriter(args.output, nanosecond=is_sdr_serport(args.serport))
 
     while True:
         try:
@@ -14,5 +14,8 @@ __all__ = [
     "sniffle_sdr",
     "coding_ble",
     "channelizer",
-    "resampler"
+    "resampler",
+    "iq_file",
+    "sdr_gen",
+    "sdr_bench"
 ]
@@ -5,67 +5,155 @@
 import numpy
 import scipy.signal
 import scipy.fft
+from fractions import Fraction
 import concurrent.futures
+import math
 import os
+import time
 
 class PolyphaseChannelizer:
+    backends = ('direct', 'fft', 'matrix')
+
     def __init__(self, channel_count: int, taps_per_chan: int = 16, chan_rel_bw: float = 0.8,
-                 dtype: numpy.typing.DTypeLike = numpy.complex64):
+                 dtype: numpy.typing.DTypeLike = numpy.complex64, workers: int = None,
+                 backend: str = 'direct', chan_rel_trans: float = None):
+        # chan_rel_trans is the transition band width relative to channel spacing,
+        # defaulting to what's left over after chan_rel_bw
+        if chan_rel_trans is None:
+            chan_rel_trans = 1 - chan_rel_bw
         chan_bw = 1 /  channel_count
         filter_coeffs = scipy.signal.firwin(channel_count * taps_per_chan,
                                           chan_bw * chan_rel_bw,
-                                          width=chan_bw * (1 - chan_rel_bw))
+                                          width=chan_bw * chan_rel_trans)
 
         self.channel_count = channel_count
+        self.taps_per_chan = taps_per_chan
+        self.dtype = dtype
         self.filter_coeffs = numpy.reshape(filter_coeffs, (channel_count, -1), order='F')
-        self.filter_ic = numpy.zeros(channel_count * (taps_per_chan - 1), dtype=dtype)
 
-        # first column of data for rows (channels) other than the first
-        self.extra = numpy.zeros(channel_count - 1, dtype=dtype)
+        # Branch filter implementation:
+        # - direct: numpy.convolve per branch
+        # - fft: blocked FFT (overlap-add) convolution across all branches of a batch
+        # - matrix: sliding window matrix product across all branches of a batch
+        if backend not in self.backends:
+            raise ValueError("Unknown channelizer backend %s" % backend)
+        self.backend = backend
+        self._filter_rows = getattr(self, '_filter_rows_' + backend)
+        real_dtype = numpy.empty(0, dtype).real.dtype
+        self.filter_coeffs_rev = numpy.ascontiguousarray(self.filter_coeffs[:, ::-1], dtype=real_dtype)
+
+        # Input columns feeding each branch (row) of the filter bank
+        # Row ordering needs to be 0 M-1 M-2 ... 2 1
+        # See https://kastnerkyle.github.io/posts/polyphase-signal-processing/index.html
+        self.branch_cols = (channel_count - numpy.arange(channel_count)) % channel_count
+
+        # Per-branch input, starting with the filter history (last taps_per_chan - 1 inputs)
+        # Grown as needed to fit the largest chunk seen so far
+        self.hist_len = taps_per_chan - 1
+        self.branch_buf = numpy.zeros((channel_count, self.hist_len), dtype=dtype)
+        self.filtered = numpy.empty((channel_count, 0), dtype=dtype)
+
+        # Rows (channels) other than the first are delayed by one input column for the
+        # columns to line up properly. This holds the last column for those rows.
+        self.extra = numpy.zeros(channel_count, dtype=dtype)
 
         # Any data from the end of the last chunk that wasn't a multiple of channel_count
-        self.leftover = None
+        self.leftover = numpy.zeros(0, dtype=dtype)
 
-    def process(self, samples: numpy.typing.ArrayLike) -> numpy.ndarray:
-        # amount of samples we process per operation must be a multiple of channel count
-        if self.leftover is not None:
-            samples = numpy.hstack([self.filter_ic, self.leftover, samples])
-            self.leftover = None
-        else:
-            samples = numpy.hstack([self.filter_ic, samples])
+        # Long-lived worker pool, with branches split into one batch per worker
+        self.workers = workers if workers else os.cpu_count()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.batches = numpy.array_split(numpy.arange(channel_count), min(self.workers, channel_count))
 
-        leftover_samps = len(samples) % self.channel_count
-        if leftover_samps:
-            self.leftover = samples[-leftover_samps:]
-            samples = samples[:-leftover_samps]
+        # Cumulative per-stage timings in seconds
+        self.timings = {'setup': 0., 'filter': 0., 'fft': 0.}
+        self.samples_processed = 0
 
-        output_len = (len(samples) - len(self.filter_ic)) // self.channel_count
-        self.filter_ic = samples[-len(self.filter_ic):]
+    def _ensure_capacity(self, output_len):
+        if self.filtered.shape[1] < output_len:
+            hist = self.branch_buf[:, :self.hist_len].copy()
+            self.branch_buf = numpy.empty((self.channel_count, self.hist_len + output_len), dtype=self.dtype)
+            self.branch_buf[:, :self.hist_len] = hist
+            self.filtered = numpy.empty((self.channel_count, output_len), dtype=self.dtype)
 
-        filtered_samps = numpy.empty((self.channel_count, output_len + 1), dtype=samples.dtype)
-        filtered_samps[1:, 0] = self.extra
-        self.extra = filtered_samps[1:, -1]
+    # chans (output indices needed) is accepted for compatibility, all channels are computed
+    def process(self, samples: numpy.typing.ArrayLike, chans: list = None) -> numpy.ndarray:
+        t0 = time.perf_counter()
+        samples = numpy.asarray(samples)
+        M = self.channel_count
+        n_left = len(self.leftover)
 
-        # Do the filtering in a thread pool
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
-        futures = []
-        for i in range(self.channel_count):
-            futures.append(executor.submit(self._filter, i, samples, filtered_samps))
-        concurrent.futures.wait(futures)
+        # amount of samples we process per operation must be a multiple of channel count
+        output_len = (n_left + len(samples)) // M
+        if output_len == 0:
+            self.leftover = numpy.concatenate([self.leftover, samples]).astype(self.dtype)
+            return numpy.empty((M, 0), dtype=self.dtype)
+
+        # First input row may partly come from the previous chunk's leftovers
+        first = numpy.empty(M, dtype=self.dtype)
+        first[:n_left] = self.leftover
+        first[n_left:] = samples[:M - n_left]
+        rest_end = M - n_left + (output_len - 1) * M
+        rest = samples[M - n_left:rest_end].reshape(output_len - 1, M)
+        self.leftover = samples[rest_end:].astype(self.dtype)
+
+        self._ensure_capacity(output_len)
+        t1 = time.perf_counter()
+
+        # Do the deinterleaving and filtering in the worker pool
+        futures = [self.executor.submit(self._filter, rows, first, rest, output_len)
+                   for rows in self.batches]
+        for f in futures:
+            f.result()
+        self.extra = rest[-1, self.branch_cols] if output_len > 1 else first[self.branch_cols]
+        t2 = time.perf_counter()
 
         # Let SciPy parallelize the FFTs
-        return scipy.fft.ifft(filtered_samps[:, :-1], axis=0, norm='forward', workers=os.cpu_count())
+        channelized = scipy.fft.ifft(self.filtered[:, :output_len], axis=0, norm='forward',
+                                     workers=self.workers)
+        t3 = time.perf_counter()
 
-    def _filter(self, i, samples, dst):
-        # For columns to line up properly:
-        # - append a 0 to first row (channel)
-        # - prepend previous values (or zeros) to other rows
-        # Row ordering also needs to be 0 M-1 M-2 ... 2 1
-        # See https://kastnerkyle.github.io/posts/polyphase-signal-processing/index.html
-        if i == 0:
-            dst[i, :-1] = numpy.convolve(samples[::self.channel_count], self.filter_coeffs[i], mode='valid')
-        else:
-            dst[i, 1:] = numpy.convolve(samples[self.channel_count - i::self.channel_count], self.filter_coeffs[i], mode='valid')
+        self.timings['setup'] += t1 - t0
+        self.timings['filter'] += t2 - t1
+        self.timings['fft'] += t3 - t2
+        self.samples_processed += len(samples)
+        return channelized
+
+    # Filter delay isn't compensated, so there are no held back outputs to flush
+    def flush(self, chans: list = None) -> numpy.ndarray:
+        return numpy.empty((self.channel_count, 0), dtype=self.dtype)
+
+    def _filter(self, rows, first, rest, output_len):
+        hist_len = self.hist_len
+        for i in rows:
+            col = self.branch_cols[i]
+            buf = self.branch_buf[i, :hist_len + output_len]
+            if i == 0:
+                buf[hist_len] = first[0]
+                buf[hist_len + 1:] = rest[:, 0]
+            else:
+                buf[hist_len] = self.extra[i]
+                if output_len > 1:
+                    buf[hist_len + 1] = first[col]
+                    buf[hist_len + 2:] = rest[:-1, col]
+
+        r0, r1 = rows[0], rows[-1] + 1
+        bufs = self.branch_buf[r0:r1, :hist_len + output_len]
+        self._filter_rows(r0, r1, bufs, self.filtered[r0:r1, :output_len])
+
+        # keep the last inputs as history for the next chunk
+        bufs[:, :hist_len] = bufs[:, output_len:].copy()
+
+    def _filter_rows_direct(self, r0, r1, bufs, dst):
+        for i in range(r1 - r0):
+            dst[i] = numpy.convolve(bufs[i], self.filter_coeffs[r0 + i], mode='valid')
+
+    def _filter_rows_fft(self, r0, r1, bufs, dst):
+        dst[:] = scipy.signal.oaconvolve(bufs, self.filter_coeffs_rev[r0:r1, ::-1], mode='valid', axes=1)
+
+    def _filter_rows_matrix(self, r0, r1, bufs, dst):
+        windows = numpy.lib.stride_tricks.sliding_window_view(bufs, self.taps_per_chan, axis=1)
+        numpy.matmul(windows, self.filter_coeffs_rev[r0:r1, :, None], out=dst[:, :, None])
 
     def chan_idx(self, chan: int) -> int:
         # Maps from a channel index (signed int relative to centre) to index in channelizer output array
@@ -81,6 +169,200 @@ class PolyphaseChannelizer:
         else:
             raise ValueError("Channel out-of-bounds")
 
+    def get_timings(self) -> dict:
+        # Cumulative time spent per stage, and overall throughput in samples per second
+        timings = dict(self.timings)
+        total = sum(self.timings.values())
+        timings['total'] = total
+        timings['msps'] = self.samples_processed / total / 1e6 if total else None
+        return timings
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+# Fast convolution (overlap-save FFT filter bank) channelizer, for input rates that
+# aren't an integer multiple of the channel spacing, such as 122.88 or 61.44 MSPS with
+# 2 MHz BLE channels. A polyphase DFT bank can only produce channels spaced fs/M apart
+# at a decimation of M, so those rates would otherwise need a resampling pass first.
+# Each block of input is transformed once, and every channel is filtered and decimated
+# by weighting the FFT bins around its centre with the channel filter's response and
+# taking a short inverse FFT, giving outputs at exactly the channel spacing rate.
+# The filter is zero-phase, so output sample j of every channel lines up with input
+# time j / channel_spacing, and block sizes are chosen so that each block starts on
+# an output sample boundary with a whole number of turns of every channel's carrier.
+class FastConvChannelizer:
+    def __init__(self, fs: float, channel_count: int, channel_spacing: float = 2e6,
+                 chan_rel_bw: float = 0.8, dtype: numpy.typing.DTypeLike = numpy.complex64,
+                 workers: int = None, chan_rel_trans: float = None, taps_per_chan: int = 16,
+                 block_factor: int = 8, batch_blocks: int = 16):
+        if chan_rel_trans is None:
+            chan_rel_trans = 1 - chan_rel_bw
+
+        # Decimation as a fraction p/q, so q outputs correspond to p inputs
+        decim = Fraction(int(round(fs)), int(round(channel_spacing)))
+        q = decim.denominator
+        self.decim = decim
+
+        # Overlap between blocks (filter length), in outputs and inputs, and block sizes.
+        # Overlap must be an even multiple of q so that half of it is a whole number of inputs.
+        overlap_out = 2 * q * -(-taps_per_chan // (2 * q))
+        self.block_bins = overlap_out * block_factor
+        self.fft_len = int(self.block_bins * decim)
+        self.overlap = int(overlap_out * decim)
+        self.step = self.fft_len - self.overlap
+        self.block_outputs = self.block_bins - overlap_out
+        self.out_offset = overlap_out // 2
+        if channel_count * self.block_bins > self.fft_len:
+            raise ValueError("Too many channels for sample rate")
+
+        self.channel_count = channel_count
+        self.channel_spacing = channel_spacing
+        self.dtype = dtype
+        self.workers = workers if workers else os.cpu_count()
+        self.batch_blocks = batch_blocks
+
+        # Zero-phase channel filter, and its response at the bins of one channel,
+        # in inverse FFT order (centre bin upwards, then the lower half of the channel).
+        # Scaled so a tone at channel centre comes out with its input amplitude.
+        filter_coeffs = scipy.signal.firwin(self.overlap + 1, chan_rel_bw * channel_spacing / fs,
+                                            width=chan_rel_trans * channel_spacing / fs)
+        half = self.overlap // 2
+        impulse = numpy.zeros(self.fft_len)
+        impulse[:half + 1] = filter_coeffs[half:]
+        impulse[self.fft_len - half:] = filter_coeffs[:half]
+        response = scipy.fft.fft(impulse).real
+        h2 = self.block_bins // 2
+        real_dtype = numpy.empty(0, dtype).real.dtype
+        self.response = (numpy.concatenate([response[:h2], response[-h2:]]) *
+                         (self.block_bins / self.fft_len)).astype(real_dtype)
+
+        # Start of the upper and lower half of each output's bins, with outputs in the
+        # same order as PolyphaseChannelizer (0 1 2 ... -2 -1)
+        self.bin_starts = []
+        for idx in range(channel_count):
+            rel = (idx + channel_count // 2) % channel_count - channel_count // 2
+            centre = (rel * self.block_bins) % self.fft_len
+            self.bin_starts.append((centre, (centre - h2) % self.fft_len))
+
+        # Inputs not yet consumed by a block, starting with half an overlap of zeros
+        # so that the first block's first output lines up with the first input
+        self.pending = numpy.zeros(self.overlap + self.step, dtype=dtype)
+        self.pending_len = half
+        self.head = numpy.empty(self.overlap + 2 * self.step, dtype=dtype)
+        self.spectra = numpy.empty((batch_blocks, self.fft_len), dtype=dtype)
+        self.bins = numpy.empty((batch_blocks, channel_count, self.block_bins), dtype=dtype)
+
+        # Cumulative per-stage timings in seconds
+        self.timings = {'setup': 0., 'filter': 0., 'fft': 0.}
+        self.samples_processed = 0
+
+    # chans optionally limits processing to a list of output indices, with other rows zeroed
+    def process(self, samples: numpy.typing.ArrayLike, chans: list = None) -> numpy.ndarray:
+        t0 = time.perf_counter()
+        samples = numpy.ascontiguousarray(samples, self.dtype)
+        M = self.channel_count
+        S = self.step
+        P = self.pending_len
+        n = len(samples)
+        chans = range(M) if chans is None else sorted(set(chans))
+        num_blocks = max(P + n - self.overlap, 0) // S
+
+        channelized = numpy.empty((M, num_blocks * self.block_outputs), dtype=self.dtype)
+        if len(chans) < M:
+            channelized[[i for i in range(M) if i not in chans]] = 0
+
+        # Blocks starting in pending inputs come from a stitched head buffer,
+        # the rest are overlapping windows of the new samples
+        head_blocks = min(num_blocks, -(-P // S))
+        if head_blocks:
+            head_len = (head_blocks - 1) * S + self.fft_len
+            self.head[:P] = self.pending[:P]
+            self.head[P:head_len] = samples[:head_len - P]
+        body = samples[head_blocks * S - P:] if num_blocks > head_blocks else samples[:0]
+        body_blocks = numpy.lib.stride_tricks.as_strided(body,
+                shape=(num_blocks - head_blocks, self.fft_len),
+                strides=(S * body.itemsize, body.itemsize), writeable=False)
+        t1 = time.perf_counter()
+        self.timings['setup'] += t1 - t0
+
+        for b0 in range(0, num_blocks, self.batch_blocks):
+            count = min(self.batch_blocks, num_blocks - b0)
+            t1 = time.perf_counter()
+            spectra = self.spectra[:count]
+            for i in range(count):
+                b = b0 + i
+                if b < head_blocks:
+                    spectra[i] = self.head[b * S:b * S + self.fft_len]
+                else:
+                    spectra[i:count] = body_blocks[b - head_blocks:b0 + count - head_blocks]
+                    break
+            spectra = scipy.fft.fft(spectra, axis=1, overwrite_x=True, workers=self.workers)
+            t2 = time.perf_counter()
+
+            # Weight each channel's bins by the filter response
+            h2 = self.block_bins // 2
+            bins = self.bins[:count, :len(chans)]
+            for j, idx in enumerate(chans):
+                upper, lower = self.bin_starts[idx]
+                numpy.multiply(spectra[:, upper:upper + h2], self.response[:h2], out=bins[:, j, :h2])
+                numpy.multiply(spectra[:, lower:lower + h2], self.response[h2:], out=bins[:, j, h2:])
+            t3 = time.perf_counter()
+
+            bins = scipy.fft.ifft(bins, axis=2, overwrite_x=True, workers=self.workers)
+            t4 = time.perf_counter()
+
+            # Keep the valid (unaliased) part of each block
+            k = self.block_outputs
+            o = self.out_offset
+            for j, idx in enumerate(chans):
+                dst = channelized[idx, b0 * k:(b0 + count) * k].reshape(count, k)
+                dst[:] = bins[:, j, o:o + k]
+            t5 = time.perf_counter()
+
+            self.timings['fft'] += (t2 - t1) + (t4 - t3)
+            self.timings['filter'] += (t3 - t2) + (t5 - t4)
+
+        # Keep inputs from the start of the next block onwards
+        t1 = time.perf_counter()
+        consumed = num_blocks * S
+        if consumed < P:
+            keep = P - consumed
+            self.pending[:keep] = self.pending[consumed:P]
+            self.pending[keep:keep + n] = samples
+            self.pending_len = keep + n
+        else:
+            tail = samples[consumed - P:]
+            self.pending[:len(tail)] = tail
+            self.pending_len = len(tail)
+        self.timings['setup'] += time.perf_counter() - t1
+        self.samples_processed += n
+        return channelized
+
+    # Returns outputs for the inputs still held back as filter lookahead, as if the
+    # input was followed by zeros. Used once the input is done.
+    def flush(self, chans: list = None) -> numpy.ndarray:
+        remaining = self.pending_len - self.overlap // 2
+        num_out = math.ceil(remaining / self.decim)
+        samples_processed = self.samples_processed
+        channelized = self.process(numpy.zeros(self.step + self.overlap // 2, self.dtype), chans)
+        self.samples_processed = samples_processed
+        return channelized[:, :num_out]
+
+    def chan_idx(self, chan: int) -> int:
+        # Maps from a channel index (signed int relative to centre) to index in channelizer output array
+        return (chan + self.channel_count) % self.channel_count
+
+    def get_timings(self) -> dict:
+        # Cumulative time spent per stage, and overall throughput in samples per second
+        timings = dict(self.timings)
+        total = sum(self.timings.values())
+        timings['total'] = total
+        timings['msps'] = self.samples_processed / total / 1e6 if total else None
+        return timings
+
+    def close(self):
+        pass
+
 def complex_chirp(f0, f1, T, fs):
     w = numpy.linspace(f0/fs, f1/fs, int(T*fs))
     p = 2 * numpy.pi * numpy.cumsum(w)
@@ -105,5 +387,32 @@ def plot_freqz(channel_count):
     plt.legend(range(channel_count))
     plt.show()
 
+# Throughput in MSPS of each backend, for each number of taps per channel
+def benchmark_backends(channel_count=48, taps_list=(16, 32, 48, 64), chunk_size=3125000, chunks=4):
+    rng = numpy.random.default_rng(0)
+    samples = (rng.standard_normal(chunk_size) + 1j * rng.standard_normal(chunk_size)).astype(numpy.complex64)
+    results = {}
+    for taps in taps_list:
+        for backend in PolyphaseChannelizer.backends:
+            channelizer = PolyphaseChannelizer(channel_count, taps, backend=backend)
+            channelizer.process(samples) # warm up
+            t0 = time.perf_counter()
+            for i in range(chunks):
+                channelizer.process(samples)
+            elapsed = time.perf_counter() - t0
+            channelizer.close()
+            results[(taps, backend)] = chunk_size * chunks / elapsed / 1e6
+    return results
+
+def print_benchmark(channel_count=48):
+    results = benchmark_backends(channel_count)
+    print("Taps/chan  " + "".join("%10s" % b for b in PolyphaseChannelizer.backends) + "  (MSPS)")
+    for taps in sorted(set(t for t, _ in results)):
+        print("%9d  " % taps + "".join("%10.1f" % results[(taps, b)] for b in PolyphaseChannelizer.backends))
+
 if __name__ == "__main__":
-    plot_freqz(5)
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        print_benchmark()
+    else:
+        plot_freqz(5)
@@ -2,6 +2,8 @@
 # Copyright (c) 2024, NCC Group plc
 # Released as open source under GPLv3
 
+import numpy
+
 # LSB-first
 def fec_ble_encode_int(data: int, nbits: int, state=0):
     output = 0
@@ -63,10 +65,10 @@ def _fec_ble_decode_bit(data: int, state: int):
 _dec_lut = [_fec_ble_decode_bit(i & 0xF, i >> 4) for i in range(128)]
 
 def pack_bits(bits):
-    output = bytearray((len(bits) + 7) // 8)
-    for i, b in enumerate(bits):
-        output[i >> 3] |= b << (i & 0x7)
-    return bytes(output)
+    return numpy.packbits(numpy.asarray(bits, numpy.uint8), bitorder='little').tobytes()
+
+def unpack_bits(data: bytes):
+    return numpy.unpackbits(numpy.frombuffer(data, numpy.uint8), bitorder='little')
 
 def fec_ble_decode(data: bytes):
     state = 0
@@ -81,19 +83,94 @@ def fec_ble_decode(data: bytes):
     out_bits[-1] = _dec_lut[(data[-1] & 0xF) | (state << 4)]
     return pack_bits(out_bits)
 
+# Expected coded bit pair (a0, a1) for each encoder state and input bit, as +1/-1
+def _make_branch_signs():
+    signs = numpy.zeros((2, 16), numpy.float32)
+    for state in range(8):
+        for b in range(2):
+            o = fec_ble_encode_int(b, 1, state)
+            signs[0, state*2 + b] = 1 if o & 1 else -1
+            signs[1, state*2 + b] = 1 if o & 2 else -1
+    return signs
+
+_branch_signs = _make_branch_signs()
+
+# Trellis taken three steps at a time (radix-8): with 3 bits of encoder state, every state
+# reaches every other after three steps, and the destination state is just the three input
+# bits (oldest in the LSB). These are the intermediate states from p to n.
+_radix8_p = numpy.arange(8)[:, None]
+_radix8_n = numpy.arange(8)[None, :]
+_radix8_s1 = (_radix8_p >> 1) | ((_radix8_n & 1) << 2)
+_radix8_s2 = (_radix8_p >> 2) | ((_radix8_n & 3) << 1)
+
+# Maximum likelihood (Viterbi) decoding of the K=4 convolutional code
+# soft has shape (..., 2*nbits), coded bits in transmission order, positive values for 1
+# Hard decisions can be passed as +1/-1 values; larger magnitudes mean more confidence
+# With terminated, encoding is assumed to end in state 0 (i.e. after TERM1/TERM2)
+# Returns decoded bits with shape (..., nbits), decoding all leading dimensions as a batch
+def fec_ble_decode_soft(soft, state=0, terminated=False):
+    soft = numpy.asarray(soft, numpy.float32)
+    batch_shape = soft.shape[:-1]
+    nbits = soft.shape[-1] // 2
+    nsteps = (nbits + 2) // 3
+
+    # Pad to whole steps
+    padded = numpy.zeros((int(numpy.prod(batch_shape)), nsteps * 3, 2), numpy.float32)
+    padded[:, :nbits] = soft[..., :nbits*2].reshape(-1, nbits, 2)
+    batch = padded.shape[0]
+
+    # Branch metrics for every bit, state, and input bit
+    # Padding bits are forced to zero, as are the final three (TERM) bits if terminated,
+    # so that decoding always ends in state 0 with termination
+    metrics = (padded @ _branch_signs).reshape(batch, nsteps * 3, 8, 2)
+    metrics[:, max(nbits - 3, 0) if terminated else nbits:, :, 1] = -numpy.inf
+    metrics = metrics.reshape(batch, nsteps, 3, 8, 2)
+
+    # Combined metrics over each group of three bits, from every state p to every state n
+    metrics8 = metrics[:, :, 0, _radix8_p, _radix8_n & 1] + \
+            metrics[:, :, 1, _radix8_s1, (_radix8_n >> 1) & 1] + \
+            metrics[:, :, 2, _radix8_s2, _radix8_n >> 2]
+    metrics8 = numpy.ascontiguousarray(metrics8.transpose(1, 0, 2, 3))
+
+    path = numpy.full((batch, 8, 1), -numpy.inf, numpy.float32)
+    path[:, state] = 0
+    decisions = numpy.empty((nsteps, batch, 8), numpy.uint8)
+    cand = numpy.empty((batch, 8, 8), numpy.float32)
+    for i in range(nsteps):
+        numpy.add(path, metrics8[i], out=cand)
+        decisions[i] = cand.argmax(axis=1)
+        path = cand.max(axis=1)[:, :, None]
+
+    # Trace back from the final state of the best path
+    rows = numpy.arange(batch)
+    if terminated:
+        cur = numpy.zeros(batch, numpy.intp)
+    else:
+        cur = numpy.argmax(path[:, :, 0], axis=1)
+    states = numpy.empty((batch, nsteps), numpy.intp)
+    for i in range(nsteps - 1, -1, -1):
+        states[:, i] = cur
+        cur = decisions[i, rows, cur]
+
+    # Each state on the path holds the three input bits that led to it
+    out_bits = ((states[:, :, None] >> numpy.arange(3)) & 1).astype(numpy.uint8)
+    return out_bits.reshape(batch, -1)[:, :nbits].reshape(batch_shape + (nbits,))
+
+# Hard decision Viterbi decoding of fec_ble_encode output, returning len(data)*4 bits
+def fec_ble_decode_viterbi(data: bytes, state=0, terminated=False):
+    soft = unpack_bits(data).astype(numpy.float32) * 2 - 1
+    return pack_bits(fec_ble_decode_soft(soft, state, terminated))
+
 # LSB first, i.e. 0b1100 is transmitted as 0 0 1 1
 _pattern_map_lut = [0b1100, 0b0011]
 
+# Each input byte maps to 4 output bytes
+_pattern_map_byte_lut = numpy.array([[_pattern_map_lut[(b >> (j*2)) & 0x1] |
+                                      (_pattern_map_lut[(b >> (j*2 + 1)) & 0x1] << 4)
+                                      for j in range(4)] for b in range(256)], numpy.uint8)
+
 def pattern_map_p4(data: bytes):
-    output = bytearray(len(data) * 4)
-    for i, b in enumerate(data):
-        for j in range(4):
-            bit_low = (b >> (j*2)) & 0x1
-            bit_high = (b >> (j*2 + 1)) & 0x1
-            o = _pattern_map_lut[bit_low]
-            o |= _pattern_map_lut[bit_high] << 4
-            output[i*4 + j] = o
-    return bytes(output)
+    return _pattern_map_byte_lut[numpy.frombuffer(data, numpy.uint8)].tobytes()
 
 _pattern_unmap_lut = [
     1, # 0b0000 - ambiguous
@@ -114,9 +191,25 @@ _pattern_unmap_lut = [
     0, # 0b1111 - ambiguous
 ]
 
+# Each input byte unmaps to 2 bits
+_pattern_unmap_byte_lut = numpy.array([[_pattern_unmap_lut[b & 0xF], _pattern_unmap_lut[b >> 4]]
+                                       for b in range(256)], numpy.uint8)
+
 def pattern_unmap_p4(data: bytes):
-    out_bits = bytearray(len(data) * 2)
-    for i, b in enumerate(data):
-        out_bits[2*i] = _pattern_unmap_lut[b & 0xF]
-        out_bits[2*i + 1] = _pattern_unmap_lut[b >> 4]
-    return pack_bits(out_bits)
+    return pack_bits(_pattern_unmap_byte_lut[numpy.frombuffer(data, numpy.uint8)].ravel())
+
+# Soft pattern demapping: 1 is sent as 1 1 0 0 and 0 as 0 0 1 1
+# soft has shape (..., 4*n) with positive values for 1, returns shape (..., n)
+# Ambiguous patterns come out near zero rather than being forced to a guess
+def pattern_unmap_p4_soft(soft):
+    soft = numpy.asarray(soft, numpy.float32)
+    groups = soft[..., :soft.shape[-1] // 4 * 4].reshape(soft.shape[:-1] + (-1, 4))
+    return groups[..., 0] + groups[..., 1] - groups[..., 2] - groups[..., 3]
+
+# LE Coded PHY preamble: 10 repetitions of 0 0 1 1 1 1 0 0
+CODED_PREAMBLE = b'\x3C' * 10
+
+# Preamble followed by the FEC encoded (S=8) access address, as transmitted
+# The AA is the start of FEC block 1, so its coding doesn't depend on what follows
+def coded_sync_word(aa: int):
+    return CODED_PREAMBLE + pattern_map_p4(fec_ble_encode(aa.to_bytes(4, 'little')))
@@ -54,3 +54,74 @@ def crc_ble_reverse(crc_init_reverse: int, data: bytes):
 def crc_ble(crc_init: int, data: bytes):
     crc_init_reverse = rbit24(crc_init)
     return rbit24(crc_ble_reverse(crc_init_reverse, data))
+
+# Slice-by-N tables for batch CRC computation, built lazily so that NumPy
+# is only needed by SDR code paths
+# Row j of the table for N gives the CRC contribution of a byte followed by N-1-j zero bytes
+_slice_tables = {}
+
+def _crc_slice_table(n):
+    if n not in _slice_tables:
+        import numpy
+        lut = numpy.array(ble_crc_lut, numpy.uint32)
+        tables = numpy.empty((n, 256), numpy.uint32)
+        tables[n - 1] = lut
+        for j in range(n - 2, -1, -1):
+            prev = tables[j + 1]
+            tables[j] = (prev >> 8) ^ lut[prev & 0xFF]
+        _slice_tables[n] = tables
+    return _slice_tables[n]
+
+# Compute CRCs of many variable-length messages at once
+# data is a 2D uint8 array with one message per row (padded arbitrarily)
+# lengths gives the number of valid bytes in each row
+# Returns a uint32 array of (bit reversed) CRCs, one per row
+def crc_ble_reverse_batch(crc_init_reverse: int, data, lengths, slice_by=8):
+    import numpy
+    assert slice_by >= 3 # state must be fully consumed by every block
+    data = numpy.asarray(data, numpy.uint8)
+    lengths = numpy.asarray(lengths, numpy.int64)
+    rows = numpy.arange(len(data))
+    state = numpy.full(len(data), crc_init_reverse & 0xFFFFFF, numpy.uint32)
+    tables = _crc_slice_table(slice_by)
+    table_rows = numpy.arange(slice_by)
+    state_shifts = numpy.array([0, 8, 16], numpy.uint32)
+
+    # Full blocks of slice_by bytes, shared column positions for all rows
+    nblocks = lengths // slice_by
+    for k in range(int(nblocks.max(initial=0))):
+        keys = data[:, k*slice_by:(k+1)*slice_by].astype(numpy.intp)
+        keys[:, :3] ^= (state[:, None] >> state_shifts) & 0xFF
+        new_state = numpy.bitwise_xor.reduce(tables[table_rows, keys], axis=1)
+        numpy.copyto(state, new_state, where=nblocks > k)
+
+    # Remaining bytes, one at a time, at row dependent columns
+    tail_start = nblocks * slice_by
+    tail_len = lengths - tail_start
+    max_col = max(data.shape[1] - 1, 0)
+    for t in range(int(tail_len.max(initial=0))):
+        cols = numpy.minimum(tail_start + t, max_col)
+        key = data[rows, cols] ^ (state & 0xFF)
+        new_state = (state >> 8) ^ tables[slice_by - 1][key]
+        numpy.copyto(state, new_state, where=tail_len > t)
+
+    return state
+
+# Check CRCs of many received packets at once
+# Each row of data holds a packet body followed by its 3 byte CRC, and lengths
+# includes the CRC bytes. Returns a boolean array, True where the CRC is valid.
+def crc_ble_check_batch(crc_init_reverse: int, data, lengths, slice_by=8):
+    import numpy
+    data = numpy.asarray(data, numpy.uint8)
+    lengths = numpy.asarray(lengths, numpy.int64)
+    if data.shape[1] == 0:
+        return numpy.zeros(len(data), bool)
+    body_lens = numpy.maximum(lengths - 3, 0)
+    crc_calc = crc_ble_reverse_batch(crc_init_reverse, data, body_lens, slice_by)
+    rows = numpy.arange(len(data))
+    max_col = data.shape[1] - 1
+    crc_rx = numpy.zeros(len(data), numpy.uint32)
+    for i in range(3):
+        cols = numpy.minimum(body_lens + i, max_col)
+        crc_rx |= data[rows, cols].astype(numpy.uint32) << (8 * i)
+    return (crc_calc == crc_rx) & (lengths >= 3)
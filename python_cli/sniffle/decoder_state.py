@@ -13,6 +13,7 @@ class SniffleDecoderState:
         self.first_epoch_time = 0
         self.ts_wraps = 0
         self.last_ts = -1
+        self.first_ts_ns = None # first 64-bit timestamp, for sources that provide them
 
         # access address tracking
         self.cur_aa = 0 if is_data else BLE_ADV_AA
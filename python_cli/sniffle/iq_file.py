@@ -0,0 +1,132 @@
+# Written by Sultan Qasim Khan
+# Copyright (c) 2024, NCC Group plc
+# Released as open source under GPLv3
+
+import json
+import os
+import re
+from datetime import datetime, timezone
+
+import numpy
+
+# Raw element type, and scale and offset to map elements to complex64 I/Q in [-1, 1)
+IQ_FORMATS = {
+    'cf32': (numpy.float32, 1., 0.),
+    'cs16': (numpy.int16, 1 / 32768, 0.),
+    'cs8': (numpy.int8, 1 / 128, 0.),
+    'cu8': (numpy.uint8, 1 / 128, -127.5)
+}
+
+# SigMF core:datatype equivalents of the supported formats
+SIGMF_DATATYPES = {
+    'cf32_le': 'cf32',
+    'ci16_le': 'cs16',
+    'ci8': 'cs8',
+    'cu8': 'cu8'
+}
+
+def sigmf_meta_path(file_name):
+    if file_name.endswith('.sigmf-data'):
+        return file_name[:-len('.sigmf-data')] + '.sigmf-meta'
+    return file_name + '.sigmf-meta'
+
+# Converts an ISO 8601 datetime as used by SigMF to integer UNIX epoch nanoseconds
+# Fractional seconds are kept to full (nanosecond) precision, and UTC is assumed
+# if no time zone is given
+def parse_datetime_ns(dt):
+    m = re.fullmatch(r'([^.]*T\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:?\d\d)?', dt.strip())
+    if m is None:
+        raise ValueError("Invalid datetime %s" % dt)
+    base, frac, tz = m.groups()
+    whole = datetime.fromisoformat(base)
+    if tz is not None and tz != 'Z':
+        whole = datetime.fromisoformat(base + tz)
+    if whole.tzinfo is None:
+        whole = whole.replace(tzinfo=timezone.utc)
+    frac_ns = int((frac or '').ljust(9, '0')[:9])
+    return round(whole.timestamp()) * 1_000_000_000 + frac_ns
+
+# Returns a dict with any of fmt, fs, center_freq, and start_time_ns (UNIX epoch
+# nanoseconds) found in a SigMF metadata file
+def read_sigmf_meta(meta_name):
+    with open(meta_name, 'r') as f:
+        meta = json.load(f)
+    info = {}
+    glob = meta.get('global', {})
+    if 'core:datatype' in glob:
+        datatype = glob['core:datatype']
+        if datatype not in SIGMF_DATATYPES:
+            raise ValueError("Unsupported SigMF datatype %s" % datatype)
+        info['fmt'] = SIGMF_DATATYPES[datatype]
+    if 'core:sample_rate' in glob:
+        info['fs'] = float(glob['core:sample_rate'])
+    captures = meta.get('captures', [])
+    if captures:
+        if 'core:frequency' in captures[0]:
+            info['center_freq'] = float(captures[0]['core:frequency'])
+        if 'core:datetime' in captures[0]:
+            info['start_time_ns'] = parse_datetime_ns(captures[0]['core:datetime'])
+    return info
+
+# Reads I/Q samples from a raw interleaved file, through a read-only memory map
+# Complex float files are returned as zero-copy views of the map, while integer
+# formats are converted into a caller provided (or internal) complex64 buffer.
+# The format is taken from fmt, a SigMF sidecar, or the file extension, in that
+# order, falling back to cf32. Sidecar metadata is available in self.meta.
+# Reading may be limited to samples start (inclusive) to stop (exclusive) of the file.
+class IQFileSource:
+    def __init__(self, file_name, fmt=None, start=0, stop=None):
+        meta_name = sigmf_meta_path(file_name)
+        self.meta = read_sigmf_meta(meta_name) if os.path.exists(meta_name) else {}
+        if fmt is None:
+            fmt = self.meta.get('fmt')
+        if fmt is None:
+            ext = os.path.splitext(file_name)[1][1:].lower()
+            fmt = ext if ext in IQ_FORMATS else 'cf32'
+        if fmt not in IQ_FORMATS:
+            raise ValueError("Unsupported IQ format %s" % fmt)
+        self.fmt = fmt
+        dtype, self.scale, self.offset = IQ_FORMATS[fmt]
+
+        elem_size = numpy.dtype(dtype).itemsize
+        num_samples = os.path.getsize(file_name) // (2 * elem_size)
+        if num_samples:
+            raw = numpy.memmap(file_name, dtype, mode='r', shape=(num_samples * 2,))
+        else:
+            raw = numpy.zeros(0, dtype)
+        if fmt == 'cf32':
+            self.samples = raw.view(numpy.complex64)
+        else:
+            self.samples = raw.reshape(-1, 2)
+        self.total_samples = num_samples
+        self.num_samples = num_samples if stop is None else min(stop, num_samples)
+        self.pos = start
+        self.buf = numpy.zeros(0, numpy.complex64)
+
+    # Returns the next (up to) num_samples samples as complex64, or None at end of file
+    # Converted samples are written to out if given and large enough
+    def read(self, num_samples, out=None):
+        if self.pos >= self.num_samples:
+            return None
+        stop = min(self.pos + num_samples, self.num_samples)
+        raw = self.samples[self.pos:stop]
+        self.pos = stop
+        if self.fmt == 'cf32':
+            return raw
+
+        n = len(raw)
+        if out is None or len(out) < n:
+            if len(self.buf) < n:
+                self.buf = numpy.empty(num_samples, numpy.complex64)
+            out = self.buf
+        out = out[:n]
+        out_iq = out.view(numpy.float32).reshape(-1, 2)
+        if self.offset:
+            numpy.add(raw, numpy.float32(self.offset), out=out_iq)
+            out_iq *= numpy.float32(self.scale)
+        else:
+            numpy.multiply(raw, numpy.float32(self.scale), out=out_iq)
+        return out
+
+    def close(self):
+        self.samples = None
@@ -35,7 +35,9 @@ def str_mac2(mac, is_random):
 TS_WRAP_PERIOD = 0x100000000 / 4E6
 
 class PacketMessage:
-    def __init__(self, raw_msg, dstate: SniffleDecoderState, crc_rev=None):
+    # ts_ns optionally provides a full 64-bit UNIX epoch timestamp in nanoseconds (as from
+    # an SDR), which is used instead of the 32-bit radio timestamp in the message header
+    def __init__(self, raw_msg, dstate: SniffleDecoderState, crc_rev=None, ts_ns=None):
         ts, l, event, rssi, chan = unpack("<LHHbB", raw_msg[:10])
         body = raw_msg[10:]
 
@@ -53,20 +55,29 @@ class PacketMessage:
         if chan >= 37 and dstate.cur_aa != BLE_ADV_AA:
             dstate.reset_adv()
 
-        if dstate.time_offset > 0:
-            dstate.first_epoch_time = time()
-            dstate.time_offset = ts / -1000000.
+        if ts_ns is not None:
+            # No wraparound or clock offset to track
+            if dstate.first_ts_ns is None:
+                dstate.first_ts_ns = ts_ns
+                dstate.first_epoch_time = ts_ns / 1e9
+            real_ts = (ts_ns - dstate.first_ts_ns) / 1e9
+            real_ts_epoch = ts_ns / 1e9
+        else:
+            if dstate.time_offset > 0:
+                dstate.first_epoch_time = time()
+                dstate.time_offset = ts / -1000000.
 
-        if ts < dstate.last_ts:
-            dstate.ts_wraps += 1
-        dstate.last_ts = ts
+            if ts < dstate.last_ts:
+                dstate.ts_wraps += 1
+            dstate.last_ts = ts
 
-        real_ts = dstate.time_offset + (ts / 1000000.) + (dstate.ts_wraps * TS_WRAP_PERIOD)
-        real_ts_epoch = dstate.first_epoch_time + real_ts
+            real_ts = dstate.time_offset + (ts / 1000000.) + (dstate.ts_wraps * TS_WRAP_PERIOD)
+            real_ts_epoch = dstate.first_epoch_time + real_ts
 
         # Now actually set instance attributes
         self.ts = real_ts
         self.ts_epoch = real_ts_epoch
+        self.ts_ns = ts_ns
         self.aa = dstate.cur_aa
         self.rssi = rssi
         self.chan = chan
@@ -91,14 +102,14 @@ class PacketMessage:
 
     @staticmethod
     def from_fields(ts, _len, event, rssi, chan, phy, body, crc_rev, crc_err,
-                    dstate, peripheral_send=False):
+                    dstate, peripheral_send=False, ts_ns=None):
         if peripheral_send:
             _len |= 0x8000
         if crc_err:
             _len |= 0x4000
         chan |= phy << 6
         fake_hdr = pack("<LHHbB", ts, _len, event, rssi, chan)
-        return PacketMessage(fake_hdr + body, dstate, crc_rev=crc_rev)
+        return PacketMessage(fake_hdr + body, dstate, crc_rev=crc_rev, ts_ns=ts_ns)
 
     def __repr__(self):
         return "%s(ts=%.6f, aa=%08X, rssi=%d, chan=%d, phy=%d, event=%d, body=%s)" % (
@@ -130,6 +141,7 @@ class DPacketMessage(PacketMessage):
     def __init__(self, pkt: PacketMessage):
         self.ts = pkt.ts
         self.ts_epoch = pkt.ts_epoch
+        self.ts_ns = pkt.ts_ns
         self.aa = pkt.aa
         self.rssi = pkt.rssi
         self.chan = pkt.chan
@@ -61,13 +61,20 @@ def ble_to_rf_chan(chan):
     else:
         return chan + 2
 
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+
 class PcapBleWriter:
     """
     PCAP BLE Link-layer with PHDR.
     """
     DLT = 256 # DLT_BLUETOOTH_LE_LL_WITH_PHDR
 
-    def __init__(self, output=None):
+    def __init__(self, output=None, nanosecond=False):
+        # nanosecond selects the nanosecond resolution PCAP variant, to keep the
+        # full precision of SDR timestamps
+        self.nanosecond = nanosecond
+
         # open stream
         if output is None:
             self.output = BytesIO()
@@ -87,7 +94,7 @@ class PcapBleWriter:
         """
         header = pack(
             '<IHHIIII',
-            0xa1b2c3d4,
+            PCAP_MAGIC_NSEC if self.nanosecond else PCAP_MAGIC_USEC,
             2,
             4,
             0,
@@ -97,14 +104,16 @@ class PcapBleWriter:
         )
         self.output.write(header)
 
-    def write_packet_header(self, ts_sec, ts_usec, packet_size):
+    def write_packet_header(self, ts_sec, ts_frac, packet_size):
         """
         Write packet header
+
+        ts_frac is in microseconds, or nanoseconds for nanosecond resolution PCAP.
         """
         pkt_header = pack(
             '<IIII',
             ts_sec,
-            ts_usec,
+            ts_frac,
             packet_size,
             packet_size
         )
@@ -157,11 +166,19 @@ class PcapBleWriter:
 
         Basically, generates payload and encapsulates in a header.
         """
-        ts_s = ts_usec // 1000000
-        ts_u = int(ts_usec - ts_s*1000000)
+        self.write_packet_ns(int(ts_usec) * 1000, aa, chan, rssi, packet,
+                             phy, pdu_type, aux_type, crc_rev, crc_err)
+
+    def write_packet_ns(self, ts_ns, aa, chan, rssi, packet,
+            phy=0, pdu_type=0, aux_type=0, crc_rev=0, crc_err=False):
+        """
+        Add packet to PCAP output, with an integer nanosecond timestamp.
+        """
+        ts_s, ts_ns = divmod(ts_ns, 1000000000)
+        ts_frac = ts_ns if self.nanosecond else ts_ns // 1000
         payload = self.payload(aa, packet, ble_to_rf_chan(chan), rssi,
                                phy, pdu_type, aux_type, crc_rev, crc_err)
-        self.write_packet_header(ts_s, ts_u, len(payload))
+        self.write_packet_header(ts_s, ts_frac, len(payload))
         self.output.write(payload)
 
     def write_packet_message(self, pkt: DPacketMessage):
@@ -175,7 +192,9 @@ class PcapBleWriter:
             elif isinstance(pkt, AuxScanRspMessage):
                 aux_type = 3
 
-        self.write_packet(int(pkt.ts_epoch * 1000000), pkt.aa, pkt.chan, pkt.rssi,
+        # Use the exact 64-bit timestamp where the source provides one
+        ts_ns = pkt.ts_ns if pkt.ts_ns is not None else int(pkt.ts_epoch * 1000000) * 1000
+        self.write_packet_ns(ts_ns, pkt.aa, pkt.chan, pkt.rssi,
                 pkt.body, pkt.phy, pdu_type, aux_type, pkt.crc_rev, pkt.crc_err)
 
     def close(self):
@@ -201,8 +220,7 @@ class PcapBleReader:
 
     def read_header(self):
         expected_header = pack(
-            '<IHHIIII',
-            0xa1b2c3d4,
+            '<HHIIII',
             2,
             4,
             0,
@@ -210,16 +228,21 @@ class PcapBleReader:
             65535,
             self.DLT
         )
+        magic = self.input.read(4)
         read_header = self.input.read(len(expected_header))
-        if read_header != expected_header:
+        if len(magic) < 4 or read_header != expected_header:
+            raise ValueError("Unexpected PCAP header")
+        magic, = unpack('<I', magic)
+        if magic not in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
             raise ValueError("Unexpected PCAP header")
+        self.nanosecond = magic == PCAP_MAGIC_NSEC
 
     def read_packet(self):
         # Read and parse packet header
         hdr = self.input.read(16)
         if len(hdr) < 16:
             raise EOFError
-        ts_sec, ts_usec, size1, size2 = unpack('<IIII', hdr)
+        ts_sec, ts_frac, size1, size2 = unpack('<IIII', hdr)
         assert size1 == size2
 
         payload = self.input.read(size1)
@@ -244,12 +267,12 @@ class PcapBleReader:
         crc_rev = payload[-3] + (payload[-2] << 8) + (payload[-1] << 16)
         assert len(body) == body[1] + 2
 
-        ts32 = (ts_sec*1000000 + ts_usec) & 0x3FFFFFFF
+        ts_ns = ts_sec*1000000000 + (ts_frac if self.nanosecond else ts_frac*1000)
         chan = rf_to_ble_chan(rf_chan)
         peripheral_send = True if pdu_type == 3 else False
 
-        pkt = PacketMessage.from_fields(ts32, len(body), 0, rssi, chan, phy, body,
-                                        crc_rev, crc_err, self.decoder_state, peripheral_send)
+        pkt = PacketMessage.from_fields(0, len(body), 0, rssi, chan, phy, body,
+                                        crc_rev, crc_err, self.decoder_state, peripheral_send, ts_ns)
         try:
             return DPacketMessage.decode(pkt, self.decoder_state)
         except BaseException as e:
@@ -5,7 +5,15 @@
 import numpy
 import scipy.signal
 from math import gcd
+from numpy.lib.stride_tricks import as_strided
 
+# Streaming rational resampler, computing only the output phases needed
+# Every up outputs (a cycle) consume down inputs, with output r of a cycle taking
+# filter phase (r * down) % up from input (r * down) // up of the cycle and the order - 1
+# inputs before it. Whole cycles are computed as rows of a matrix product with a
+# sparse (down + order - 1) x up tap matrix, using strided views of the input for the
+# rows, so no copy of the input is needed. Inputs of an unfinished cycle along with the
+# filter history are kept in a small preallocated buffer between calls.
 class PolyphaseResampler:
     def __init__(self, up, down, dtype=numpy.complex64, order=5, rel_bw=0.95):
         g = gcd(up, down)
@@ -18,26 +26,122 @@ class PolyphaseResampler:
         else:
             filt_bw = rel_bw / self.up
         self.filt_coeffs = scipy.signal.firwin(filt_size, filt_bw).astype(dtype) * self.up
-        self.state_len = self.filt_multiple + self.down // up
-        self.state = numpy.zeros(self.state_len, dtype)
-        self.adjust = 0 # starting index in upsampled array relative to first sample of new data
-        self.pad_lut = [self.compute_pad(i) for i in range(1 - self.down, self.down)]
-
-    def feed(self, samples):
-        pad_samples = self.pad_lut[self.adjust + self.down - 1]
-        samples2 = numpy.concatenate([numpy.zeros(pad_samples, self.state.dtype), self.state, samples])
-        resamp = scipy.signal.upfirdn(self.filt_coeffs, samples2, self.up, self.down)
-        self.state = samples2[-self.state_len:]
-        start_idx = ((pad_samples + self.state_len) * self.up + self.adjust + self.down - 1) // self.down
-        end_idx = (len(samples2) * self.up + self.down - 1) // self.down
-        self.adjust = end_idx * self.down - len(samples2) * self.up
-        return resamp[start_idx:end_idx]
-
-    def compute_pad(self, adjust):
-        for i in range(self.down):
-            if ((i + self.state_len) * self.up + adjust) % self.down == 0:
-                return i
-        assert(False)
+        self.dtype = numpy.dtype(dtype)
+
+        # Tap matrix rows are the filter history (order - 1 inputs), then the cycle's inputs
+        self.hist_len = order - 1
+        self.offsets = (numpy.arange(self.up) * self.down) // self.up
+        phases = (numpy.arange(self.up) * self.down) % self.up
+        taps = numpy.zeros((self.hist_len + self.down, self.up), dtype)
+        for t in range(order):
+            taps[self.offsets - t + self.hist_len, numpy.arange(self.up)] = \
+                    self.filt_coeffs[phases + t * self.up]
+        self.taps = taps
+        self.taps_hist = numpy.ascontiguousarray(taps[:self.hist_len])
+        self.taps_cycle = numpy.ascontiguousarray(taps[self.hist_len:])
+
+        # Filter history followed by inputs of the current unfinished cycle
+        max_head = self.hist_len + self.down * (2 + self.hist_len // self.down)
+        self.pending = numpy.zeros(max_head, dtype)
+        self.pending_len = self.hist_len
+        self.cycle_done = 0 # outputs of the current cycle already returned
+        self.head_buf = numpy.empty(max_head, dtype)
+        self.head_out = numpy.empty((2 + self.hist_len // self.down, self.up), dtype)
+        self.tmp = numpy.empty((0, self.up), dtype)
+
+    # Start over with zero history, as if newly created
+    def reset(self):
+        self.pending[:self.hist_len] = 0
+        self.pending_len = self.hist_len
+        self.cycle_done = 0
+
+    # Number of outputs the next call to feed will produce for num_samples inputs
+    def output_len(self, num_samples):
+        avail = self.pending_len - self.hist_len + num_samples
+        cycles = avail // self.down
+        left = avail - cycles * self.down
+        return cycles * self.up + -(-left * self.up // self.down) - self.cycle_done
+
+    # Returns resampled outputs, written to out (which must be large enough) if given
+    def feed(self, samples, out=None):
+        n_out = self.output_len(len(samples))
+        if out is None:
+            out = numpy.empty(n_out, self.dtype)
+        elif len(out) < n_out:
+            raise ValueError("Output buffer too small")
+        out = out[:n_out]
+        samples = numpy.asarray(samples, self.dtype)
+
+        # Cycle c spans stream indices c * down to c * down + hist_len + down, where the
+        # stream is the pending inputs followed by samples
+        P = self.pending_len
+        n = len(samples)
+        cycles = (P - self.hist_len + n) // self.down
+        body_first = min(-(-P // self.down), cycles) # first cycle entirely within samples
+
+        # Cycles starting in the pending inputs, through a small stitched buffer
+        o = 0
+        if body_first:
+            head_len = body_first * self.down + self.hist_len
+            head = self.head_buf[:head_len]
+            head[:P] = self.pending[:P]
+            head[P:] = samples[:head_len - P]
+            head_out = self.head_out[:body_first]
+            self._cycles(head, 0, body_first, head_out)
+            o = body_first * self.up - self.cycle_done
+            out[:o] = head_out.ravel()[self.cycle_done:]
+            self.cycle_done = 0
+
+        # Cycles entirely within samples, straight into the output
+        if cycles > body_first:
+            count = cycles - body_first
+            self._cycles(samples, body_first * self.down - P, count,
+                         out[o:o + count * self.up].reshape(count, self.up))
+            o += count * self.up
+
+        # Keep the history and inputs of the unfinished cycle
+        keep = P + n - cycles * self.down
+        if n >= keep:
+            self.pending[:keep] = samples[n - keep:]
+        else:
+            self.pending[:keep] = numpy.concatenate([self.pending[P - (keep - n):P], samples])
+        self.pending_len = keep
+
+        # Outputs of the unfinished cycle that already have their newest input
+        done = self.cycle_done
+        for r in range(done, done + n_out - o):
+            rows = slice(self.offsets[r], self.offsets[r] + self.hist_len + 1)
+            out[o + r - done] = numpy.dot(self.pending[rows], self.taps[rows, r])
+        self.cycle_done = done + n_out - o
+        return out
+
+    def _cycles(self, x, start, count, out):
+        isz = x.itemsize
+        rows = as_strided(x[start + self.hist_len:], (count, self.down), (self.down * isz, isz))
+        numpy.matmul(rows, self.taps_cycle, out=out)
+        if self.hist_len:
+            if len(self.tmp) < count:
+                self.tmp = numpy.empty((count, self.up), self.dtype)
+            tmp = self.tmp[:count]
+            hist = as_strided(x[start:], (count, self.hist_len), (self.down * isz, isz))
+            numpy.matmul(hist, self.taps_hist, out=tmp)
+            out += tmp
+
+# Throughput of the resampling ratios used by SniffleSDR, in millions of input samples/s
+def benchmark_resampler(chunk_size=4000000, chunks=4):
+    from time import perf_counter
+    rng = numpy.random.default_rng(0)
+    samples = (rng.standard_normal(chunk_size) + 1j * rng.standard_normal(chunk_size)).astype(numpy.complex64)
+    results = {}
+    for up, down, order in ((25, 32, 5), (25, 1536, 25), (25, 768, 25), (2, 1, 16)):
+        resampler = PolyphaseResampler(up, down, order=order)
+        out = numpy.empty(resampler.output_len(chunk_size) + up, numpy.complex64)
+        resampler.feed(samples, out)
+        t = perf_counter()
+        for i in range(chunks):
+            resampler.feed(samples, out)
+        results['%d/%d' % (up, down)] = chunk_size * chunks / (perf_counter() - t) / 1e6
+    return results
 
 def plot_resamp(up, down):
     fs = 1000
@@ -78,4 +182,9 @@ def plot_resamp(up, down):
     plt.show()
 
 if __name__ == "__main__":
-    plot_resamp(25, 32)
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'plot':
+        plot_resamp(25, 32)
+    else:
+        for ratio, msps in benchmark_resampler().items():
+            print("%8s: %6.1f MSPS" % (ratio, msps))
@@ -0,0 +1,316 @@
+# Written by Sultan Qasim Khan
+# Copyright (c) 2024, NCC Group plc
+# Released as open source under GPLv3
+
+# Throughput benchmarks of each stage of the SDR receive pipeline, and of the whole
+# pipeline replaying a capture, on synthetic (sdr_gen) or recorded IQ. For example:
+# python3 -m sniffle.sdr_bench --fs 122.88e6 --json bench.json
+# python3 -m sniffle.sdr_bench --file capture.sigmf-data --workers 1,2,4
+
+import json
+import os
+import platform
+import tempfile
+import time
+from os import cpu_count
+
+import numpy
+import scipy
+
+from .constants import BLE_ADV_AA, BLE_ADV_CRCI
+from .crc_ble import rbit24, crc_ble_check_batch
+from .decoder_state import SniffleDecoderState
+from .packet_decoder import DPacketMessage
+from .sdr_utils import FMDemodulator, EnergyGate, MultiSyncDetector
+from .channelizer import FastConvChannelizer
+from .resampler import PolyphaseResampler
+from .iq_file import IQFileSource
+from .sdr_gen import BLESignalGenerator
+from .sniffle_sdr import SniffleSDR, SniffleFileSDR, ChannelProcessor, freq_from_chan, \
+        chan_from_freq
+from .errors import SourceDone
+
+# Sample rates the pipeline channelizes directly, with their number of channelizer outputs
+NUM_CHANNELS = {122.88e6: 48, 61.44e6: 24}
+
+# Number of samples processed per second, in millions, and the real time factor (how
+# many times faster than rate_required the stage ran)
+def _throughput(num_samples, elapsed, rate_required):
+    msps = num_samples / elapsed / 1e6 if elapsed else None
+    return {
+        'samples': num_samples,
+        'seconds': elapsed,
+        'msps': msps,
+        'realtime_factor': msps * 1e6 / rate_required if msps else None
+    }
+
+def _chunks(samples, chunk_size):
+    for i in range(0, len(samples), chunk_size):
+        yield samples[i:i + chunk_size]
+
+# Writes a synthetic capture of advertisers on the primary advertising channels to
+# file_name, returning the number of packets in it
+def make_capture(file_name, fs=122.88e6, duration=0.1, advertisers=20, interval=0.02,
+                 snr=20., seed=0):
+    gen = BLESignalGenerator(fs, freq_from_chan(17), -20. - snr, seed)
+    rng = gen.rng
+    chans = [c for c in (37, 38, 39) if abs(gen.chan_freq(c) - gen.center_freq) + 1e6 <= fs / 2]
+    for _ in range(advertisers):
+        adv_a = rng.integers(0, 256, 6).astype(numpy.uint8).tobytes()
+        adv_data = rng.integers(0, 256, rng.integers(0, 32)).astype(numpy.uint8).tobytes()
+        gen.add_advertiser(adv_a, rng.uniform(0, interval), duration - 0.003, interval,
+                           adv_data, chans, cfo=rng.uniform(-50e3, 50e3))
+    gen.write(file_name, duration)
+    return len(gen.packets)
+
+# Returns the throughput, the channelizer stage timings, and the channelized output for
+# each of chans (BLE channels) as complex64 arrays
+def bench_channelizer(samples, fs, center_chan, chans, chunk_size, workers=None):
+    channelizer = FastConvChannelizer(fs, NUM_CHANNELS[fs], workers=workers)
+    rf_center = freq_from_chan(center_chan)
+    idx = {c: channelizer.chan_idx(int(round((freq_from_chan(c) - rf_center) / 2e6))) for c in chans}
+    channelizer.process(samples[:chunk_size], list(idx.values())) # warm up
+    channelizer.close()
+
+    channelizer = FastConvChannelizer(fs, NUM_CHANNELS[fs], workers=workers)
+    outputs = {c: [] for c in chans}
+    t0 = time.perf_counter()
+    for chunk in _chunks(samples, chunk_size):
+        channelized = channelizer.process(chunk, list(idx.values()))
+        for c, i in idx.items():
+            outputs[c].append(channelized[i].copy())
+    elapsed = time.perf_counter() - t0
+    timings = channelizer.get_timings()
+    channelizer.close()
+    outputs = {c: numpy.concatenate(o) if o else numpy.zeros(0, numpy.complex64)
+               for c, o in outputs.items()}
+    return _throughput(len(samples), elapsed, fs), timings, outputs
+
+# Benchmarks the per-channel stages on channelized outputs (BLE channel to 2 MSPS samples),
+# fed in chunks of chunk_size samples. Returns stage results, and the packets received.
+def bench_channel_stages(outputs, chunk_size):
+    stages = {}
+    total = sum(len(x) for x in outputs.values())
+    rate_required = 2e6 * len(outputs)
+
+    def run(name, func):
+        t0 = time.perf_counter()
+        for chan, x in outputs.items():
+            func(chan, x)
+        stages[name] = _throughput(total, time.perf_counter() - t0, rate_required)
+
+    # The only resampling in the wideband pipeline: 2M PHY processors interpolate their
+    # critically sampled 2 MSPS channel to 4 MSPS (as ChannelProcessor does)
+    def interp_2m(chan, x):
+        resampler = PolyphaseResampler(2, 1, order=16)
+        out = numpy.empty(resampler.output_len(chunk_size) + 2, numpy.complex64)
+        for chunk in _chunks(x, chunk_size):
+            resampler.feed(chunk, out)
+    run('interp_2m', interp_2m)
+
+    gates = {}
+    def gate(chan, x):
+        g = gates[chan] = EnergyGate()
+        for chunk in _chunks(x, chunk_size):
+            g.feed(chunk)
+    run('energy_gate', gate)
+
+    demod_bits = {}
+    def demod(chan, x):
+        demodulator = FMDemodulator(chunk_size)
+        bits = demod_bits[chan] = numpy.empty(len(x), bool)
+        for i in range(0, len(x), chunk_size):
+            demodulator.feed_bits(x[i:i + chunk_size], out=bits[i:i + chunk_size])
+    run('demod', demod)
+
+    syncs = {}
+    def sync(chan, x):
+        detector = MultiSyncDetector([BLE_ADV_AA])
+        bits = demod_bits[chan]
+        found = []
+        for i in range(0, len(bits), chunk_size):
+            indices, _ = detector.feed_multi(bits[i:i + chunk_size])
+            found.append(indices + i)
+        syncs[chan] = numpy.concatenate(found) if found else numpy.zeros(0, numpy.int64)
+    run('sync', sync)
+
+    crci_rev = rbit24(BLE_ADV_CRCI)
+    def extract(chan, x):
+        _, dw, lens = ChannelProcessor.ble_pkt_extract_batch(demod_bits[chan], syncs[chan], chan)
+        crc_ble_check_batch(crci_rev, dw, lens)
+    run('extract', extract)
+
+    # Complete per-channel processing as done by SniffleSDR (energy gate, CFO
+    # compensation, demodulation, sync search, extraction, and CRC retries)
+    pkts = []
+    def process(chan, x):
+        g = EnergyGate()
+        processor = ChannelProcessor(chan, 2e6)
+        for chunk in _chunks(x, chunk_size):
+            pkts.extend(processor.feed_spans(chunk, g.feed(chunk), g.hold))
+        pkts.extend(processor.flush())
+    run('channel_processor', process)
+
+    # Decoding is per packet, so its rate is in packets per second
+    state = SniffleDecoderState()
+    t0 = time.perf_counter()
+    for p in pkts:
+        DPacketMessage.decode(p.to_packet_message(state), state)
+    elapsed = time.perf_counter() - t0
+    stages['decode'] = {
+        'packets': len(pkts),
+        'seconds': elapsed,
+        'packets_per_sec': len(pkts) / elapsed if elapsed else None
+    }
+    stages['syncs'] = int(sum(len(s) for s in syncs.values()))
+    return stages, pkts
+
+# Replays file_name through SniffleFileSDR, returning throughput and packets received
+def bench_end_to_end(file_name, workers=None, **kwargs):
+    sdr = SniffleFileSDR(file_name, fast=True, demod_workers=workers,
+                         channelizer_workers=workers, **kwargs)
+    sdr.setup_sniffer()
+    num_pkts = 0
+    t0 = time.perf_counter()
+    while True:
+        try:
+            if sdr.recv_and_decode() is not None:
+                num_pkts += 1
+        except SourceDone:
+            break
+    elapsed = time.perf_counter() - t0
+    metrics = sdr.get_metrics()
+    sdr.cancel_recv()
+    result = _throughput(sdr.source.num_samples, elapsed, sdr.fs_source)
+    result['packets'] = num_pkts
+    result['chunks'] = metrics.get('chunks')
+    result['shed_chunks'] = metrics.get('shed_chunks')
+    return result
+
+def _worker_counts():
+    counts = []
+    n = 1
+    while n < cpu_count():
+        counts.append(n)
+        n *= 2
+    counts.append(cpu_count())
+    return counts
+
+# Runs all benchmarks on file_name (or a synthetic capture at fs if None), returning
+# a JSON serializable dict of results. workers lists the thread counts for scaling runs.
+def run_benchmarks(file_name=None, fs=122.88e6, duration=0.1, snr=20., workers=None,
+                   chunk_size=SniffleSDR.chunk_size, max_samples=None, all_chan=False):
+    results = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'host': {
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpu_count': cpu_count(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'scipy': scipy.__version__
+        }
+    }
+    if workers is None:
+        workers = _worker_counts()
+
+    tmp_dir = None
+    if file_name is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        file_name = os.path.join(tmp_dir.name, 'bench.sigmf-data')
+        num_pkts = make_capture(file_name, fs, duration, snr=snr)
+        results['source'] = {'synthetic': True, 'packets': num_pkts, 'snr': snr}
+    else:
+        results['source'] = {'synthetic': False, 'file': file_name}
+
+    try:
+        source = IQFileSource(file_name, stop=max_samples)
+        fs = source.meta.get('fs', fs)
+        if fs not in NUM_CHANNELS:
+            raise ValueError("Benchmarks need a 122.88 or 61.44 MSPS capture")
+        center_chan = chan_from_freq(source.meta.get('center_freq', freq_from_chan(17)))
+        samples = source.read(source.num_samples)
+        if samples is None:
+            raise ValueError("Empty capture")
+        results['source'].update({'fs': fs, 'center_chan': center_chan, 'samples': len(samples),
+                                  'format': source.fmt})
+        chans = list(range(40)) if all_chan else [37, 38, 39]
+        rf_center = freq_from_chan(center_chan)
+        chans = [c for c in chans if abs(freq_from_chan(c) - rf_center) + 1e6 <= fs / 2]
+        results['config'] = {'chunk_size': chunk_size, 'chans': chans, 'workers': workers}
+
+        stages = {}
+        stages['channelizer'], timings, outputs = bench_channelizer(samples, fs, center_chan,
+                                                                     chans, chunk_size)
+        stages['channelizer']['timings'] = timings
+        chan_stages, _ = bench_channel_stages(outputs, max(int(chunk_size * 2e6 / fs), 1))
+        stages.update(chan_stages)
+        results['stages'] = stages
+
+        # Per-core scaling of the channelizer and of the whole pipeline
+        scaling = {'channelizer': {}, 'end_to_end': {}}
+        for w in workers:
+            scaling['channelizer'][w] = bench_channelizer(samples, fs, center_chan, chans,
+                                                          chunk_size, w)[0]
+            scaling['end_to_end'][w] = bench_end_to_end(file_name, w, stop=max_samples,
+                                                        all_chan=all_chan)
+        for runs in scaling.values():
+            base = runs[workers[0]]['msps'] / workers[0]
+            for w, r in runs.items():
+                r['efficiency'] = r['msps'] / (w * base) if base else None
+        results['scaling'] = scaling
+        results['end_to_end'] = scaling['end_to_end'][max(workers)]
+    finally:
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+    return results
+
+def print_results(results):
+    src = results['source']
+    print("Source: %s, %.2f MSPS, %d samples" % (src.get('file', 'synthetic'), src['fs'] / 1e6,
+                                                src['samples']))
+    print("%-18s %10s %10s" % ("Stage", "MSPS", "Realtime"))
+    for name, r in results['stages'].items():
+        if isinstance(r, dict) and 'msps' in r:
+            print("%-18s %10.1f %9.2fx" % (name, r['msps'], r['realtime_factor']))
+    decode = results['stages']['decode']
+    if decode['packets_per_sec']:
+        print("%-18s %10.0f packets/s (%d packets)" % ('decode', decode['packets_per_sec'],
+                                                      decode['packets']))
+    print("%-18s %10s %10s %10s %10s" % ("Scaling (workers)", "Chan MSPS", "Efficiency",
+                                         "E2E MSPS", "Realtime"))
+    for w in results['config']['workers']:
+        c = results['scaling']['channelizer'][w]
+        e = results['scaling']['end_to_end'][w]
+        print("%-18d %10.1f %10.2f %10.1f %9.2fx" % (w, c['msps'], c['efficiency'], e['msps'],
+                                                   e['realtime_factor']))
+
+def main():
+    import argparse
+    aparse = argparse.ArgumentParser(description="Benchmark the SDR receive pipeline")
+    aparse.add_argument("-f", "--file", default=None, help="IQ capture (default synthetic)")
+    aparse.add_argument("--fs", type=float, default=122.88e6, help="Synthetic sample rate (Hz)")
+    aparse.add_argument("--duration", type=float, default=0.1, help="Synthetic length (s)")
+    aparse.add_argument("--snr", type=float, default=20., help="Synthetic packet SNR (dB)")
+    aparse.add_argument("--max-samples", type=int, default=None, help="Limit file samples")
+    aparse.add_argument("--chunk-size", type=int, default=SniffleSDR.chunk_size,
+                        help="Input samples per chunk")
+    aparse.add_argument("--workers", default=None,
+                        help="Comma separated worker counts for scaling (default 1, 2, 4 .. CPUs)")
+    aparse.add_argument("--all-chan", action="store_true", help="Process all 40 channels")
+    aparse.add_argument("--json", default=None, help="Write results as JSON ('-' for stdout)")
+    args = aparse.parse_args()
+
+    workers = [int(w) for w in args.workers.split(',')] if args.workers else None
+    results = run_benchmarks(args.file, args.fs, args.duration, args.snr, workers,
+                             args.chunk_size, args.max_samples, args.all_chan)
+    if args.json == '-':
+        print(json.dumps(results, indent=2))
+        return
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+# Written by Sultan Qasim Khan
+# Copyright (c) 2024, NCC Group plc
+# Released as open source under GPLv3
+
+import json
+import numpy
+import scipy.signal
+from math import ceil
+
+from .constants import BLE_ADV_AA, BLE_ADV_CRCI, PhyMode
+from .crc_ble import rbit24, crc_ble_reverse
+from .whitening_ble import le_dewhiten
+from .coding_ble import fec_ble_encode, fec_ble_encode_int, pattern_map_p4, CODED_PREAMBLE
+from .pcap import ble_to_rf_chan
+from .iq_file import IQ_FORMATS, SIGMF_DATATYPES, sigmf_meta_path
+
+def _unpack(data):
+    return numpy.unpackbits(numpy.frombuffer(bytes(data), numpy.uint8), bitorder='little')
+
+# LE Coded PHY pattern mapping for S=8 of an array of coded bits, by the library mapper
+# so that generated captures check it too. Bits are padded to whole bytes for mapping.
+def _pattern_map_bits(bits):
+    syms = _unpack(pattern_map_p4(numpy.packbits(bits, bitorder='little').tobytes()))
+    return syms[:4 * len(bits)]
+
+# FEC encodes data followed by the tail_bits low bits of tail, returning coded bits
+def _fec_bits(data, tail, tail_bits):
+    state = data[-1] >> 5 if data else 0
+    coded_tail = fec_ble_encode_int(tail, tail_bits, state)
+    tail_syms = [(coded_tail >> i) & 1 for i in range(2 * tail_bits)]
+    return numpy.concatenate([_unpack(fec_ble_encode(data)), numpy.array(tail_syms, numpy.uint8)])
+
+# On air symbols of a packet with the given PDU (header and payload, no CRC), as bits
+# The CRC is computed and appended, and the PDU and CRC are whitened for chan
+def ble_packet_syms(pdu, chan, aa=BLE_ADV_AA, crci=BLE_ADV_CRCI, phy=PhyMode.PHY_1M):
+    pdu = bytes(pdu)
+    crc = crc_ble_reverse(rbit24(crci), pdu)
+    body = le_dewhiten(pdu + crc.to_bytes(3, 'little'), chan)
+    aa_bytes = aa.to_bytes(4, 'little')
+
+    if phy in (PhyMode.PHY_1M, PhyMode.PHY_2M):
+        # Preamble alternates, ending opposite to the first AA bit
+        preamble = (b'\x55' if aa & 1 else b'\xAA') * (2 if phy == PhyMode.PHY_2M else 1)
+        return _unpack(preamble + aa_bytes + body)
+    elif phy in (PhyMode.PHY_CODED_S8, PhyMode.PHY_CODED_S2):
+        # FEC block 1 (AA, CI, TERM1) is always S=8, CI 0 is S=8 and CI 1 is S=2
+        ci = 0 if phy == PhyMode.PHY_CODED_S8 else 1
+        block1 = _pattern_map_bits(_fec_bits(aa_bytes, ci, 5))
+        block2 = _fec_bits(body, 0, 3) # PDU, CRC, TERM2
+        if phy == PhyMode.PHY_CODED_S8:
+            block2 = _pattern_map_bits(block2)
+        return numpy.concatenate([_unpack(CODED_PREAMBLE), block1, block2])
+    else:
+        raise ValueError("Invalid PHY %s" % phy)
+
+# GFSK modulates symbols (bits) at sym_rate to unit amplitude complex baseband at fs
+# bt is the Gaussian filter bandwidth-time product and h the modulation index. The
+# signal is shifted by freq (Hz), and starts at the given carrier phase (radians).
+def gfsk_modulate(syms, sym_rate, fs, bt=0.5, h=0.5, freq=0., phase=0.):
+    sps = fs / sym_rate
+    n = int(ceil(len(syms) * sps))
+    sym_idx = numpy.minimum((numpy.arange(n) / sps).astype(numpy.int64), len(syms) - 1)
+    nrz = 2. * numpy.asarray(syms, numpy.float64)[sym_idx] - 1
+
+    # Gaussian pulse spanning 3 symbols, normalized so the frequency settles at +/- 1
+    sigma = numpy.sqrt(numpy.log(2)) / (2 * numpy.pi * bt) * sps
+    half_len = int(ceil(1.5 * sps))
+    taps = numpy.exp(-0.5 * (numpy.arange(-half_len, half_len + 1) / sigma) ** 2)
+    taps /= taps.sum()
+    freq_dev = scipy.signal.fftconvolve(nrz, taps, 'same') if len(taps) > 1 else nrz
+
+    dphase = freq_dev * (numpy.pi * h / sps) + 2 * numpy.pi * freq / fs
+    return numpy.exp(1j * (phase + numpy.cumsum(dphase))).astype(numpy.complex64)
+
+# Synthesizes a capture of BLE packets, as an SDR centered on center_freq with sample
+# rate fs would receive them, for benchmarking and regression testing without hardware.
+# noise_db is the noise power within a 2 MHz channel relative to full scale, so a packet
+# added with power_db has an SNR of power_db - noise_db. Ground truth for each packet
+# added is kept in self.packets as dicts of its add_packet arguments.
+class BLESignalGenerator:
+    def __init__(self, fs=122.88e6, center_freq=2440e6, noise_db=-60., seed=None):
+        self.fs = fs
+        self.center_freq = center_freq
+        self.noise_db = noise_db
+        self.rng = numpy.random.default_rng(seed)
+        self.packets = []
+        self._pending = [] # (start sample, packet index), synthesized on demand
+
+    def chan_freq(self, chan):
+        return 2402e6 + ble_to_rf_chan(chan) * 2e6
+
+    # Adds a packet starting (with its preamble) t seconds into the capture
+    # cfo is the transmitter's carrier frequency offset in Hz, and ppm its symbol clock error
+    def add_packet(self, t, pdu, chan, aa=BLE_ADV_AA, crci=BLE_ADV_CRCI, phy=PhyMode.PHY_1M,
+                   power_db=-20., cfo=0., ppm=0.):
+        phy = PhyMode(phy)
+        offset = self.chan_freq(chan) - self.center_freq
+        if abs(offset) + 1e6 > self.fs / 2:
+            raise ValueError("Channel %d is outside the captured bandwidth" % chan)
+        pkt = {'t': t, 'chan': chan, 'phy': phy, 'aa': aa, 'crci': crci, 'pdu': bytes(pdu),
+               'power_db': power_db, 'cfo': cfo, 'ppm': ppm}
+        self.packets.append(pkt)
+        self._pending.append((int(round(t * self.fs)), len(self.packets) - 1))
+
+    # Adds advertising events from one device: ADV_NONCONN_IND packets with adv_data,
+    # sent on each of chans in turn every interval seconds (plus the 0-10 ms random
+    # advertising delay) from t_start until t_stop. Returns the number of packets added.
+    def add_advertiser(self, adv_a, t_start, t_stop, interval=0.1, adv_data=b'',
+                       chans=(37, 38, 39), phy=PhyMode.PHY_1M, power_db=-20., cfo=0., ppm=0.,
+                       hop_gap=500e-6):
+        pdu = bytes([0x42, 6 + len(adv_data)]) + bytes(adv_a) + bytes(adv_data)
+        count = 0
+        t = t_start
+        while t < t_stop:
+            for i, chan in enumerate(chans):
+                self.add_packet(t + i * hop_gap, pdu, chan, phy=phy, power_db=power_db,
+                                cfo=cfo, ppm=ppm)
+                count += 1
+            t += interval + self.rng.uniform(0, 10e-3)
+        return count
+
+    def _synthesize(self, pkt):
+        sym_rate = 2e6 if pkt['phy'] == PhyMode.PHY_2M else 1e6
+        syms = ble_packet_syms(pkt['pdu'], pkt['chan'], pkt['aa'], pkt['crci'], pkt['phy'])
+        freq = self.chan_freq(pkt['chan']) - self.center_freq + pkt['cfo']
+        sig = gfsk_modulate(syms, sym_rate * (1 + pkt['ppm'] * 1e-6), self.fs, freq=freq,
+                            phase=self.rng.uniform(0, 2 * numpy.pi))
+        sig *= numpy.float32(10 ** (pkt['power_db'] / 20))
+        return sig
+
+    # Yields the capture from its start as complex64 chunks of chunk_size samples, up to
+    # num_samples in total. Packets are synthesized as they are reached, so long captures
+    # don't need to fit in memory.
+    def iter_chunks(self, num_samples, chunk_size=1 << 20):
+        pending = sorted(self._pending)
+        noise_std = numpy.sqrt(10 ** (self.noise_db / 10) * self.fs / 2e6 / 2)
+        active = [] # (start sample, samples)
+        next_pkt = 0
+        for pos in range(0, num_samples, chunk_size):
+            n = min(chunk_size, num_samples - pos)
+            chunk = numpy.empty(n, numpy.complex64)
+            iq = chunk.view(numpy.float32)
+            self.rng.standard_normal(2 * n, numpy.float32, out=iq)
+            iq *= numpy.float32(noise_std)
+
+            while next_pkt < len(pending) and pending[next_pkt][0] < pos + n:
+                start, idx = pending[next_pkt]
+                active.append((start, self._synthesize(self.packets[idx])))
+                next_pkt += 1
+
+            still_active = []
+            for start, sig in active:
+                s0 = max(pos, start)
+                s1 = min(pos + n, start + len(sig))
+                if s1 > s0:
+                    chunk[s0 - pos:s1 - pos] += sig[s0 - start:s1 - start]
+                if start + len(sig) > pos + n:
+                    still_active.append((start, sig))
+            active = still_active
+            yield chunk
+
+    # Returns a capture of duration seconds as one complex64 array
+    def generate(self, duration):
+        num_samples = int(round(duration * self.fs))
+        chunks = list(self.iter_chunks(num_samples))
+        return numpy.concatenate(chunks) if chunks else numpy.zeros(0, numpy.complex64)
+
+    # Writes a capture of duration seconds to file_name in one of the IQ_FORMATS, clipping
+    # to full scale, with a SigMF metadata sidecar if sigmf is set. Returns samples written.
+    def write(self, file_name, duration, fmt='cf32', sigmf=True, chunk_size=1 << 20):
+        if fmt not in IQ_FORMATS:
+            raise ValueError("Unsupported IQ format %s" % fmt)
+        dtype, scale, offset = IQ_FORMATS[fmt]
+        num_samples = int(round(duration * self.fs))
+        with open(file_name, 'wb') as f:
+            for chunk in self.iter_chunks(num_samples, chunk_size):
+                if fmt == 'cf32':
+                    chunk.tofile(f)
+                    continue
+                iq = chunk.view(numpy.float32) * numpy.float32(1 / scale) - numpy.float32(offset)
+                info = numpy.iinfo(dtype)
+                numpy.clip(numpy.rint(iq), info.min, info.max).astype(dtype).tofile(f)
+
+        if sigmf:
+            datatype = {v: k for k, v in SIGMF_DATATYPES.items()}[fmt]
+            meta = {
+                'global': {'core:datatype': datatype, 'core:sample_rate': self.fs,
+                           'core:version': '1.0.0'},
+                'captures': [{'core:sample_start': 0, 'core:frequency': self.center_freq}],
+                'annotations': []
+            }
+            with open(sigmf_meta_path(file_name), 'w') as f:
+                json.dump(meta, f, indent=2)
+        return num_samples
+
+# Writes a capture of advertisers on the primary advertising channels, for example:
+# python3 -m sniffle.sdr_gen capture.sigmf-data --fs 61.44e6 --advertisers 20 --snr 15
+def main():
+    import argparse
+    aparse = argparse.ArgumentParser(description="Synthesize BLE advertising IQ captures")
+    aparse.add_argument("output", help="Output IQ file name")
+    aparse.add_argument("--fs", type=float, default=122.88e6, help="Sample rate (Hz)")
+    aparse.add_argument("--chan", type=int, default=None,
+                        help="BLE channel to center on (default 17, or 37 at 2 MSPS)")
+    aparse.add_argument("--duration", type=float, default=1., help="Capture length (seconds)")
+    aparse.add_argument("--advertisers", type=int, default=10, help="Number of advertisers")
+    aparse.add_argument("--interval", type=float, default=0.1, help="Advertising interval (s)")
+    aparse.add_argument("--snr", type=float, default=20., help="Packet SNR in 2 MHz (dB)")
+    aparse.add_argument("--max-cfo", type=float, default=50e3,
+                        help="Advertiser CFOs are uniform in +/- this (Hz)")
+    aparse.add_argument("--fmt", choices=list(IQ_FORMATS), default='cf32', help="Sample format")
+    aparse.add_argument("--seed", type=int, default=None, help="Random seed")
+    args = aparse.parse_args()
+
+    chan = args.chan
+    if chan is None:
+        chan = 17 if args.fs > 2e6 else 37
+    gen = BLESignalGenerator(args.fs, 2402e6 + ble_to_rf_chan(chan) * 2e6, -20. - args.snr,
+                             args.seed)
+    chans = [c for c in (37, 38, 39) if abs(gen.chan_freq(c) - gen.center_freq) + 1e6 <= args.fs / 2]
+    rng = gen.rng
+    for _ in range(args.advertisers):
+        adv_a = rng.integers(0, 256, 6).astype(numpy.uint8).tobytes()
+        adv_data = rng.integers(0, 256, rng.integers(0, 32)).astype(numpy.uint8).tobytes()
+        gen.add_advertiser(adv_a, rng.uniform(0, args.interval), args.duration - 0.003,
+                           args.interval, adv_data, chans, cfo=rng.uniform(-1, 1) * args.max_cfo)
+    gen.write(args.output, args.duration, args.fmt)
+    print("Wrote %d packets" % len(gen.packets))
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,7 @@
 import numpy
 import scipy.signal
 from struct import pack
-from re import finditer
+from re import finditer, escape
 from math import gcd
 
 DEFAULT_BURST_THRESH = 0.002
@@ -152,6 +152,89 @@ def squelch(signal, thresh=DEFAULT_BURST_THRESH, pad=DEFAULT_BURST_PAD):
 
     return arr
 
+# Streaming block energy gate, finding the spans of each chunk that may hold bursts
+# Block powers above thresh_db over the noise floor are active, and spans are padded
+# by pad_blocks on either side. A span at the start of a chunk may begin up to hold
+# samples before it (negative start), so the caller should retain that many samples
+# from the end of an idle chunk. The noise floor follows a low percentile of block
+# powers, falling immediately but rising with a time constant of floor_blocks, so that
+# it stays on the noise even for busy channels and chunks shorter than a packet.
+class EnergyGate:
+    def __init__(self, block_len=32, pad_blocks=4, thresh_db=4., floor_pct=10, floor_blocks=8192):
+        self.block_len = block_len
+        self.pad_blocks = pad_blocks
+        self.hold = pad_blocks * block_len
+        self.thresh = 10 ** (thresh_db / 10)
+        self.floor_pct = floor_pct
+        self.floor_blocks = floor_blocks
+        self.noise_floor = None
+        self.carry = 0 # blocks of padding still owed to the next chunk
+
+        self.samples = 0
+        self.active_samples = 0
+        self.bursts = 0
+
+    # Returns a list of (start, stop) sample index spans within signal
+    def feed(self, signal):
+        n = len(signal)
+        if n == 0:
+            return []
+        # Mean power of each block, with any partial block at the end on its own
+        nfull = n // self.block_len
+        nblocks = nfull + (1 if n % self.block_len else 0)
+        iq = numpy.ascontiguousarray(signal, numpy.complex64).view(numpy.float32).reshape(-1, 2)
+        block_pow = numpy.empty(nblocks, numpy.float32)
+        full = iq[:nfull * self.block_len].reshape(nfull, 2 * self.block_len)
+        numpy.einsum('ij,ij->i', full, full, out=block_pow[:nfull])
+        block_pow[:nfull] *= 1 / self.block_len
+        if nblocks > nfull:
+            part = iq[nfull * self.block_len:].ravel()
+            block_pow[nfull] = numpy.dot(part, part) / (n - nfull * self.block_len)
+
+        k = nblocks * self.floor_pct // 100
+        floor = float(numpy.partition(block_pow, k)[k])
+        if self.noise_floor is None or floor < self.noise_floor:
+            self.noise_floor = floor
+        else:
+            self.noise_floor += min(nblocks / self.floor_blocks, 1.) * (floor - self.noise_floor)
+
+        # Pad each active block, then merge overlapping spans
+        active = numpy.flatnonzero(block_pow > self.noise_floor * self.thresh)
+        starts = numpy.concatenate([[-self.pad_blocks], active - self.pad_blocks])
+        stops = numpy.concatenate([[self.carry], active + self.pad_blocks + 1])
+        if not self.carry:
+            starts = starts[1:]
+            stops = stops[1:]
+        spans = []
+        if len(starts):
+            breaks = numpy.flatnonzero(starts[1:] > stops[:-1])
+            run_starts = starts[numpy.concatenate([[0], breaks + 1])] * self.block_len
+            run_stops = numpy.minimum(stops[numpy.concatenate([breaks, [len(stops) - 1]])] * self.block_len, n)
+            spans = list(zip(run_starts.tolist(), run_stops.tolist()))
+            self.active_samples += int(numpy.sum(run_stops - numpy.maximum(run_starts, 0)))
+            self.bursts += len(spans) - (1 if self.carry else 0)
+
+        if len(active):
+            self.carry = max(int(active[-1]) + self.pad_blocks + 1 - nblocks, 0)
+        else:
+            self.carry = max(self.carry - nblocks, 0)
+        self.samples += n
+        return spans
+
+    # Forget about activity before a gap in the input
+    def skip(self, num_samples):
+        self.carry = 0
+        self.samples += num_samples
+
+    def get_stats(self):
+        return {
+            'samples': self.samples,
+            'active_samples': self.active_samples,
+            'occupancy': self.active_samples / self.samples if self.samples else None,
+            'bursts': self.bursts,
+            'noise_floor_db': float(10 * numpy.log10(self.noise_floor)) if self.noise_floor else None
+        }
+
 # Slow textbook implementation using atan2 and unwrapping
 # Uses numpy.gradient on phase, which takes second-order difference
 # Second-order difference works well for 2+ samples per symbol (SPS), but not for 1 SPS
@@ -171,6 +254,146 @@ def fm_demod2(signal, prev=numpy.complex64(0)):
     with numpy.errstate(divide='ignore'):
         return (i*qdot - q*idot) / sq
 
+# Output of fm_demod2 to float32 rounding, as Im(x[n] * conj(x[n-1])) / |x[n]|^2 without
+# allocating temporaries. Scratch buffers are owned by the demodulator and grown as needed,
+# and the last sample is carried across calls for continuous streams.
+# Output goes to out if given (ex. straight into a caller's larger buffer), otherwise
+# returned arrays are views of the scratch buffers, only valid until the next call.
+class FMDemodulator:
+    def __init__(self, capacity=0, dtype=numpy.complex64):
+        self.dtype = numpy.dtype(dtype)
+        self.real_dtype = numpy.empty(0, self.dtype).real.dtype
+        self.prev = self.dtype.type(0)
+        self.capacity = -1
+        self._ensure_capacity(capacity)
+
+    def _ensure_capacity(self, n):
+        if n > self.capacity:
+            self.capacity = n
+            self.prod = numpy.empty(n, self.dtype)
+            self.mag = numpy.empty(n, self.real_dtype)
+            self.tmp = numpy.empty(n, self.real_dtype)
+            self.demod = numpy.empty(n, self.real_dtype)
+            self.bits = numpy.empty(n, bool)
+
+    def reset(self):
+        self.prev = self.dtype.type(0)
+
+    # x[n] * conj(x[n-1]), the imaginary part is the (scaled) phase change
+    def _phase_prod(self, signal):
+        n = len(signal)
+        self._ensure_capacity(n)
+        prod = self.prod[:n]
+        if n:
+            numpy.conjugate(signal[:-1], out=prod[1:])
+            numpy.multiply(prod[1:], signal[1:], out=prod[1:])
+            prod[0] = signal[0] * numpy.conj(self.prev)
+            self.prev = signal[-1]
+        return prod
+
+    # Soft demodulated output, like fm_demod2
+    def feed(self, signal, out=None):
+        n = len(signal)
+        prod = self._phase_prod(signal)
+        mag = self.mag[:n]
+        tmp = self.tmp[:n]
+        numpy.multiply(signal.real, signal.real, out=mag)
+        numpy.multiply(signal.imag, signal.imag, out=tmp)
+        numpy.add(mag, tmp, out=mag)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.divide(prod.imag, mag, out=self.demod[:n] if out is None else out)
+
+    # Sliced bits only (demodulated value > 0), skipping the normalization
+    # With offset (radians per sample), bits are whether the phase change exceeds it,
+    # as for a carrier frequency offset. Bits sliced at zero are also written to plain_out if
+    # given, from the same products.
+    def feed_bits(self, signal, out=None, offset=0., plain_out=None):
+        n = len(signal)
+        prod = self._phase_prod(signal)
+        if out is None:
+            out = self.bits[:n]
+        if plain_out is not None:
+            numpy.greater(prod.imag, 0, out=plain_out)
+        if not offset:
+            return numpy.greater(prod.imag, 0, out=out)
+
+        # Compare phase change against offset by rotating the products back by it
+        rot_imag = self.demod[:n]
+        numpy.multiply(prod.imag, self.real_dtype.type(numpy.cos(offset)), out=rot_imag)
+        rot_real = self.tmp[:n]
+        numpy.multiply(prod.real, self.real_dtype.type(numpy.sin(offset)), out=rot_real)
+        return numpy.greater(rot_imag, rot_real, out=out)
+
+# Data-aided carrier frequency offset estimate from known symbols (ex. preamble and AA)
+# prod holds x[n] * conj(x[n-1]) at the sampling instant of each symbol, and dev is the
+# nominal phase change per sample of a 1 symbol. Returns the offset in radians per sample,
+# and the coherence (0 to 1) of the products with the symbols, which is near 1 only if
+# the symbols were really there.
+def estimate_cfo_known(prod, syms, dev):
+    derotated = prod * numpy.exp(numpy.where(syms, -1j * dev, 1j * dev))
+    total = numpy.sum(derotated)
+    power = numpy.sum(numpy.abs(prod))
+    return float(numpy.angle(total)), float(abs(total) / power) if power else 0.
+
+# Feedforward symbol timing recovery over one packet
+# soft holds demodulated values at sps samples per symbol, with the nominal sampling
+# instant of symbol k at start + k * sps (start may be fractional, but must be at least
+# sps / 2). Over each block of block_syms symbols, the timing offset maximizing the eye
+# opening (mean magnitude of the soft values) is found from steps fractions of a symbol,
+# and the offsets are interpolated between block centers so that timing can drift over
+# the packet. Returns the soft values of each symbol at the recovered sampling instants.
+def recover_timing(soft, sps, start, block_syms=32, steps=8):
+    nsyms = int((len(soft) - 2 - start - sps / 2) // sps) + 1
+    if nsyms < 1:
+        return numpy.zeros(0, soft.dtype)
+    sample_idx = numpy.arange(len(soft))
+    nominal = start + numpy.arange(nsyms) * sps
+    taus = (numpy.arange(steps) / steps - 0.5) * sps
+
+    nblocks = max(nsyms // block_syms, 1)
+    block_len = min(block_syms, nsyms)
+    grid = nominal[:nblocks * block_len] + taus[:, None]
+    eye = numpy.abs(numpy.interp(grid, sample_idx, soft))
+    eye = eye.reshape(steps, nblocks, block_len).mean(axis=2)
+
+    # The eye opening is periodic in the symbol period, so take the best offset as the
+    # phase of its fundamental, which is unwrapped across blocks to follow timing drift
+    # past half a symbol
+    phasor = numpy.exp(2j * numpy.pi / sps * taus)
+    best = numpy.unwrap(numpy.angle(phasor @ eye)) * (sps / (2 * numpy.pi))
+    centers = (numpy.arange(nblocks) + 0.5) * block_len
+    tau = numpy.interp(numpy.arange(nsyms), centers, best)
+
+    # Drifting late can run past the buffered samples
+    inst = nominal + tau
+    inst = inst[inst <= len(soft) - 1]
+    return numpy.interp(inst, sample_idx, soft).astype(soft.dtype)
+
+# Per-transmitter carrier frequency offset history in Hz, for telemetry
+# Keeps a count, exponentially weighted mean, min, max, and last value for each key,
+# forgetting the least recently updated keys beyond max_keys.
+class CFOTracker:
+    def __init__(self, alpha=0.1, max_keys=1024):
+        self.alpha = alpha
+        self.max_keys = max_keys
+        self.history = {}
+
+    def update(self, key, cfo):
+        hist = self.history.pop(key, None)
+        if hist is None:
+            hist = {'count': 0, 'mean': cfo, 'min': cfo, 'max': cfo, 'last': cfo}
+        hist['count'] += 1
+        hist['mean'] += max(self.alpha, 1 / hist['count']) * (cfo - hist['mean'])
+        hist['min'] = min(hist['min'], cfo)
+        hist['max'] = max(hist['max'], cfo)
+        hist['last'] = cfo
+        self.history[key] = hist
+        if len(self.history) > self.max_keys:
+            del self.history[next(iter(self.history))]
+
+    def get_stats(self):
+        return {k: dict(v) for k, v in self.history.items()}
+
 def fsk_decode(signal, fs, sym_rate, clock_recovery=False, cfo=0):
     demod = fm_demod2(signal)
 
@@ -209,7 +432,8 @@ class ExactSyncDetector(SyncDetector):
         super().__init__(sync, samps_per_sym, msb_first)
         self.deduplicate = deduplicate
         sync_bits = numpy.unpackbits(numpy.frombuffer(sync, numpy.uint8), bitorder=self.bit_order)
-        self.sync_seqs = [numpy.packbits(sync_bits[8-i:self.sync_len-i], bitorder=self.bit_order).tobytes() for i in range(8)]
+        # Escaped, as the byte sequences are searched for as regular expressions
+        self.sync_seqs = [escape(numpy.packbits(sync_bits[8-i:self.sync_len-i], bitorder=self.bit_order).tobytes()) for i in range(8)]
 
     def feed(self, samples_demod):
         indices = []
@@ -231,6 +455,165 @@ class ExactSyncDetector(SyncDetector):
         else:
             return indices
 
+# Table lookup approach, finds any of several access addresses in one pass
+# At any bit offset, a 32-bit AA fully covers two consecutive bytes of the packed symbols.
+# Those 16-bit values are looked up in a table of all AA/offset combinations to find
+# candidates, and then full 32-bit windows at candidate positions are checked.
+class MultiSyncDetector(SyncDetector):
+    def __init__(self, aas, samps_per_sym=2, deduplicate=True):
+        super().__init__(b'\x00' * 4, samps_per_sym)
+        self.deduplicate = deduplicate
+        self.aas = numpy.unique(numpy.array(list(aas), numpy.uint32))
+        self.table = numpy.zeros(0x10000, bool)
+        for aa in self.aas:
+            for j in range(8):
+                self.table[(int(aa) >> (8 - j)) & 0xFFFF] = True
+
+    def feed(self, samples_demod):
+        return self.feed_multi(samples_demod)[0]
+
+    # Returns (sync indices, matching access addresses) as arrays sorted by index
+    def feed_multi(self, samples_demod):
+        all_indices = [numpy.zeros(0, numpy.int64)]
+        all_aas = [numpy.zeros(0, numpy.uint32)]
+
+        for i in range(self.samps_per_sym):
+            syms = samples_demod[i::self.samps_per_sym]
+            nbits = len(syms)
+            if nbits < 32 or len(self.aas) == 0:
+                continue
+            packed = numpy.packbits(syms, bitorder='little')
+
+            # candidate AA start bytes: AA spans bytes m to m+4, with m+1 and m+2 fully covered
+            pairs = packed[:-1].astype(numpy.uint16)
+            pairs |= packed[1:].astype(numpy.uint16) << 8
+            cand = numpy.flatnonzero(self.table[pairs]) - 1
+            cand = cand[cand >= 0]
+            if len(cand) == 0:
+                continue
+
+            padded = numpy.zeros(len(packed) + 4, numpy.uint8)
+            padded[:len(packed)] = packed
+            words40 = numpy.zeros(len(cand), numpy.uint64)
+            for k in range(5):
+                words40 |= padded[cand + k].astype(numpy.uint64) << numpy.uint64(8 * k)
+
+            for j in range(8):
+                words = ((words40 >> numpy.uint64(j)) & numpy.uint64(0xFFFFFFFF)).astype(numpy.uint32)
+                pos = numpy.minimum(numpy.searchsorted(self.aas, words), len(self.aas) - 1)
+                bit_idx = cand * 8 + j
+                hits = (self.aas[pos] == words) & (bit_idx + 32 <= nbits)
+                all_indices.append(bit_idx[hits] * self.samps_per_sym + i)
+                all_aas.append(words[hits])
+
+        indices = numpy.concatenate(all_indices)
+        aas = numpy.concatenate(all_aas)
+        order = numpy.argsort(indices, kind='stable')
+        indices = indices[order]
+        aas = aas[order]
+
+        if self.deduplicate and len(indices):
+            # same AA found at adjacent sampling phases counts once
+            keep = numpy.ones(len(indices), bool)
+            last_index = {}
+            for k in range(len(indices)):
+                aa = int(aas[k])
+                if indices[k] - last_index.get(aa, -2 * self.samps_per_sym) < self.samps_per_sym:
+                    keep[k] = False
+                else:
+                    last_index[aa] = indices[k]
+            indices = indices[keep]
+            aas = aas[keep]
+
+        return indices, aas
+
+_popcount8_lut = numpy.array([bin(i).count('1') for i in range(256)], numpy.uint8)
+
+def popcount64(x):
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(x)
+    return _popcount8_lut[x.view(numpy.uint8)].reshape(x.shape + (8,)).sum(axis=-1, dtype=numpy.uint8)
+
+# Bit-parallel sliding window approach, allows inexact matching
+# Builds a word from the symbols at every bit offset and accepts windows within
+# max_errors bit errors (Hamming distance) of any of the sync words, up to 56 bits each.
+# Accepts either a single sync word or a list of sync words (ex. preamble + AA for each AA).
+class HammingSyncDetector(SyncDetector):
+    def __init__(self, syncs, samps_per_sym=2, msb_first=False, max_errors=2):
+        if isinstance(syncs, (bytes, bytearray)):
+            syncs = [syncs]
+        if len(set(len(sync) for sync in syncs)) != 1:
+            raise ValueError("Sync words must all be the same length")
+        super().__init__(syncs[0], samps_per_sym, msb_first)
+        if self.sync_len > 56:
+            raise ValueError("Sync words longer than 56 bits unsupported")
+        self.max_errors = max_errors
+        self.sync_bytes = len(syncs[0])
+
+        # LSB first words, matching the order symbols are packed into sliding windows
+        self.syncs = numpy.array([int.from_bytes(numpy.packbits(numpy.unpackbits(numpy.frombuffer(
+            sync, numpy.uint8), bitorder=self.bit_order), bitorder='little').tobytes(), 'little')
+            for sync in syncs], numpy.uint64)
+        self.mask = numpy.uint64((1 << self.sync_len) - 1)
+
+    def feed(self, samples_demod):
+        return self.feed_multi(samples_demod)[0]
+
+    # Returns (sync indices, matching sync words as LSB first integers, bit errors) sorted by index
+    def feed_multi(self, samples_demod):
+        all_indices = [numpy.zeros(0, numpy.int64)]
+        all_ids = [numpy.zeros(0, numpy.intp)]
+        all_errs = [numpy.zeros(0, numpy.uint8)]
+
+        for i in range(self.samps_per_sym):
+            syms = samples_demod[i::self.samps_per_sym]
+            nbits = len(syms)
+            if nbits < self.sync_len:
+                continue
+            packed = numpy.packbits(syms, bitorder='little')
+
+            # words starting at every byte, long enough for windows at all 8 bit offsets
+            nwords = len(packed)
+            padded = numpy.zeros(nwords + self.sync_bytes, numpy.uint8)
+            padded[:nwords] = packed
+            words = numpy.zeros(nwords, numpy.uint64)
+            for k in range(self.sync_bytes + 1):
+                words |= padded[k:nwords + k].astype(numpy.uint64) << numpy.uint64(8 * k)
+
+            byte_idx = numpy.arange(nwords, dtype=numpy.int64) * 8
+            for j in range(8):
+                window = (words >> numpy.uint64(j)) & self.mask
+                valid = byte_idx + (j + self.sync_len) <= nbits
+                for s, sync in enumerate(self.syncs):
+                    errs = popcount64(window ^ sync)
+                    hits = numpy.flatnonzero((errs <= self.max_errors) & valid)
+                    all_indices.append((byte_idx[hits] + j) * self.samps_per_sym + i)
+                    all_ids.append(numpy.full(len(hits), s, numpy.intp))
+                    all_errs.append(errs[hits].astype(numpy.uint8))
+
+        indices = numpy.concatenate(all_indices)
+        ids = numpy.concatenate(all_ids)
+        errs = numpy.concatenate(all_errs)
+        order = numpy.argsort(indices, kind='stable')
+        indices, ids, errs = indices[order], ids[order], errs[order]
+
+        # Inexact matches cluster around the true position, keep the best of each cluster
+        keep = numpy.zeros(len(indices), bool)
+        best = {}
+        for k in range(len(indices)):
+            s = ids[k]
+            if s in best and indices[k] - indices[best[s][-1]] <= 2 * self.samps_per_sym:
+                best[s].append(k)
+            else:
+                if s in best:
+                    cluster = best[s]
+                    keep[cluster[numpy.argmin(errs[cluster])]] = True
+                best[s] = [k]
+        for cluster in best.values():
+            keep[cluster[numpy.argmin(errs[cluster])]] = True
+
+        return indices[keep], self.syncs[ids[keep]], errs[keep]
+
 # Correlator based approach, slower, allows inexact matching
 class CorrelatorSyncDetector(SyncDetector):
     def __init__(self, sync: bytes, samps_per_sym=2, msb_first=False, corr_thresh=2):
@@ -279,3 +662,42 @@ def resample(samples, fs_orig, fs_targ):
     new_len = int((duration * fs_targ) + 0.5)
     fs_new = new_len / duration
     return fs_new, scipy.signal.resample(samples, new_len)
+
+# Compare fm_demod2 (plus slicing) against FMDemodulator, returning MSPS and
+# bytes allocated per call for each approach
+def benchmark_fm_demod(chunk_size=65536, chunks=64):
+    import time, tracemalloc
+    rng = numpy.random.default_rng(0)
+    samples = (rng.standard_normal(chunk_size) + 1j * rng.standard_normal(chunk_size)).astype(numpy.complex64)
+    demodulator = FMDemodulator(chunk_size)
+    prev = numpy.complex64(0)
+    approaches = {
+        'fm_demod2': lambda: fm_demod2(samples, prev),
+        'fm_demod2_bits': lambda: fm_demod2(samples, prev) > 0,
+        'FMDemodulator': lambda: demodulator.feed(samples),
+        'FMDemodulator_bits': lambda: demodulator.feed_bits(samples),
+    }
+    results = {}
+    for name, func in approaches.items():
+        with numpy.errstate(invalid='ignore'):
+            func() # warm up
+            tracemalloc.start()
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            t0 = time.perf_counter()
+            for i in range(chunks):
+                func()
+            elapsed = time.perf_counter() - t0
+        results[name] = (chunk_size * chunks / elapsed / 1e6, peak)
+    return results
+
+def print_fm_demod_benchmark(chunk_size=65536):
+    results = benchmark_fm_demod(chunk_size)
+    print("%-20s %10s %14s" % ("Demodulator", "MSPS", "Alloc/chunk"))
+    for name, (msps, peak) in results.items():
+        print("%-20s %10.1f %13.1fx" % (name, msps, peak / (chunk_size * 8)))
+    print("(allocation relative to input chunk size in bytes)")
+
+if __name__ == "__main__":
+    print_fm_demod_benchmark()
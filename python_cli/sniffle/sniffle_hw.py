@@ -92,12 +92,17 @@ def make_sniffle_hw(serport=None, logger=None, timeout=None, baudrate=None):
             mode = 'single'
         return SniffleSoapySDR(driver, mode, logger=logger)
     elif serport.startswith('file:'):
-        from .sniffle_sdr import SniffleFileSDR
-        fname = serport[5:]
-        return SniffleFileSDR(fname, logger=logger)
+        from .sniffle_sdr import SniffleFileSDR, parse_file_spec
+        fname, kwargs = parse_file_spec(serport[5:])
+        return SniffleFileSDR(fname, logger=logger, **kwargs)
     else:
         return SniffleHW(serport, logger, timeout, baudrate)
 
+# SDR sources (rfnm[:mode] and file:<path>) timestamp packets to the nanosecond,
+# so their captures are saved as nanosecond resolution PCAP
+def is_sdr_serport(serport):
+    return serport is not None and serport.startswith(('rfnm', 'file:'))
+
 class SniffleHW:
     max_interval_preload_pairs = 4
     api_level = 0
@@ -4,27 +4,34 @@
 
 from struct import pack, unpack
 from binascii import Error as BAError
-from time import time
-from queue import Queue
-from threading import Thread, Semaphore
-from concurrent.futures import ThreadPoolExecutor
+from time import time_ns, perf_counter
+from queue import Queue, Empty
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from os import cpu_count
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
 
-from SoapySDR import SOAPY_SDR_RX, SOAPY_SDR_CF32
-from SoapySDR import Device as SoapyDevice
-from numpy import zeros, complex64, frombuffer, reshape
+import numpy
+from numpy import zeros, complex64, reshape
 
 from .constants import BLE_ADV_AA, BLE_ADV_CRCI, SnifferMode, PhyMode
 from .decoder_state import SniffleDecoderState
-from .packet_decoder import PacketMessage, DPacketMessage, AdvertMessage, DataMessage
+from .packet_decoder import (PacketMessage, DPacketMessage, AdvertMessage, DataMessage,
+                             ConnectIndMessage, ScanReqMessage, str_mac)
 from .errors import SniffleHWPacketError, UsageError
 from .sniffle_hw import TrivialLogger
-from .sdr_utils import decimate, unpack_syms, calc_rssi, resample, fm_demod2, ExactSyncDetector
-from .whitening_ble import le_dewhiten
-from .crc_ble import rbit24, crc_ble_reverse
+from .sdr_utils import decimate, calc_rssi, resample, FMDemodulator, EnergyGate, \
+        MultiSyncDetector, HammingSyncDetector, CorrelatorSyncDetector, CFOTracker, \
+        estimate_cfo_known, recover_timing
+from .whitening_ble import le_dewhiten, le_dewhiten_batch
+from .coding_ble import fec_ble_decode_soft, pattern_unmap_p4_soft, pack_bits, coded_sync_word, \
+        CODED_PREAMBLE
+from .crc_ble import rbit24, crc_ble_reverse, crc_ble_check_batch
 from .pcap import rf_to_ble_chan, ble_to_rf_chan
-from .channelizer import PolyphaseChannelizer
+from .channelizer import PolyphaseChannelizer, FastConvChannelizer
 from .resampler import PolyphaseResampler
+from .iq_file import IQFileSource
 from .errors import SourceDone
 
 def freq_from_chan(chan):
@@ -35,89 +42,1075 @@ def chan_from_freq(freq):
     rf = (freq - 2402e6) / 2e6
     return rf_to_ble_chan(int(rf))
 
+# Duration of num_samples at sample rate fs, in integer nanoseconds (rounded)
+# Uses Python integers, so there is no overflow or float rounding for long captures
+def samples_to_ns(num_samples, fs):
+    fs = int(round(fs))
+    return (int(num_samples) * 2_000_000_000 + fs) // (2 * fs)
+
+# ts_ns is the UNIX epoch time of the access address, in integer nanoseconds
+# cfo is the carrier frequency offset estimated from the preamble (and AA) in Hz, if known
 class _SDRPacket:
-    def __init__(self, ts, rssi, chan, phy, body, crc_rev, crc_err):
-        self.ts = ts
+    def __init__(self, ts_ns, rssi, chan, phy, body, crc_rev, crc_err, aa=BLE_ADV_AA, cfo=None):
+        self.ts_ns = ts_ns
         self.rssi = rssi
         self.chan = chan
         self.phy = phy
         self.body = body
         self.crc_rev = crc_rev
         self.crc_err = crc_err
+        self.aa = aa
+        self.cfo = cfo
+
+    # Compact tuple form for passing between processes
+    def to_record(self):
+        return (self.ts_ns, self.rssi, self.chan, int(self.phy), self.body, self.crc_rev, self.crc_err,
+                self.aa, self.cfo)
 
     def to_packet_message(self, decoder_state):
-        # TODO/HACK: handle timestamps properly, don't do this
-        ts32 = int(self.ts * 1e6) & 0x3FFFFFFF
-        return PacketMessage.from_fields(ts32, len(self.body), 0, self.rssi, self.chan, self.phy, self.body,
-                                         self.crc_rev, self.crc_err, decoder_state, False)
+        # The 32-bit radio timestamp field is unused, the full timestamp is passed as ts_ns
+        pkt = PacketMessage.from_fields(0, len(self.body), 0, self.rssi, self.chan, self.phy, self.body,
+                                        self.crc_rev, self.crc_err, decoder_state, False, self.ts_ns)
+        # Wideband capture may receive several connections at once, so don't rely on decoder state
+        pkt.aa = self.aa
+        return pkt
+
+# LE Coded PHY packet structure, in symbols (microseconds)
+CODED_PREAMBLE_SYMS = 80
+CODED_BLOCK1_SYMS = 296 # 37 bits (AA, CI, TERM1), S=8
+CODED_SYNC_SYMS = CODED_PREAMBLE_SYMS + 256 # through end of FEC encoded AA
+CODED_BLOCK2_START = CODED_PREAMBLE_SYMS + CODED_BLOCK1_SYMS
+CODED_MAX_PKT_SYMS = CODED_BLOCK2_START + (260 * 8 + 3) * 8 # 260 byte PDU + CRC, TERM2, S=8
+CODED_PREAMBLE_BITS = numpy.unpackbits(numpy.frombuffer(CODED_PREAMBLE, numpy.uint8),
+                                     bitorder='little').astype(bool) # in transmit order
+
+# Largest carrier frequency offset compensated (BLE allows +/- 150 kHz), and smallest
+# burst offset worth slicing against (burst estimates vary by a few kHz), in Hz
+MAX_CFO = 200e3
+MIN_CFO = 10e3
 
 class ChannelProcessor:
-    def __init__(self, chan, fs, coded_phy=False, gain=0):
+    def __init__(self, chan, fs, coded_phy=False, gain=0, phy=PhyMode.PHY_1M):
+        sym_rate = 2e6 if phy == PhyMode.PHY_2M else 1e6
+
+        # Demodulation needs at least 2 samples per symbol, so 2M PHY on a critically
+        # sampled 2 MSPS channel gets interpolated to 4 MSPS
+        if fs < 2 * sym_rate:
+            self.interp = PolyphaseResampler(2, 1, order=16)
+            self.interp_buf = numpy.zeros(0, complex64)
+            fs *= 2
+            self.interp_delay = samples_to_ns(len(self.interp.filt_coeffs) - 1, 2 * fs)
+        else:
+            self.interp = None
+            self.interp_delay = 0 # nanoseconds
+
         self.chan = chan
         self.fs = fs
-        self.samps_per_sym = int(fs / 1e6)
+        self.samps_per_sym = int(fs / sym_rate)
         self.sample_counter = 0
-        self.sync_detector = ExactSyncDetector(b'\xd6\xbe\x89\x8e', samps_per_sym=self.samps_per_sym)
         self.gain = gain
-        self.t_start = 0
-        self.phy = PhyMode.PHY_1M
+        self.t_start = 0 # UNIX epoch nanoseconds of sample 0
+        self.phy = phy
+        self.validate_crc = True
 
+        # Access addresses to receive: maps AA to reversed CRC init
+        # All of them are searched for in a single pass by one sync detector
+        # With sync_max_errors, preamble + AA are matched allowing that many bit errors
+        self.targets = {}
+        self.sync_detector = None
+        self.sync_max_errors = 0
+        self.sync_lead = 0 # symbols before AA included in sync word, in samples
+
+        # With coded_phy, LE Coded PHY packets are received alongside 1M packets
+        # Each AA has a correlator for the coded preamble and FEC encoded AA
+        self.coded_phy = coded_phy and phy == PhyMode.PHY_1M
+        self.coded_detectors = {}
+        self.set_aa_crci()
+
+        # State carried across calls to feed()
+        # Demodulated bits (and soft values with coded_phy) are written straight after the
+        # carried tail in persistent work buffers, with the tail moved to the front after
+        self.overlap_len = 0
+        self._set_overlap_len()
+        self.demodulator = FMDemodulator()
+
+        # Carrier frequency offset compensation: with energy gated input, bits are sliced
+        # against the offset estimated over each burst, and packets failing their CRC are
+        # sliced again with an offset estimated from their preamble and access address
+        # The burst estimate mixes transmitters whose bursts overlap, so bits are also sliced
+        # at zero, and syncs and packets found that way are kept too. Compensation then
+        # can't lose packets that are received without it.
+        self.cfo_comp = True
+        self.cfo_offset = 0. # radians per sample
+        self.sliced_end = 0 # absolute sample index after the last bit sliced against an offset
+        self.cfo_acc = 0j # sum of phase change products over the current burst
+        self.in_burst = False # the last span of the previous chunk ran to its end
+        self.max_cfo = 2 * numpy.pi * MAX_CFO / fs
+        self.min_cfo = 2 * numpy.pi * MIN_CFO / fs
+        self.sym_dev = numpy.pi / (2 * self.samps_per_sym) # modulation index 0.5
+
+        # Packets still failing their CRC are retried with symbol timing recovered over
+        # the packet, rather than sampled at fixed intervals from the sync
+        self.timing_recovery = True
+
+        self.work_demod = numpy.zeros(0, bool)
+        self.work_plain = numpy.zeros(0, bool) # bits sliced at zero, with cfo_comp
+        self.work_soft = numpy.zeros(0, numpy.float32) # not offset compensated
+        self.tail_len = 0
+        self.tail_samples = numpy.zeros(0, complex64)
+        self.buf_start = 0 # absolute sample index of start of tail
+        self.held_samples = numpy.zeros(0, complex64) # idle samples kept back by feed_spans
+
+    # t_start is the UNIX epoch time of the first sample, in integer nanoseconds
     def set_t_start(self, t_start):
-        self.t_start = t_start
+        self.t_start = t_start - self.interp_delay
 
+    # Receive only the specified access address
     def set_aa_crci(self, aa=0x8E89BED6, crci=BLE_ADV_CRCI):
-        self.sync_detector = ExactSyncDetector(pack('<I', aa), samps_per_sym=self.samps_per_sym)
+        self.aa = aa
         self.crci_rev = rbit24(crci)
+        self.targets = {}
+        self.add_aa(aa, crci)
+
+    # Additionally receive the specified access address
+    def add_aa(self, aa, crci):
+        self.targets[aa] = rbit24(crci)
+        self._make_sync_detector()
+
+    def remove_aa(self, aa):
+        if aa != self.aa and aa in self.targets:
+            del self.targets[aa]
+            self._make_sync_detector()
+
+    # Tolerate up to max_errors bit errors in the preamble and access address
+    # Zero requires exact access address matches
+    def set_sync_errors(self, max_errors=0):
+        self.sync_max_errors = max_errors
+        self._make_sync_detector()
+
+    # Additionally receive LE Coded PHY packets (S=2 and S=8)
+    # Coded PHY shares the 1M symbol rate, so 2M processors ignore this
+    def set_coded_phy(self, coded_phy=True):
+        coded_phy = coded_phy and self.phy == PhyMode.PHY_1M
+        if coded_phy and not self.coded_phy:
+            # No soft values were kept for the carried tail, treat them as erasures
+            self.work_soft = numpy.zeros(len(self.work_demod), numpy.float32)
+        self.coded_phy = coded_phy
+        self._make_sync_detector()
+        self._set_overlap_len()
+
+    # Packets up to this many samples long after their sync must be fully buffered
+    def _set_overlap_len(self):
+        MAX_PKT = 264 # 4 byte AA, 2 byte header, 255 byte body, 3 byte CRC
+        if self.coded_phy:
+            self.overlap_len = CODED_MAX_PKT_SYMS * self.samps_per_sym
+        else:
+            self.overlap_len = MAX_PKT * 8 * self.samps_per_sym
+
+    def _make_sync_detector(self):
+        if self.coded_phy:
+            # Allow 25% of symbols in error, Viterbi decoding then recovers and checks the AA
+            self.coded_detectors = {aa: CorrelatorSyncDetector(coded_sync_word(aa), self.samps_per_sym,
+                                                               corr_thresh=CODED_SYNC_SYMS // 2)
+                                    for aa in self.targets}
+        else:
+            self.coded_detectors = {}
+
+        if self.sync_max_errors:
+            # Preamble alternates, ending opposite to the first AA bit (LSB)
+            syncs = [(b'\x55' if aa & 1 else b'\xAA') + pack('<I', aa) for aa in self.targets]
+            self.sync_detector = HammingSyncDetector(syncs, samps_per_sym=self.samps_per_sym,
+                                                     max_errors=self.sync_max_errors)
+            self.sync_lead = 8 * self.samps_per_sym
+        else:
+            self.sync_detector = MultiSyncDetector(self.targets.keys(), samps_per_sym=self.samps_per_sym)
+            self.sync_lead = 0
+
+    # Connections only use data channels, so ignore them on primary advertising channels
+    def add_conn_aa(self, aa, crci):
+        if self.chan < 37:
+            self.add_aa(aa, crci)
+
+    def set_validate_crc(self, validate=True):
+        self.validate_crc = validate
+
+    def set_cfo_comp(self, cfo_comp=True):
+        if cfo_comp and not self.cfo_comp:
+            # Without compensation, the carried tail was sliced at zero
+            self.work_plain = self.work_demod.copy()
+        self.cfo_comp = cfo_comp
+        self.cfo_offset = 0.
+
+    def set_timing_recovery(self, timing_recovery=True):
+        self.timing_recovery = timing_recovery
 
     # To continuously feed samples
-    # TODO: handle frames and sync words crossing chunk boundaries
+    # The last overlap_len samples of each chunk are carried over to the next call, so that
+    # sync words and packets straddling chunk boundaries are still received. Packets whose
+    # sync word falls within the carried tail are deferred until the next call.
     def feed(self, samples, start_sample=None):
-        samples_demod = fm_demod2(samples) > 0
-        syncs = self.sync_detector.feed(samples_demod)
-        pkts_raw = self.ble_pkt_extract(samples_demod, syncs, self.chan, self.samps_per_sym)
+        if len(self.held_samples):
+            samples = numpy.concatenate([self.held_samples, samples])
+            self.held_samples = self.held_samples[:0]
+        if self.interp:
+            n = self.interp.output_len(len(samples))
+            if len(self.interp_buf) < n:
+                self.interp_buf = numpy.empty(n, complex64)
+            samples = self.interp.feed(samples, self.interp_buf)
+        tail_len = self.tail_len
+        total = tail_len + len(samples)
+        self._ensure_work(total)
+
+        # Soft demodulated values are only needed for coded PHY decoding
+        buf_demod = self.work_demod[:total]
+        buf_plain = self.work_plain[:total] if self.cfo_comp else None
+        if self.coded_phy:
+            buf_soft = self.work_soft[:total]
+            self.demodulator.feed(samples, out=buf_soft[tail_len:])
+            numpy.greater(buf_soft[tail_len:], numpy.float32(numpy.sin(self.cfo_offset)),
+                          out=buf_demod[tail_len:])
+            if buf_plain is not None:
+                numpy.greater(buf_soft[tail_len:], 0, out=buf_plain[tail_len:])
+        elif self.cfo_offset:
+            buf_soft = None
+            self.demodulator.feed_bits(samples, out=buf_demod[tail_len:], offset=self.cfo_offset,
+                                       plain_out=buf_plain[tail_len:])
+        else:
+            buf_soft = None
+            self.demodulator.feed_bits(samples, out=buf_demod[tail_len:])
+            if buf_plain is not None:
+                buf_plain[tail_len:] = buf_demod[tail_len:]
+        if self.cfo_offset:
+            self.sliced_end = self.buf_start + total
+
+        # Only handle syncs with room for a maximum length packet after them
+        # Negative sync indices were already seen in the previous chunk's tail
+        # The tail also carries the preamble (sync_lead) of syncs at its start
+        sync_min = self.sync_lead if self.buf_start else -32 * self.samps_per_sym
+        sync_max = len(buf_demod) - self.overlap_len
+        pkts = self._process_syncs(buf_demod, self._plain_bits(buf_plain), buf_soft,
+                                   self.tail_samples, samples, sync_min, sync_max)
+
+        # Carry forward the tail of this chunk
+        keep = min(total, self.overlap_len + self.sync_lead)
+        self.work_demod[:keep] = buf_demod[total - keep:]
+        if buf_plain is not None:
+            self.work_plain[:keep] = buf_plain[total - keep:]
+        if buf_soft is not None:
+            self.work_soft[:keep] = buf_soft[total - keep:]
+        self.tail_len = keep
+        if keep > len(samples):
+            self.tail_samples = numpy.concatenate([self.tail_samples[len(self.tail_samples) -
+                                                                     (keep - len(samples)):], samples])
+        else:
+            self.tail_samples = samples[len(samples) - keep:].copy()
+        self.buf_start += total - keep
+        self.sample_counter += len(samples)
+        return pkts
+
+    def _ensure_work(self, n):
+        if len(self.work_demod) < n:
+            work_demod = numpy.empty(n, bool)
+            work_demod[:self.tail_len] = self.work_demod[:self.tail_len]
+            self.work_demod = work_demod
+        if self.cfo_comp and len(self.work_plain) < n:
+            work_plain = numpy.empty(n, bool)
+            work_plain[:self.tail_len] = self.work_plain[:self.tail_len]
+            self.work_plain = work_plain
+        if self.coded_phy and len(self.work_soft) < n:
+            work_soft = numpy.empty(n, numpy.float32)
+            work_soft[:self.tail_len] = self.work_soft[:self.tail_len]
+            self.work_soft = work_soft
+
+    # Process any packets still pending in the carried tail (ex. at end of input)
+    def flush(self):
+        tail_len = self.tail_len
+        pkts = self._process_syncs(self.work_demod[:tail_len],
+                                   self._plain_bits(self.work_plain[:tail_len] if self.cfo_comp else None),
+                                   self.work_soft[:tail_len] if self.coded_phy else None,
+                                   self.tail_samples, self.tail_samples[:0],
+                                   self.sync_lead if self.buf_start else -32 * self.samps_per_sym,
+                                   tail_len)
+        self.buf_start += tail_len
+        self.tail_len = 0
+        self.tail_samples = self.tail_samples[:0]
+        return pkts
+
+    # Bits sliced at zero, or None where they match those sliced against the offset, as they
+    # do once the last bits sliced against an offset have left the buffer
+    def _plain_bits(self, buf_plain):
+        return buf_plain if self.sliced_end > self.buf_start else None
+
+    # To feed only the (start, stop) spans of samples that may hold bursts, from an EnergyGate
+    # Samples between spans are skipped, except for the last hold samples of the chunk,
+    # which are kept back in case a span in the next chunk starts before it.
+    def feed_spans(self, samples, spans, hold=0):
+        held = self.held_samples
+        self.held_samples = held[:0]
+        pkts = []
+        pos = -len(held)
+        for start, stop in spans:
+            start = max(start, pos)
+            if start > pos:
+                pkts.extend(self.skip(start - pos))
+            if start < 0:
+                span = numpy.concatenate([held[len(held) + start:], samples[:stop]])
+            else:
+                span = samples[start:stop]
+            if self.cfo_comp:
+                self._update_cfo(span, start <= 0 and self.in_burst)
+            pkts.extend(self.feed(span))
+            pos = stop
+
+        keep_from = max(pos, len(samples) - hold, 0)
+        if keep_from > pos:
+            pkts.extend(self.skip(keep_from - pos))
+        self.held_samples = samples[keep_from:].copy()
+        self.in_burst = len(spans) > 0 and pos >= len(samples)
+        return pkts
+
+    # Carrier frequency offset of a burst, from the power weighted mean phase change per
+    # sample, in which balanced FSK symbols cancel out. A span continuing the previous
+    # chunk's last span adds to its estimate.
+    def _update_cfo(self, span, continued):
+        acc = numpy.vdot(span[:-1], span[1:]) if len(span) > 1 else 0j
+        self.cfo_acc = self.cfo_acc + acc if continued else acc
+        offset = numpy.angle(self.cfo_acc)
+        if self.interp:
+            offset /= self.interp.up
+        if abs(offset) < self.min_cfo:
+            offset = 0.
+        self.cfo_offset = min(max(float(offset), -self.max_cfo), self.max_cfo)
+
+    # Skip over a gap of num_samples lost samples, flushing anything pending
+    def skip(self, num_samples):
+        num_samples += len(self.held_samples)
+        self.held_samples = self.held_samples[:0]
+        pkts = self.flush() if self.tail_len else []
+        if self.interp:
+            num_samples *= self.interp.up
+            self.interp.reset()
+        self.buf_start += num_samples
+        self.sample_counter += num_samples
+        self.demodulator.reset()
+        self.in_burst = False
+        return pkts
+
+    # Sync indices from sync_min to sync_max in buf_demod, and their access addresses
+    # Only the window where those sync words (with preamble, if matched) lie is searched
+    def _find_syncs(self, buf_demod, sync_min, sync_max):
+        win_start = max(sync_min - self.sync_lead, 0)
+        win_end = min(sync_max + 32 * self.samps_per_sym, len(buf_demod))
+        if self.sync_max_errors:
+            syncs, sync_words, _ = self.sync_detector.feed_multi(buf_demod[win_start:win_end])
+            syncs = syncs + (win_start + self.sync_lead)
+            sync_aas = sync_words >> numpy.uint64(8)
+        else:
+            syncs, sync_aas = self.sync_detector.feed_multi(buf_demod[win_start:win_end])
+            syncs = syncs + win_start
+        in_range = (syncs >= sync_min) & (syncs < sync_max)
+        return syncs[in_range], sync_aas[in_range]
+
+    # buf_plain holds the bits sliced at zero, if they differ from buf_demod
+    def _process_syncs(self, buf_demod, buf_plain, buf_soft, tail_samples, samples, sync_min, sync_max):
+        syncs, sync_aas = self._find_syncs(buf_demod, sync_min, sync_max)
+        if buf_plain is not None:
+            plain_syncs, plain_aas = self._find_syncs(buf_plain, sync_min, sync_max)
+
         pkts = []
-        for i, p in enumerate(pkts_raw):
-            pkt_duration = (len(p) + 4) * 8 * 2 # 2 SPS, pkt doesn't include sync word
+        for aa, crci_rev in self.targets.items():
+            aa_syncs = syncs[sync_aas == aa]
+            aa_plain = plain_syncs[plain_aas == aa] if buf_plain is not None else None
+            if len(aa_syncs) or (aa_plain is not None and len(aa_plain)):
+                pkts.extend(self._process_aa_syncs(aa, crci_rev, buf_demod, aa_syncs, tail_samples,
+                                                   samples, buf_plain, aa_plain))
+
+        # Coded sync indices are at the start of the preamble
+        # Only correlate over the window where new syncs may start
+        win_start = max(sync_min, 0)
+        win_end = min(sync_max + CODED_SYNC_SYMS * self.samps_per_sym, len(buf_demod))
+        if win_end - win_start < CODED_SYNC_SYMS * self.samps_per_sym:
+            return pkts
+        for aa, detector in self.coded_detectors.items():
+            coded_syncs = detector.feed(buf_demod[win_start:win_end])
+            if buf_plain is not None:
+                # The same preamble found in both is decoded once
+                coded_syncs = numpy.union1d(coded_syncs, detector.feed(buf_plain[win_start:win_end]))
+                dup = numpy.diff(coded_syncs, prepend=-CODED_SYNC_SYMS * self.samps_per_sym) < \
+                        CODED_SYNC_SYMS * self.samps_per_sym
+                coded_syncs = coded_syncs[~dup]
+            coded_syncs = coded_syncs + win_start
+            coded_syncs = coded_syncs[coded_syncs < sync_max]
+            if len(coded_syncs):
+                pkts.extend(self._process_coded_syncs(aa, self.targets[aa], buf_soft, coded_syncs,
+                                                      tail_samples, samples))
+        return pkts
+
+    # Samples spanning buffer indices s0 to s1, accounting for the carried tail
+    @staticmethod
+    def _buf_samples(s0, s1, tail_samples, samples):
+        tail_len = len(tail_samples)
+        if s0 >= tail_len:
+            return samples[s0 - tail_len:s1 - tail_len]
+        elif s1 <= tail_len:
+            return tail_samples[s0:s1]
+        else:
+            return numpy.concatenate([tail_samples[s0:], samples[:s1 - tail_len]])
+
+    # Average power of packet spanning buffer indices s0 to s1
+    def _pkt_rssi(self, s0, s1, tail_samples, samples):
+        return int(calc_rssi(self._buf_samples(s0, s1, tail_samples, samples)) - self.gain)
+
+    # Carrier frequency offset (radians per sample) and coherence from the known symbols
+    # syms starting at buffer index start, or (None, 0) if they aren't all buffered
+    def _known_cfo(self, start, syms, tail_samples, samples):
+        sps = self.samps_per_sym
+        if start < 1:
+            return None, 0.
+        x = self._buf_samples(start - 1, start + len(syms) * sps, tail_samples, samples)
+        if len(x) < len(syms) * sps + 1:
+            return None, 0.
+        idx = numpy.arange(len(syms)) * sps + 1
+        return estimate_cfo_known(x[idx] * numpy.conj(x[idx - 1]), syms, self.sym_dev)
+
+    # Preamble (ending opposite to the first AA bit) and access address symbols
+    @staticmethod
+    def _sync_syms(aa):
+        sync = (b'\x55' if aa & 1 else b'\xAA') + pack('<I', aa)
+        return numpy.unpackbits(numpy.frombuffer(sync, numpy.uint8), bitorder='little').astype(bool)
+
+    # Demodulated bits of a packet with its sync at buffer index sync, sliced against offset
+    # Returned bits start at the sync
+    def _reslice(self, sync, offset, tail_samples, samples):
+        MAX_PKT = 264
+        end = min(sync + 8 * MAX_PKT * self.samps_per_sym, len(tail_samples) + len(samples))
+        x = self._buf_samples(sync - 1, end, tail_samples, samples)
+        prod = x[1:] * numpy.conj(x[:-1])
+        return (prod * numpy.complex64(numpy.exp(-1j * offset))).imag > 0
+
+    # Like _reslice, but with the sampling instant of each symbol recovered from the
+    # signal rather than fixed relative to the sync, returning one bit per symbol
+    def _retime(self, sync, offset, tail_samples, samples):
+        MAX_PKT = 264
+        sps = self.samps_per_sym
+        if sync <= sps:
+            return self._reslice(sync, offset, tail_samples, samples)[::sps]
+        end = min(sync + 8 * MAX_PKT * sps, len(tail_samples) + len(samples))
+        x = self._buf_samples(sync - sps - 1, end, tail_samples, samples)
+        prod = x[1:] * numpy.conj(x[:-1])
+        soft = numpy.angle(prod * numpy.complex64(numpy.exp(-1j * offset)))
+        # Integrating phase change over a whole symbol averages out noise, and delays
+        # the soft values by (sps - 1) / 2 samples
+        soft = numpy.convolve(soft, numpy.ones(sps, soft.dtype))[:len(soft)]
+        return recover_timing(soft, sps, sps + (sps - 1) / 2) > 0
+
+    # plain_syncs are the syncs found in buf_plain, the bits sliced at zero (if given)
+    def _process_aa_syncs(self, aa, crci_rev, buf_demod, syncs, tail_samples, samples,
+                          buf_plain=None, plain_syncs=None):
+        syncs, pkts_dw, pkt_lens = self.ble_pkt_extract_batch(buf_demod, syncs, self.chan,
+                                                              self.samps_per_sym)
+
+        # Reject garbage sync hits in bulk before doing any per-packet work
+        crc_valid = crc_ble_check_batch(crci_rev, pkts_dw, pkt_lens)
+
+        # The same packet has its sync within a symbol or so in both slicings
+        near_syncs = lambda a, b: numpy.abs(a[:, None] - b[None, :]) < 8 * self.samps_per_sym
+        if plain_syncs is not None and len(plain_syncs):
+            # Bits sliced at zero are only needed for syncs found just there, and for packets
+            # failing their CRC sliced against the burst offset
+            near = near_syncs(syncs, plain_syncs)
+            needed = ~near.any(axis=0) | near[~crc_valid].any(axis=0)
+            plain_syncs, plain_dw, plain_lens = self.ble_pkt_extract_batch(buf_plain, plain_syncs[needed],
+                                                                           self.chan, self.samps_per_sym)
+        if plain_syncs is not None and len(plain_syncs):
+            plain_valid = crc_ble_check_batch(crci_rev, plain_dw, plain_lens)
+            near = near_syncs(syncs, plain_syncs)
+            pair = near.argmax(axis=1)
+
+            # Packets failing their CRC sliced against the burst offset but not at zero
+            use_plain = near.any(axis=1) & ~crc_valid
+            use_plain[use_plain] = plain_valid[pair[use_plain]]
+            syncs[use_plain] = plain_syncs[pair[use_plain]]
+            pkts_dw[use_plain] = plain_dw[pair[use_plain]]
+            pkt_lens[use_plain] = plain_lens[pair[use_plain]]
+            crc_valid |= use_plain
+
+            # Packets whose sync was only found at zero
+            only = ~near.any(axis=0)
+            syncs = numpy.concatenate([syncs, plain_syncs[only]])
+            pkts_dw = numpy.concatenate([pkts_dw, plain_dw[only]])
+            pkt_lens = numpy.concatenate([pkt_lens, plain_lens[only]])
+            crc_valid = numpy.concatenate([crc_valid, plain_valid[only]])
+
+        # Offsets from the preamble and AA, to retry CRC failures and for telemetry
+        # CRC failures are retried sliced against that offset, then with symbol timing
+        # recovered over the packet
+        cfos = [None] * len(syncs)
+        if (self.cfo_comp or self.timing_recovery) and len(syncs):
+            sync_syms = self._sync_syms(aa)
+            lead = 8 * self.samps_per_sym
+            for i in range(len(syncs)):
+                if crc_valid[i] and self.validate_crc:
+                    if self.cfo_comp:
+                        cfos[i] = True # estimated below, only for packets that are kept
+                    continue
+                # The preamble may precede the buffered samples, then only the AA is used
+                if syncs[i] > lead:
+                    offset, coherence = self._known_cfo(syncs[i] - lead, sync_syms,
+                                                        tail_samples, samples)
+                else:
+                    offset, coherence = self._known_cfo(syncs[i], sync_syms[8:],
+                                                        tail_samples, samples)
+                if self.cfo_comp:
+                    cfos[i] = offset
+                # Coherence filters out sync hits on noise, that aren't worth retrying
+                if crc_valid[i] or offset is None or coherence < 0.5:
+                    continue
+                if not self.cfo_comp:
+                    offset = 0.
+                retries = []
+                if self.cfo_comp:
+                    retries.append((self._reslice, self.samps_per_sym))
+                if self.timing_recovery:
+                    retries.append((self._retime, 1))
+                for reslice, sps in retries:
+                    bits = reslice(syncs[i], offset, tail_samples, samples)
+                    _, dw, lens = self.ble_pkt_extract_batch(bits, [0], self.chan, sps)
+                    if len(lens) and crc_ble_check_batch(crci_rev, dw, lens)[0]:
+                        pkts_dw[i] = dw[0]
+                        pkt_lens[i] = lens[0]
+                        crc_valid[i] = True
+                        break
+
+        if self.validate_crc:
+            cfos = [c for c, v in zip(cfos, crc_valid) if v]
+            syncs = syncs[crc_valid]
+            pkts_dw = pkts_dw[crc_valid]
+            pkt_lens = pkt_lens[crc_valid]
+            crc_valid = crc_valid[crc_valid]
+
+        pkts = []
+        for i in range(len(syncs)):
+            p = pkts_dw[i, :pkt_lens[i]].tobytes()
+            pkt_duration = (len(p) + 4) * 8 * self.samps_per_sym # pkt doesn't include sync word
             s0 = syncs[i] if syncs[i] >= 0 else 0
-            pkt_samples = samples[s0:syncs[i] + pkt_duration]
-            rssi = int(calc_rssi(pkt_samples) - self.gain)
-            t_sync = self.t_start + (self.sample_counter + syncs[i]) / self.fs
-            pkt = self.process_pkt(self.chan, t_sync, p, rssi)
+            rssi = self._pkt_rssi(s0, syncs[i] + pkt_duration, tail_samples, samples)
+            t_sync = self.t_start + samples_to_ns(self.buf_start + syncs[i], self.fs)
+            if cfos[i] is True:
+                cfos[i], _ = self._known_cfo(syncs[i] - 8 * self.samps_per_sym, self._sync_syms(aa),
+                                             tail_samples, samples)
+            pkt = self.process_pkt(self.chan, t_sync, p, rssi, not crc_valid[i], aa,
+                                   cfo=self._cfo_hz(cfos[i]))
             pkts.append(pkt)
-        self.sample_counter += len(samples)
+        return pkts
+
+    def _cfo_hz(self, offset):
+        return None if offset is None else offset * self.fs / (2 * numpy.pi)
+
+    # Soft symbol values for Viterbi decoding, compensated for offset (radians per sample)
+    # The FM discriminator output spikes when the signal amplitude dips, so clip it to
+    # the nominal phase change per sample (modulation index 0.5)
+    def _coded_soft(self, demod, offset=0.):
+        clip = numpy.pi / (2 * self.samps_per_sym)
+        if offset:
+            demod = demod - numpy.float32(numpy.sin(offset))
+        return numpy.clip(numpy.nan_to_num(demod), -clip, clip)
+
+    # FEC block 1 (AA, CI, TERM1) is always S=8, decode all candidates at once
+    # Returns the coding indicator of each candidate, or -1 where it doesn't decode to aa
+    def _coded_block1(self, aa, buf_soft, syncs, offset=0.):
+        sps = self.samps_per_sym
+        idx = syncs[:, None] + (CODED_PREAMBLE_SYMS + numpy.arange(CODED_BLOCK1_SYMS)) * sps
+        block1 = fec_ble_decode_soft(pattern_unmap_p4_soft(self._coded_soft(buf_soft[idx], offset)),
+                                     terminated=True)
+        aa_dec = numpy.packbits(block1[:, :32], axis=1, bitorder='little').view('<u4')[:, 0]
+        ci = (block1[:, 32] | (block1[:, 33] << 1)).astype(int)
+        return numpy.where((aa_dec == aa) & (ci <= 1), ci, -1)
+
+    # FEC block 2 (PDU, CRC, TERM2) of the packet with its preamble at sync
+    # Returns (phy, PDU with CRC, CRC error, end index), or None if it isn't all buffered
+    def _coded_block2(self, crci_rev, buf_soft, sync, ci, offset=0.):
+        sps = self.samps_per_sym
+        soft_syms = lambda start, nsyms: self._coded_soft(buf_soft[start + numpy.arange(nsyms) * sps],
+                                                          offset)
+
+        # CI 0 is S=8 (4 symbols per coded bit), CI 1 is S=2 (1 symbol per coded bit)
+        if ci == 0:
+            phy = PhyMode.PHY_CODED_S8
+            decode = lambda start, nbits: fec_ble_decode_soft(
+                    pattern_unmap_p4_soft(soft_syms(start, nbits * 8)), terminated=True)
+            syms_per_bit = 8
+        else:
+            phy = PhyMode.PHY_CODED_S2
+            decode = lambda start, nbits: fec_ble_decode_soft(soft_syms(start, nbits * 2),
+                                                               terminated=True)
+            syms_per_bit = 2
+
+        # First get the length from the header
+        # Decoding a bit past the header keeps the trellis from truncating it early
+        block2 = sync + CODED_BLOCK2_START * sps
+        hdr_bits = 16 + 24
+        if block2 + hdr_bits * syms_per_bit * sps > len(buf_soft):
+            return None
+        hdr = le_dewhiten(pack_bits(decode(block2, hdr_bits)[:16]), self.chan)
+        nbits = (hdr[1] + 5) * 8 + 3
+        pkt_end = block2 + nbits * syms_per_bit * sps
+        if pkt_end > len(buf_soft):
+            return None
+        p = le_dewhiten(pack_bits(decode(block2, nbits)[:-3]), self.chan)
+
+        crc_err = crc_ble_reverse(crci_rev, p[:-3]) != (p[-3] | (p[-2] << 8) | (p[-1] << 16))
+        return phy, p, crc_err, pkt_end
+
+    # syncs are indices of coded PHY preambles, matched against the coded form of aa
+    # Candidates are decoded without offset compensation first, and those failing to decode
+    # are retried compensated for the offset estimated from their preamble
+    def _process_coded_syncs(self, aa, crci_rev, buf_soft, syncs, tail_samples, samples):
+        sps = self.samps_per_sym
+        syncs = syncs[syncs + (CODED_BLOCK2_START - 1) * sps < len(buf_soft)]
+        if len(syncs) == 0:
+            return []
+        cis = self._coded_block1(aa, buf_soft, syncs)
+
+        pkts = []
+        for i in range(len(syncs)):
+            dec = self._coded_block2(crci_rev, buf_soft, syncs[i], cis[i]) if cis[i] >= 0 else None
+            cfo = None
+            if self.cfo_comp:
+                cfo, coherence = self._known_cfo(syncs[i], CODED_PREAMBLE_BITS, tail_samples, samples)
+                # Coherence filters out sync hits on noise, that aren't worth retrying
+                if (dec is None or dec[2]) and cfo is not None and coherence >= 0.5:
+                    ci = self._coded_block1(aa, buf_soft, syncs[i:i+1], cfo)[0]
+                    retry = self._coded_block2(crci_rev, buf_soft, syncs[i], ci, cfo) if ci >= 0 else None
+                    if retry is not None and (dec is None or not retry[2]):
+                        dec = retry
+            if dec is None:
+                continue
+            phy, p, crc_err, pkt_end = dec
+            if crc_err and self.validate_crc:
+                continue
+            rssi = self._pkt_rssi(syncs[i], pkt_end, tail_samples, samples)
+            t_sync = self.t_start + samples_to_ns(self.buf_start + syncs[i] + CODED_PREAMBLE_SYMS * sps,
+                                                  self.fs)
+            pkts.append(self.process_pkt(self.chan, t_sync, p, rssi, crc_err, aa, phy,
+                                         cfo=self._cfo_hz(cfo)))
         return pkts
 
     # To process a range of samples without knowledge of previous samples
     def feed_range(self, samples, start_sample, phy=PhyMode.PHY_1M):
         pass # TODO
 
+    # Returns (sync indices, dewhitened packets as rows of a 2D array, packet lengths)
+    # Packet lengths include the CRC but not the access address
     @staticmethod
-    def ble_pkt_extract(samples_demod, peaks, chan, samps_per_sym=2):
-        # TODO: coded phy support
-        pkts = []
+    def ble_pkt_extract_batch(samples_demod, peaks, chan, samps_per_sym=2):
         MAX_PKT = 264 # 4 byte AA, 2 byte header, 255 byte body, 3 byte CRC
-        for p in peaks:
-            syms = samples_demod[p:p+(8*MAX_PKT*samps_per_sym):samps_per_sym]
-            raw = unpack_syms(syms, 32)
-            if len(raw) > 2:
-                hdr = le_dewhiten(raw[:2], chan)
-                pkt_len = 5 + hdr[1]
-                pkts.append(le_dewhiten(raw[:pkt_len], chan))
-        return pkts
+        peaks = numpy.asarray(peaks, numpy.int64)
+        if len(peaks) == 0:
+            return peaks, numpy.zeros((0, MAX_PKT - 4), numpy.uint8), peaks
+
+        # Gather symbols following each sync word into one row per candidate packet
+        sym_idx = peaks[:, None] + numpy.arange(32, 8*MAX_PKT) * samps_per_sym
+        avail_syms = (len(samples_demod) - peaks + samps_per_sym - 1) // samps_per_sym - 32
+        avail_bytes = numpy.minimum((avail_syms + 7) // 8, MAX_PKT - 4)
+        numpy.clip(sym_idx, 0, len(samples_demod) - 1, out=sym_idx)
+        raw = numpy.packbits(samples_demod[sym_idx], axis=1, bitorder='little')
+
+        # Dewhiten all candidates at once, then trim each to its header length
+        dw = le_dewhiten_batch(raw, chan)
+        pkt_lens = numpy.minimum(5 + dw[:, 1].astype(numpy.int64), avail_bytes)
+        keep = avail_bytes > 2
+        return peaks[keep], dw[keep], pkt_lens[keep]
 
-    def process_pkt(self, chan, t_sync, pkt, rssi):
+    @staticmethod
+    def ble_pkt_extract(samples_demod, peaks, chan, samps_per_sym=2):
+        _, dw, pkt_lens = ChannelProcessor.ble_pkt_extract_batch(samples_demod, peaks, chan, samps_per_sym)
+        return [dw[i, :pkt_lens[i]].tobytes() for i in range(len(pkt_lens))]
+
+    def process_pkt(self, chan, t_sync, pkt, rssi, crc_err=None, aa=None, phy=None, cfo=None):
+        if aa is None:
+            aa = self.aa
+        if phy is None:
+            phy = self.phy
         body = pkt[:-3]
         crc_bytes = pkt[-3:]
         crc_rev = crc_bytes[0] | (crc_bytes[1] << 8) | (crc_bytes[2] << 16)
-        crc_calc = crc_ble_reverse(self.crci_rev, body)
-        crc_err = (crc_calc != crc_rev)
-        return _SDRPacket(t_sync, rssi, chan, self.phy, body, crc_rev, crc_err)
+        if crc_err is None:
+            crc_calc = crc_ble_reverse(self.targets[aa], body)
+            crc_err = (crc_calc != crc_rev)
+        return _SDRPacket(t_sync, rssi, chan, phy, body, crc_rev, bool(crc_err), aa, cfo)
+
+# Runs ChannelProcessors for the active channels in a thread pool, sharing the
+# processor objects with the caller
+class _ThreadDemodBackend:
+    def __init__(self, chan_processors, chans, workers):
+        self.chan_processors = chan_processors
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    # active is a list of (channelizer output index, processor index) tuples
+    # Processor indices are the BLE channel for 1M, or 40 + BLE channel for 2M
+    # If given, spans maps channelizer output index to the EnergyGate spans to demodulate
+    def feed(self, channelized, active, spans=None, hold=0):
+        if spans is None:
+            futures = [self.executor.submit(self.chan_processors[c].feed, channelized[i])
+                       for i, c in active]
+        else:
+            futures = [self.executor.submit(self.chan_processors[c].feed_spans, channelized[i],
+                                            spans[i], hold) for i, c in active]
+        pkts = []
+        for f in futures:
+            pkts.extend(f.result())
+        return pkts
+
+    def flush(self, active):
+        pkts = []
+        for _, c in active:
+            pkts.extend(self.chan_processors[c].flush())
+        return pkts
+
+    def skip(self, active, num_samples):
+        pkts = []
+        for _, c in active:
+            pkts.extend(self.chan_processors[c].skip(num_samples))
+        return pkts
+
+    def call(self, method, *args):
+        pass # processors are shared, caller already updated them
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+# processors maps processor index to ChannelProcessor
+def _demod_worker(conn, processors):
+    procs = processors
+    shm = None
+    while True:
+        cmd, *args = conn.recv()
+        if cmd == 'stop':
+            break
+        try:
+            pkts = []
+            if cmd == 'feed':
+                shm_name, shape, rows, hold = args
+                if shm is None or shm.name != shm_name:
+                    if shm is not None:
+                        shm.close()
+                    shm = SharedMemory(name=shm_name)
+                channelized = numpy.ndarray(shape, complex64, buffer=shm.buf)
+                for row, c, spans in rows:
+                    if spans is None:
+                        pkts.extend(procs[c].feed(channelized[row]))
+                    else:
+                        pkts.extend(procs[c].feed_spans(channelized[row], spans, hold))
+                del channelized
+            elif cmd == 'flush':
+                for c in args[0]:
+                    pkts.extend(procs[c].flush())
+            elif cmd == 'skip':
+                chans, num_samples = args
+                for c in chans:
+                    pkts.extend(procs[c].skip(num_samples))
+            elif cmd == 'call':
+                method, margs = args
+                for p in procs.values():
+                    getattr(p, method)(*margs)
+            conn.send([p.to_record() for p in pkts])
+        except BaseException as e:
+            conn.send(e)
+    if shm is not None:
+        shm.close()
+
+# Runs ChannelProcessors for the active channels in worker processes, each owning a
+# subset of the channels. Channelizer outputs are passed through shared memory,
+# and packets come back as compact records.
+class _ProcessDemodBackend:
+    def __init__(self, chan_processors, chans, workers):
+        ctx = get_context('spawn')
+        workers = max(1, min(workers, len(chans)))
+        self.assign = {c: k % workers for k, c in enumerate(chans)}
+        self.conns = []
+        self.procs = []
+        for w in range(workers):
+            owned = {c: chan_processors[c] for c in chans if self.assign[c] == w}
+            conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(target=_demod_worker, args=(child_conn, owned), daemon=True)
+            proc.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.procs.append(proc)
+        self.shm = None
+
+    def _ensure_shm(self, nbytes):
+        if self.shm is None or self.shm.size < nbytes:
+            if self.shm is not None:
+                self.shm.close()
+                self.shm.unlink()
+            self.shm = SharedMemory(create=True, size=max(nbytes, 1))
+
+    # Sends each worker its message (from msgs, in worker order) and collects the replies
+    # A worker that died (closing its pipe) fails the whole operation, after the
+    # replies of the other workers are read so that their pipes stay in step
+    def _exchange(self, msgs):
+        sent = []
+        for conn, msg in zip(self.conns, msgs):
+            try:
+                conn.send(msg)
+                sent.append(True)
+            except OSError:
+                sent.append(False)
+
+        pkts = []
+        err = None
+        for conn, proc, ok in zip(self.conns, self.procs, sent):
+            if ok:
+                try:
+                    recs = conn.recv()
+                except (EOFError, OSError):
+                    ok = False
+            if not ok:
+                proc.join(timeout=1)
+                err = RuntimeError("Demodulation worker exited with code %s" % proc.exitcode)
+            elif isinstance(recs, BaseException):
+                err = recs
+            else:
+                pkts.extend(_SDRPacket(*r) for r in recs)
+        if err is not None:
+            raise err
+        return pkts
+
+    def _per_worker_chans(self, active):
+        chans = [[] for _ in self.conns]
+        for _, c in active:
+            chans[self.assign[c]].append(c)
+        return chans
+
+    def feed(self, channelized, active, spans=None, hold=0):
+        num_samples = len(channelized[active[0][0]]) if active else 0
+        rows = {} # channelizer output to shared row, an output may feed several processors
+        for i, _ in active:
+            rows.setdefault(i, len(rows))
+        shape = (len(rows), num_samples)
+        self._ensure_shm(shape[0] * shape[1] * numpy.dtype(complex64).itemsize)
+        shared = numpy.ndarray(shape, complex64, buffer=self.shm.buf)
+        for i, row in rows.items():
+            shared[row] = channelized[i]
+        jobs = [[] for _ in self.conns]
+        for i, c in active:
+            jobs[self.assign[c]].append((rows[i], c, None if spans is None else spans[i]))
+        del shared
+        return self._exchange([('feed', self.shm.name, shape, rows, hold) for rows in jobs])
+
+    def flush(self, active):
+        return self._exchange([('flush', chans) for chans in self._per_worker_chans(active)])
+
+    def skip(self, active, num_samples):
+        return self._exchange([('skip', chans, num_samples)
+                               for chans in self._per_worker_chans(active)])
+
+    def call(self, method, *args):
+        self._exchange([('call', method, args)] * len(self.conns))
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(('stop',))
+            except OSError:
+                pass # worker already exited
+        for proc in self.procs:
+            proc.join(timeout=5)
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+_demod_backends = {'thread': _ThreadDemodBackend, 'process': _ProcessDemodBackend}
+
+# Tracks per-chunk processing time relative to real time, and optionally adapts the
+# chunk size: shrinking it while processing keeps up (for lower latency), and growing
+# it when processing falls behind (to amortize per-chunk overhead)
+class AdaptiveChunkSizer:
+    def __init__(self, chunk_size, chunk_min=None, chunk_max=None, adaptive=False,
+                 low_load=0.5, high_load=0.9, settle_chunks=8, avg_weight=0.25):
+        self.chunk_min = chunk_min if chunk_min else min(chunk_size, 1 << 16)
+        self.chunk_max = chunk_max if chunk_max else chunk_size * (4 if adaptive else 1)
+        if not (self.chunk_min <= chunk_size <= self.chunk_max):
+            raise ValueError("Chunk size must be between chunk_min and chunk_max")
+        self.chunk_size = chunk_size
+        self.adaptive = adaptive
+        self.low_load = low_load
+        self.high_load = high_load
+        self.settle_chunks = settle_chunks
+        self.avg_weight = avg_weight
+
+        self.chunks = 0
+        self.samples = 0
+        self.proc_time = 0.
+        self.real_time = 0.
+        self.last_proc_time = 0.
+        self.last_real_time = 0.
+        self.load_avg = None
+        self.reader_stall_time = 0.
+        self.resizes = 0
+        self._since_resize = 0
+
+    # Record processing of a chunk of n_samples taking proc_time seconds,
+    # representing real_time seconds of signal
+    def update(self, n_samples, proc_time, real_time):
+        self.chunks += 1
+        self.samples += n_samples
+        self.proc_time += proc_time
+        self.real_time += real_time
+        self.last_proc_time = proc_time
+        self.last_real_time = real_time
+
+        load = proc_time / real_time if real_time > 0 else 0.
+        if self.load_avg is None:
+            self.load_avg = load
+        else:
+            self.load_avg += self.avg_weight * (load - self.load_avg)
+
+        self._since_resize += 1
+        if not self.adaptive or self._since_resize < self.settle_chunks:
+            return
+        if self.load_avg > self.high_load and self.chunk_size < self.chunk_max:
+            self._resize(min(self.chunk_size * 2, self.chunk_max))
+        elif self.load_avg < self.low_load and self.chunk_size > self.chunk_min:
+            self._resize(max(self.chunk_size // 2, self.chunk_min))
+
+    def _resize(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.resizes += 1
+        self._since_resize = 0
+        self.load_avg = None
+
+    def record_stall(self, stall_time):
+        self.reader_stall_time += stall_time
+
+    def get_metrics(self):
+        return {
+            'chunk_size': self.chunk_size,
+            'chunks': self.chunks,
+            'samples': self.samples,
+            'last_proc_time': self.last_proc_time,
+            'last_real_time': self.last_real_time,
+            'load_avg': self.load_avg,
+            'realtime_factor': self.real_time / self.proc_time if self.proc_time else None,
+            'reader_stall_time': self.reader_stall_time,
+            'resizes': self.resizes
+        }
+
+# Ring of reusable sample buffers handed between the reader and worker threads
+# The reader fills a free slot and commits it, the worker gets a view of the slot's
+# samples and releases the slot once done with them, so no copies are needed.
+# Slots start empty and are grown when first written with more samples than they hold,
+# up to slot_max. Memory thus follows the chunk sizes actually used, and never exceeds
+# slot_max samples per slot (and for the scratch buffer).
+# If drop_on_overflow is set, the reader never blocks waiting for a free slot; instead
+# the chunk is read into a scratch buffer, discarded, and counted as an overflow.
+class SampleRing:
+    def __init__(self, num_slots, slot_max, dtype=complex64, drop_on_overflow=False):
+        self.dtype = dtype
+        self.slot_max = slot_max
+        self.slots = [zeros(0, dtype) for _ in range(num_slots)]
+        self.scratch = zeros(0, dtype) if drop_on_overflow else None
+        self.drop_on_overflow = drop_on_overflow
+        self.free_q = Queue()
+        self.full_q = Queue()
+        for i in range(num_slots):
+            self.free_q.put(i)
+        self.closed = False
+
+        self.overflows = 0
+        self.dropped_samples = 0
+        self._pending_drop = 0
+
+    # Returns (slot index, buffer of at least num_samples) to write into, or None if the
+    # ring was closed. Slot index is None for a scratch buffer whose contents will be discarded
+    def acquire_write(self, num_samples):
+        if num_samples > self.slot_max:
+            raise ValueError("Ring slots hold at most %d samples" % self.slot_max)
+        if self.drop_on_overflow:
+            try:
+                i = self.free_q.get_nowait()
+            except Empty:
+                if len(self.scratch) < num_samples:
+                    self.scratch = zeros(num_samples, self.dtype)
+                return None, self.scratch
+        else:
+            i = self.free_q.get()
+        if i is None or self.closed:
+            return None
+        if len(self.slots[i]) < num_samples:
+            self.slots[i] = zeros(num_samples, self.dtype)
+        return i, self.slots[i]
+
+    def commit(self, slot, num_samples, num_source_samples):
+        if slot is None:
+            self.overflows += 1
+            self.dropped_samples += num_source_samples
+            self._pending_drop += num_source_samples
+        else:
+            self.full_q.put((slot, num_samples, num_source_samples, self._pending_drop))
+            self._pending_drop = 0
+
+    # Returns (slot index, view of samples, source samples they came from, source samples
+    # dropped just before these) or None if the ring was closed or the reader finished
+    def acquire_read(self):
+        item = self.full_q.get()
+        if item is None or self.closed:
+            return None
+        slot, num_samples, num_source, dropped = item
+        return slot, self.slots[slot][:num_samples], num_source, dropped
+
+    def release(self, slot):
+        self.free_q.put(slot)
+
+    # Signal that no more data will be written
+    def finish(self):
+        self.full_q.put(None)
+
+    # Unblock both sides
+    def close(self):
+        self.closed = True
+        self.free_q.put(None)
+        self.full_q.put(None)
 
 class SniffleSDR:
     chunk_size = 4000000
-
-    def __init__(self, fs_source, gain, chan=37, multi_chan=True, logger=None):
+    ring_slots = 4
+    drop_on_overflow = False # set for live sources that must not be stalled
+    max_tracked_aas = 8
+
+    # chunk_size is the number of source samples read per chunk
+    # With latency_mode, the chunk size adapts to processing headroom within chunk_min to chunk_max
+    # demod_backend selects whether channels are demodulated in a 'thread' or 'process' pool
+    # all_chan receives every channel covered by the capture bandwidth, rather than only
+    # primary advertising channels, listening for aux advertising and tracked connections
+    # phy_2m additionally receives 2M PHY on those data channels, widening the channel filter
+    # energy_gate only demodulates spans of each channel with energy above the noise floor
+    # direct_read reads the source from the demodulation thread itself, without a reader
+    # thread or sample ring, for sources that are never stalled (ex. file replay)
+    # channelizer_workers sets the channelizer's thread count, defaulting to the CPU count
+    def __init__(self, fs_source, gain, chan=37, multi_chan=True, logger=None,
+                 chunk_size=None, latency_mode=False, chunk_min=None, chunk_max=None,
+                 demod_backend='thread', demod_workers=None, all_chan=False, phy_2m=False,
+                 energy_gate=True, direct_read=False, channelizer_workers=None):
+        if demod_backend not in _demod_backends:
+            raise ValueError("Unknown demodulation backend %s" % demod_backend)
+        self.demod_backend = demod_backend
+        self.demod_workers = demod_workers if demod_workers else cpu_count()
+        self.demod = None
+        self.all_chan = all_chan
+        self.phy_2m = phy_2m
+        self.energy_gate = energy_gate
+        self.gates = {} # channelizer output index to (BLE channel, EnergyGate)
+        self.mode = SnifferMode.CONN_FOLLOW
+        self.tracked_aas = [] # oldest first
+        self.shed_chunks = 0
+        self.cfo_tracker = CFOTracker() # per-transmitter carrier frequency offsets
         self.pktq = Queue()
+        self.worker_error = None # exception that stopped the receive worker
+        self.config_q = Queue() # pending (method, args) for channel processors
         self.decoder_state = SniffleDecoderState()
         self.logger = logger if logger else TrivialLogger()
         self.worker = None
@@ -127,26 +1120,37 @@ class SniffleSDR:
         self.reader = None
         self.reader_started = False
         self.reader_stopped = False
-
-        self.read_sem = Semaphore(1) # ready to read
-        self.data_sem = Semaphore(0) # new data in self.data_buf
-        self.data_buf = [zeros(self.chunk_size, dtype=complex64)]
-        if fs_source == 122.88e6 or fs_source == 61.44e6:
-            if multi_chan:
-                # Resample 122.88 MSPS to 96 MSPS, or 61.44 MSPS to 48 MSPS
-                up = 25
-                down = 32
-                order = 5
-            else:
-                # Resample to 2 MSPS
-                up = 25
-                if fs_source == 122.88e6:
-                    down = 1536
-                    order = 51
-                else: # fs_source == 122.88e6
-                    down = 768
-                    order = 41
-                order = 25
+        self.direct_read = direct_read
+        self.channelizer_workers = channelizer_workers
+        self.source_running = False
+        self.start_time_ns = None # source start time (UNIX epoch nanoseconds), if not now
+
+        if chunk_size:
+            self.chunk_size = chunk_size
+        self.chunk_sizer = AdaptiveChunkSizer(self.chunk_size, chunk_min, chunk_max, latency_mode)
+
+        self.ring = None
+        self.channelizer = None
+        self.read_slot = None
+        self.read_source = 0 # source samples behind the chunk last read
+        self.read_dropped = 0
+        self.num_channels = int((fs_source / 2e6) + 0.5)
+        if multi_chan and (fs_source == 122.88e6 or fs_source == 61.44e6):
+            # Channelized directly by a fast convolution filter bank, with as many
+            # channels as the front end filter passes (90 MHz or 40 MHz of bandwidth)
+            self.fs = fs_source
+            self.resampler = None
+            self.num_channels = 48 if fs_source == 122.88e6 else 24
+        elif fs_source == 122.88e6 or fs_source == 61.44e6:
+            # Resample to 2 MSPS
+            up = 25
+            if fs_source == 122.88e6:
+                down = 1536
+                order = 51
+            else: # fs_source == 122.88e6
+                down = 768
+                order = 41
+            order = 25
             self.fs = fs_source * up / down
             self.resampler = PolyphaseResampler(up, down, order=order)
         elif fs_source % 2e6 != 0 or fs_source < 4e6:
@@ -162,6 +1166,7 @@ class SniffleSDR:
             self.fs = fs_source
             self.resampler = None
 
+        self.fs_source = fs_source
         self.gain = gain
         self.chan = chan
         self.phy = PhyMode.PHY_1M
@@ -170,7 +1175,9 @@ class SniffleSDR:
         self.validate_crc = True
 
         # TODO: consider attenuation from resampler in per-channel gain
-        self.chan_processors = [ChannelProcessor(i, 2E6, gain=self.gain) for i in range(40)]
+        # Indices 0 to 39 are 1M processors, 40 to 79 are 2M processors for the same channels
+        self.chan_processors = [ChannelProcessor(i, 2E6, gain=self.gain) for i in range(40)] + \
+                [ChannelProcessor(i, 2E6, gain=self.gain, phy=PhyMode.PHY_2M) for i in range(40)]
 
     # Passively listen on specified channel and PHY for PDUs with specified access address
     # Expect PDU CRCs to use the specified initial CRC
@@ -181,8 +1188,12 @@ class SniffleSDR:
             raise ValueError("PHY must be 0 (1M), 1 (2M), 2 (coded S=8), or 3 (coded S=2)")
         self.chan = chan
         self.phy = phy
-        for p in self.chan_processors:
-            p.set_aa_crci(aa, crci)
+        # Processors are reset to receive only this AA, so tracked connections are dropped
+        self.tracked_aas = []
+        self._config_processors('set_aa_crci', aa, crci)
+
+        # Coded PHY reception runs alongside 1M on the same samples
+        self._config_processors('set_coded_phy', phy in (PhyMode.PHY_CODED_S8, PhyMode.PHY_CODED_S2))
 
     # Specify minimum RSSI for received advertisements
     def cmd_rssi(self, rssi=-128):
@@ -199,16 +1210,105 @@ class SniffleSDR:
 
     def cmd_crc_valid(self, validate=True):
         self.validate_crc = validate
+        self._config_processors('set_validate_crc', validate)
+
+    # Allow up to max_errors bit errors in the preamble and access address of received packets
+    # Packets must still pass CRC validation unless it is disabled
+    def cmd_sync_errors(self, max_errors=0):
+        self._config_processors('set_sync_errors', max_errors)
+
+    # Estimate and compensate each burst's carrier frequency offset when slicing bits,
+    # retrying packets that fail CRC with their preamble and access address based estimate
+    def cmd_cfo_comp(self, enable=True):
+        self._config_processors('set_cfo_comp', enable)
+
+    # Retry packets that fail CRC with symbol timing recovered over the packet
+    def cmd_timing_recovery(self, enable=True):
+        self._config_processors('set_timing_recovery', enable)
+
+    # Follow a connection with the specified access address and CRC init on all data channels
+    # Only effective with all_chan. The oldest connection is dropped when too many are tracked.
+    def cmd_track_aa(self, aa, crci):
+        if aa in self.tracked_aas:
+            return
+        if len(self.tracked_aas) >= self.max_tracked_aas:
+            self.cmd_untrack_aa(self.tracked_aas[0])
+        self.tracked_aas.append(aa)
+        self._config_processors('add_conn_aa', aa, crci)
+
+    def cmd_untrack_aa(self, aa):
+        if aa in self.tracked_aas:
+            self.tracked_aas.remove(aa)
+            self._config_processors('remove_aa', aa)
+
+    # Apply a setting to all channel processors, including any in worker processes
+    # Settings are queued and applied by the receive worker between chunks, so they never
+    # change processors mid-chunk or interleave with demodulation backend traffic
+    def _config_processors(self, method, *args):
+        self.config_q.put((method, args))
+
+    def _apply_config(self):
+        while True:
+            try:
+                method, args = self.config_q.get_nowait()
+            except Empty:
+                break
+            for p in self.chan_processors:
+                getattr(p, method)(*args)
+            if self.demod:
+                self.demod.call(method, *args)
 
+    # Runs the receive pipeline, then always shuts it down and unblocks recv_and_decode,
+    # which raises any error that stopped the pipeline
     def _recv_worker(self):
-        t_start = time() # TODO: handle file source start time?
+        try:
+            self._recv_chunks()
+        except BaseException as e:
+            self.worker_error = e
+        finally:
+            try:
+                self._stop_pipeline()
+            except BaseException as e:
+                if self.worker_error is None:
+                    self.worker_error = e
+            self.worker_stopped = True
+            self.pktq.put(None) # unblock caller of recv_and_decode
+
+    def _stop_pipeline(self):
+        # A reader thread may still be waiting for a free slot, so let it go too
+        self.reader_stopped = True
+        if self.ring:
+            self.ring.close()
+        if self.source_running:
+            self.source_running = False
+            self.source_stop()
+        demod = self.demod
+        self.demod = None
+        if demod:
+            demod.close()
+        if self.channelizer:
+            self.channelizer.close()
+
+    def _recv_chunks(self):
+        # Packet timestamps count samples from this single anchor, so they don't drift
+        # or lose precision over long captures
+        t_start = self.start_time_ns if self.start_time_ns is not None else time_ns()
+        self._apply_config()
         for p in self.chan_processors:
             p.set_t_start(t_start)
 
         if self.use_channelizer:
-            num_channels = int((self.fs / 2e6) + 0.5)
+            num_channels = self.num_channels
             chan_max = (num_channels - 1) // 2
-            channelizer = PolyphaseChannelizer(num_channels)
+            # 2M signals are about 2 MHz wide, so let through the whole channel
+            chan_bw = dict(chan_rel_bw=1.0, chan_rel_trans=0.2) if self.phy_2m else {}
+            if self.fs % 2e6:
+                channelizer = FastConvChannelizer(self.fs, num_channels,
+                                                  workers=self.channelizer_workers, **chan_bw)
+            else:
+                channelizer = PolyphaseChannelizer(num_channels, workers=self.channelizer_workers,
+                                                   **chan_bw)
+            self.channelizer = channelizer
 
             channels = [None] * num_channels
             for rf_rel in range(-chan_max, chan_max + 1):
@@ -219,57 +1319,152 @@ class SniffleSDR:
         else:
             channels = [self.chan]
 
-        executor = ThreadPoolExecutor(max_workers=cpu_count())
-
-        buffers = [zeros(self.chunk_size, complex64)]
+        # Primary advertising channels are always processed first. With live sources,
+        # data channels are shed (skipped) while processing falls behind real time.
+        primary = [(i, c) for i, c in enumerate(channels) if c is not None and c >= 37]
+        if self.all_chan:
+            secondary = [(i, c) for i, c in enumerate(channels) if c is not None and c < 37]
+        else:
+            secondary = []
+        if self.phy_2m:
+            # Same channelizer outputs, also demodulated at 2M by the 2M processors
+            secondary += [(i, c + 40) for i, c in secondary]
+        active = primary + secondary
+        self.demod = _demod_backends[self.demod_backend](self.chan_processors,
+                [c for _, c in active], self.demod_workers)
+
+        buffers = [zeros(0, complex64)]
+        if self.direct_read:
+            self.direct_buf = zeros(0, dtype=complex64)
+            self.direct_out = zeros(0, dtype=complex64)
+        else:
+            self.ring = SampleRing(self.ring_slots, self._out_len(self.chunk_sizer.chunk_max),
+                                   drop_on_overflow=self.drop_on_overflow)
+        chan_rate = 2e6 if self.use_channelizer else self.fs
+        dropped_total = 0 # source samples lost to reader overflow
+        gap_total = 0 # channel samples skipped for them
+        if self.energy_gate:
+            self.gates = {i: (channels[i], EnergyGate()) for i, _ in active}
 
         while not self.worker_stopped:
             if not self.read(buffers):
+                if not self.worker_stopped:
+                    # source is done, process packets pending in the channelizer and channel tails
+                    if self.use_channelizer:
+                        self._emit_pkts(self._feed_demod(channelizer.flush([i for i, _ in active]), active))
+                    self._emit_pkts(self.demod.flush(active))
                 self.worker_stopped = True
-                self.pktq.put(None) # unblock caller of recv_and_decode
                 break
 
+            t_chunk = perf_counter()
+            self._apply_config()
+            pkts = []
+            if self.read_dropped:
+                # samples were lost to reader overflow, skip over the gap
+                # Gaps come from the running totals, so rounding doesn't accumulate across drops
+                dropped_total += self.read_dropped
+                gap = dropped_total * round(chan_rate) // round(self.fs_source) - gap_total
+                gap_total += gap
+                for _, gate in self.gates.values():
+                    gate.skip(gap)
+                pkts.extend(self.demod.skip(active, gap))
+
+            load = self.chunk_sizer.load_avg
+            shed = secondary and self.drop_on_overflow and load is not None and load > 1
             if self.use_channelizer:
-                channelized = channelizer.process(buffers[0])
+                channelized = channelizer.process(buffers[0],
+                        [i for i, _ in (primary if shed else active)])
             else:
                 channelized = buffers
 
-            futures = []
-            for i, c in enumerate(channels):
-                if c is None or c < 37:
-                    continue
-                futures.append(executor.submit(self.chan_processors[c].feed, channelized[i]))
-
-            # put the packets in chronological order
-            pkts = []
-            for f in futures:
-                pkts.extend(f.result())
-            pkts.sort(key=lambda p: p.ts)
-            for p in pkts:
-                pkt = p.to_packet_message(self.decoder_state)
-
-                # Check RSSI and CRC
-                if pkt.rssi < self.rssi_min:
+            if shed:
+                self.shed_chunks += 1
+                pkts.extend(self._feed_demod(channelized, primary))
+                num_samples = len(channelized[secondary[0][0]])
+                for i, _ in secondary:
+                    if i in self.gates:
+                        self.gates[i][1].skip(num_samples)
+                pkts.extend(self.demod.skip(secondary, num_samples))
+            else:
+                pkts.extend(self._feed_demod(channelized, active))
+            self.release()
+            self._emit_pkts(pkts)
+
+            # Chunk sizes are in source samples, so load is measured against those too
+            self.chunk_sizer.update(self.read_source, perf_counter() - t_chunk,
+                                    self.read_source / self.fs_source)
+
+    # Gate each channelizer output once, even if it feeds both 1M and 2M processors
+    def _feed_demod(self, channelized, active):
+        if not self.gates:
+            return self.demod.feed(channelized, active)
+        spans = {}
+        for i, _ in active:
+            if i not in spans:
+                spans[i] = self.gates[i][1].feed(channelized[i])
+        hold = next(iter(self.gates.values()))[1].hold
+        return self.demod.feed(channelized, active, spans, hold)
+
+    # Chunk sizing and per-chunk processing time vs. real time
+    def get_metrics(self):
+        metrics = self.chunk_sizer.get_metrics()
+        metrics['overflows'] = self.ring.overflows if self.ring else 0
+        metrics['dropped_samples'] = self.ring.dropped_samples if self.ring else 0
+        metrics['shed_chunks'] = self.shed_chunks
+        if self.channelizer:
+            metrics['channelizer'] = self.channelizer.get_timings()
+        if self.gates:
+            metrics['occupancy'] = {c: gate.get_stats() for c, gate in self.gates.values()}
+        metrics['cfo'] = self.cfo_tracker.get_stats()
+        return metrics
+
+    # Key for the transmitter of a packet in CFO telemetry: its device address for
+    # advertising channel PDUs that have one, otherwise the access address
+    @staticmethod
+    def _cfo_key(dpkt):
+        if isinstance(dpkt, ScanReqMessage):
+            return str_mac(dpkt.ScanA)
+        elif isinstance(dpkt, ConnectIndMessage):
+            return str_mac(dpkt.InitA)
+        elif getattr(dpkt, 'AdvA', None):
+            return str_mac(dpkt.AdvA)
+        return "AA 0x%08X" % dpkt.aa
+
+    def _emit_pkts(self, pkts):
+        # put the packets in chronological order
+        pkts.sort(key=lambda p: p.ts_ns)
+        for p in pkts:
+            pkt = p.to_packet_message(self.decoder_state)
+
+            # Check RSSI and CRC
+            if pkt.rssi < self.rssi_min:
+                continue
+            if self.validate_crc and pkt.crc_err:
+                continue
+
+            try:
+                dpkt = DPacketMessage.decode(pkt, self.decoder_state)
+            except BaseException as e:
+                #self.logger.warning("Skipping decode due to exception: %s", e, exc_info=e)
+                #self.logger.warning("Packet: %s", pkt)
+                dpkt = pkt
+
+            if p.cfo is not None:
+                self.cfo_tracker.update(self._cfo_key(dpkt), p.cfo)
+
+            if self.all_chan and self.mode == SnifferMode.CONN_FOLLOW and not p.crc_err and \
+                    isinstance(dpkt, ConnectIndMessage):
+                self.cmd_track_aa(dpkt.aa_conn, dpkt.CRCInit)
+
+            if not isinstance(dpkt, DataMessage):
+                # TODO: IRK-based MAC filtering
+                # TODO: Handle ADV_EXT_IND with AuxPtr and no MAC
+                if not hasattr(dpkt, 'AdvA'):
                     continue
-                if self.validate_crc and pkt.crc_err:
+                if self.mac and dpkt.AdvA != self.mac:
                     continue
 
-                try:
-                    dpkt = DPacketMessage.decode(pkt, self.decoder_state)
-                except BaseException as e:
-                    #self.logger.warning("Skipping decode due to exception: %s", e, exc_info=e)
-                    #self.logger.warning("Packet: %s", pkt)
-                    dpkt = pkt
-
-                if not isinstance(dpkt, DataMessage):
-                    # TODO: IRK-based MAC filtering
-                    # TODO: Handle ADV_EXT_IND with AuxPtr and no MAC
-                    if not hasattr(dpkt, 'AdvA'):
-                        continue
-                    if self.mac and dpkt.AdvA != self.mac:
-                        continue
-
-                self.pktq.put(dpkt)
+            self.pktq.put(dpkt)
 
     def recv_and_decode(self):
         if not self.worker_started:
@@ -279,7 +1474,12 @@ class SniffleSDR:
         elif self.worker_stopped and self.pktq.empty():
             raise SourceDone
 
-        return self.pktq.get()
+        pkt = self.pktq.get()
+        if pkt is None and self.worker_error is not None:
+            err = self.worker_error
+            self.worker_error = None
+            raise err
+        return pkt
 
     def mark_and_flush(self):
         pass
@@ -288,7 +1488,8 @@ class SniffleSDR:
         if self.worker_started:
             self.worker_stopped = True
             self.reader_stopped = True
-            self.data_sem.release()
+            if self.ring:
+                self.ring.close()
             self.worker.join()
             self.pktq.put(None)
 
@@ -307,6 +1508,7 @@ class SniffleSDR:
                       validate_crc=True):
         if not mode in SnifferMode:
             raise ValueError("Invalid mode requested")
+        self.mode = mode
 
         if self.use_channelizer:
             chan = self.chan
@@ -341,43 +1543,96 @@ class SniffleSDR:
         self.cmd_crc_valid(validate_crc)
 
     def _read_worker(self):
-        if self.resampler:
-            if self.use_channelizer:
-                tmp_buf = [zeros(self.chunk_size * self.resampler.down // self.resampler.up, dtype=complex64)]
-            else:
-                tmp_buf = [zeros(self.chunk_size, dtype=complex64)]
-        else:
-            tmp_buf = self.data_buf
+        src_buf = zeros(0, dtype=complex64)
 
         self.source_start()
         while not self.reader_stopped:
-            self.read_sem.acquire()
+            chunk_size = self.chunk_sizer.chunk_size
+            t_wait = perf_counter()
+            slot_buf = self.ring.acquire_write(self._out_len(chunk_size))
+            if slot_buf is None:
+                break
+            slot, buf = slot_buf
+            self.chunk_sizer.record_stall(perf_counter() - t_wait)
+
+            if self.resampler:
+                if len(src_buf) < chunk_size:
+                    src_buf = zeros(chunk_size, dtype=complex64)
+                tmp_buf = [src_buf[:chunk_size]]
+            else:
+                tmp_buf = [buf[:chunk_size]]
             if not self.source_read(tmp_buf):
+                if slot is not None:
+                    self.ring.release(slot)
                 self.reader_stopped = True
                 break
+
+            num_source = len(tmp_buf[0])
             if self.resampler:
-                self.data_buf[0] = self.resampler.feed(tmp_buf[0])
-            self.data_sem.release()
+                if slot is None:
+                    # Don't spend time resampling data that will be dropped
+                    num_samples = 0
+                else:
+                    num_samples = len(self.resampler.feed(tmp_buf[0], buf))
+            else:
+                num_samples = num_source
+                if tmp_buf[0] is not buf and slot is not None:
+                    # source provided its own buffer
+                    buf[:num_samples] = tmp_buf[0]
+            self.ring.commit(slot, num_samples, num_source)
+        self.ring.finish()
         self.source_stop()
 
+    # Provides a zero-copy view of the next chunk of samples in buffers[0]
+    # Caller must call release() once done with the samples
     def read(self, buffers):
-        if self.reader_stopped:
+        if self.worker_stopped:
             return False
+        if self.direct_read:
+            return self._read_direct(buffers)
         if not self.reader_started:
             self.reader_started = True
             self.reader = Thread(target=self._read_worker)
             self.reader.start()
 
-        self.data_sem.acquire()
-        if self.worker_stopped:
+        item = self.ring.acquire_read()
+        if item is None or self.worker_stopped:
             return False
-        if len(self.data_buf[0]) == len(buffers[0]):
-            buffers[0][:] = self.data_buf[0]
-        else:
-            buffers[0] = self.data_buf[0].copy()
-        self.read_sem.release()
+        self.read_slot, buffers[0], self.read_source, self.read_dropped = item
         return True
 
+    def _read_direct(self, buffers):
+        if not self.source_running:
+            if self.reader_stopped:
+                return False
+            self.source_running = True
+            self.source_start()
+        chunk_size = self.chunk_sizer.chunk_size
+        if len(self.direct_buf) < chunk_size:
+            self.direct_buf = zeros(chunk_size, dtype=complex64)
+            self.direct_out = zeros(self._out_len(chunk_size), dtype=complex64)
+        tmp_buf = [self.direct_buf[:chunk_size]]
+        if not self.source_read(tmp_buf):
+            self.reader_stopped = True
+            self.source_running = False
+            self.source_stop()
+            return False
+        buffers[0] = self.resampler.feed(tmp_buf[0], self.direct_out) if self.resampler else tmp_buf[0]
+        self.read_source = len(tmp_buf[0])
+        self.read_dropped = 0
+        return True
+
+    # Number of samples at the processing rate from num_source source samples (at most)
+    def _out_len(self, num_source):
+        if self.resampler:
+            return num_source * self.resampler.up // self.resampler.down + 2
+        return num_source
+
+    def release(self):
+        if self.read_slot is not None:
+            self.ring.release(self.read_slot)
+            self.read_slot = None
+
     def source_start(self):
         pass
 
@@ -387,8 +1642,12 @@ class SniffleSDR:
     def source_read(self, buffers):
         return False
 
+# SoapySDR is only imported by this class, so file replay and benchmarks work without it
 class SniffleSoapySDR(SniffleSDR):
-    def __init__(self, driver='rfnm', mode='single', logger=None):
+    drop_on_overflow = True
+
+    def __init__(self, driver='rfnm', mode='single', logger=None, **kwargs):
+        from SoapySDR import SOAPY_SDR_RX, Device as SoapyDevice
         self.sdr = None
         self.sdr_chan = 0
         multi_chan = False
@@ -425,9 +1684,10 @@ class SniffleSoapySDR(SniffleSDR):
         else:
             raise ValueError("Unknown driver")
 
-        super().__init__(fs_source, gain, chan, multi_chan, logger)
+        super().__init__(fs_source, gain, chan, multi_chan, logger, **kwargs)
 
     def source_start(self):
+        from SoapySDR import SOAPY_SDR_RX, SOAPY_SDR_CF32
         self.stream = self.sdr.setupStream(SOAPY_SDR_RX, SOAPY_SDR_CF32, [self.sdr_chan])
         self.sdr.activateStream(self.stream)
 
@@ -444,19 +1704,160 @@ class SniffleSoapySDR(SniffleSDR):
         return True
 
     def cmd_chan_aa_phy(self, chan=37, aa=BLE_ADV_AA, phy=PhyMode.PHY_1M, crci=BLE_ADV_CRCI):
+        from SoapySDR import SOAPY_SDR_RX
         super().cmd_chan_aa_phy(chan, aa, phy, crci)
         self.sdr.setFrequency(SOAPY_SDR_RX, self.sdr_chan, freq_from_chan(self.chan))
 
+# Replays a recorded capture, in any of the formats supported by IQFileSource
+# Sample rate, center frequency, and start time come from a SigMF sidecar when present,
+# otherwise fs and chan (the BLE channel at the center frequency) are used.
+# With fast set, samples are read without a reader thread, as fast as they're processed.
+# start and stop limit replay to a range of sample indices within the file.
+#
+# With segment_len (seconds) set, the capture is instead decoded in parallel as segments
+# by segment_workers processes. Segments overlap by enough for filter warm-up and the
+# longest packet, packets are kept by the segment their timestamp falls in, and any
+# received by both sides of a boundary are de-duplicated. Connections are only followed
+# (with all_chan) within the segment their CONNECT_IND was received in.
 class SniffleFileSDR(SniffleSDR):
-    def __init__(self, file_name, fs=122.88e6, gain=10, chan=17, logger=None):
-        super().__init__(fs, gain, chan, True, logger)
-        self.file = open(file_name, 'rb')
+    segment_warmup = 0.001 # seconds of leading overlap for resampler/channelizer/gate state
+    segment_dup_time = 5e-6 # timestamps of one packet may differ by this across segments
+
+    def __init__(self, file_name, fs=None, gain=10, chan=None, logger=None, fmt=None, fast=False,
+                 start=0, stop=None, segment_len=None, segment_workers=None, **kwargs):
+        self.source = IQFileSource(file_name, fmt, start, stop)
+        self.file_name = file_name
+        self.segment_len = segment_len
+        self.segment_workers = segment_workers if segment_workers else cpu_count()
+        self.segment_kwargs = dict(kwargs, fmt=self.source.fmt, gain=gain)
+        meta = self.source.meta
+        if fs is None:
+            fs = meta.get('fs', 122.88e6)
+        if chan is None:
+            if 'center_freq' in meta:
+                chan = chan_from_freq(meta['center_freq'])
+                if abs(freq_from_chan(chan) - meta['center_freq']) > 1e3:
+                    raise ValueError("Capture must be centered on a BLE channel")
+            else:
+                chan = 17 # 2440 MHz
+        kwargs.setdefault('direct_read', fast)
+        super().__init__(fs, gain, chan, True, logger, **kwargs)
+        self.start_time_ns = meta.get('start_time_ns')
+        if self.start_time_ns is not None:
+            self.start_time_ns += samples_to_ns(start, fs)
+
+    def _recv_chunks(self):
+        if self.segment_len:
+            self._recv_segments()
+        else:
+            super()._recv_chunks()
+
+    def _recv_segments(self):
+        fs = self.fs_source
+        # Time of the first sample to decode (pos), segment times are relative to it
+        t_base = self.start_time_ns if self.start_time_ns is not None else time_ns()
+        pos = self.source.pos
+        seg_len = int(self.segment_len * fs)
+        warmup = int(self.segment_warmup * fs)
+        max_pkt = max(p.overlap_len / p.fs for p in self.chan_processors)
+        lag = int((max_pkt + self.segment_warmup) * fs)
+
+        # Processors are sent along already configured (AAs, coded PHY, etc.)
+        self._apply_config()
+        ctx = get_context('spawn')
+        executor = ProcessPoolExecutor(max_workers=self.segment_workers, mp_context=ctx)
+        # Errors from segments (including a segment process dying) stop the decode, and
+        # are passed on to recv_and_decode by _recv_worker
+        try:
+            futures = []
+            for seg_start in range(pos, self.source.num_samples, seg_len):
+                read_start = max(seg_start - warmup, pos)
+                read_stop = min(seg_start + seg_len + lag, self.source.num_samples)
+                futures.append(executor.submit(_decode_segment, self.file_name, self.fs_source,
+                        self.chan, self.segment_kwargs, self.chan_processors, self.mode,
+                        list(self.tracked_aas), read_start, read_stop,
+                        t_base + samples_to_ns(read_start - pos, fs)))
+
+            recent = [] # (timestamp, key) of packets kept near the end of the previous segment
+            dup = int(self.segment_dup_time * 1e9)
+            for k, f in enumerate(futures):
+                if self.worker_stopped:
+                    break
+                seg_t0 = t_base + samples_to_ns(k * seg_len, fs)
+                seg_t1 = t_base + samples_to_ns((k + 1) * seg_len, fs)
+                pkts = []
+                for r in f.result():
+                    p = _SDRPacket(*r)
+                    if not (seg_t0 - dup <= p.ts_ns < seg_t1 + dup):
+                        continue
+                    key = (p.chan, p.aa, p.body)
+                    if p.ts_ns < seg_t0 + dup and \
+                            any(key == rk and abs(p.ts_ns - rt) < dup for rt, rk in recent):
+                        continue
+                    pkts.append(p)
+                recent = [(p.ts_ns, (p.chan, p.aa, p.body)) for p in pkts if p.ts_ns >= seg_t1 - dup]
+                self._emit_pkts(pkts)
+        finally:
+            executor.shutdown(cancel_futures=True)
 
     def source_read(self, buffers):
-        chunk = self.file.read(len(buffers[0]) * 8)
-        if len(chunk) == 0:
-            self.file.close()
-            self.file = None
+        samples = self.source.read(len(buffers[0]), buffers[0])
+        if samples is None:
             return False
-        buffers[0] = frombuffer(chunk, complex64)
+        buffers[0] = samples
         return True
+
+    def source_stop(self):
+        self.source.close()
+
+# Keeps every received packet for merging with other segments, while still following
+# connections within the segment
+class _SegmentFileSDR(SniffleFileSDR):
+    def _emit_pkts(self, pkts):
+        self.records.extend(p.to_record() for p in pkts)
+        super()._emit_pkts(pkts)
+        while not self.pktq.empty():
+            self.pktq.get()
+
+# Runs in a worker process, returning packet records for samples start to stop of the file
+def _decode_segment(file_name, fs, chan, kwargs, processors, mode, tracked_aas, start, stop, t_start):
+    kwargs = dict(kwargs, fast=True, demod_backend='thread', demod_workers=1, channelizer_workers=1)
+    sdr = _SegmentFileSDR(file_name, fs, chan=chan, start=start, stop=stop, **kwargs)
+    sdr.chan_processors = processors
+    sdr.mode = mode
+    sdr.tracked_aas = tracked_aas
+    sdr.start_time_ns = t_start
+    sdr.records = []
+    sdr._recv_worker()
+    if sdr.worker_error is not None:
+        raise sdr.worker_error
+    return sdr.records
+
+def _parse_bool(value):
+    return value.lower() in ('1', 'true', 'yes')
+
+# SniffleFileSDR options that may follow the file name in a file source spec,
+# with the conversion for their values
+file_spec_options = {
+    'fs': float,
+    'chan': int,
+    'gain': int,
+    'fmt': str,
+    'fast': _parse_bool,
+    'start': int,
+    'stop': int,
+    'segment_len': float,
+    'segment_workers': int
+}
+
+# Splits a "path?name=value&name=value" file source spec (as in file:<spec> serial
+# port names) into the file name and SniffleFileSDR keyword arguments
+def parse_file_spec(spec):
+    file_name, _, opts = spec.partition('?')
+    kwargs = {}
+    for opt in opts.split('&') if opts else []:
+        name, sep, value = opt.partition('=')
+        if not sep or name not in file_spec_options:
+            raise ValueError("Invalid file source option: %s" % opt)
+        kwargs[name] = file_spec_options[name](value)
+    return file_name, kwargs
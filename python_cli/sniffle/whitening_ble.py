@@ -2,6 +2,8 @@
 # Copyright (c) 2024, NCC Group plc
 # Released as open source under GPLv3
 
+import numpy
+
 whitening_bitstream = [
     1, 1, 1, 1, 0, 1, 0, 1, 0, 1, 0, 0, 0, 0, 1, 0, # 0
 	1, 1, 0, 1, 1, 1, 1, 0, 0, 1, 1, 1, 0, 0, 1, 0, # 16
@@ -19,18 +21,39 @@ whitening_index = [
     94, 86, 49, 52, 20, 40, 27, 84, 90, 63, 112, 47, 102
 ]
 
-# code based on ubertooth
+# 2 byte header, 255 byte body, 3 byte CRC, rounded up
+WHITENING_TABLE_LEN = 264
+
+def _make_keystream(chan, nbytes):
+    bit_idx = (whitening_index[chan] + numpy.arange(nbytes * 8)) % len(whitening_bitstream)
+    bits = numpy.array(whitening_bitstream, numpy.uint8)[bit_idx]
+    return numpy.packbits(bits, bitorder='little')
+
+# Per-channel whitening keystream bytes (40 x WHITENING_TABLE_LEN)
+# The LFSR sequence repeats every 127 bits, and thus also every 127 bytes
+whitening_keystream = numpy.stack([_make_keystream(c, WHITENING_TABLE_LEN) for c in range(40)])
+
+def _keystream(chan, nbytes):
+    if nbytes <= WHITENING_TABLE_LEN:
+        return whitening_keystream[chan, :nbytes]
+    return numpy.resize(whitening_keystream[chan, :len(whitening_bitstream)], nbytes)
+
+# Whitening is its own inverse, so this also whitens data
 def le_dewhiten(data, chan):
-	dw = []
-	idx = whitening_index[chan]
-
-	for b in data:
-		o = 0
-		for i in range(8):
-			bit = (b >> i) & 1
-			bit ^= whitening_bitstream[idx]
-			idx = (idx + 1) % len(whitening_bitstream)
-			o |= bit << i
-		dw.append(o)
-
-	return bytes(dw)
+    data = numpy.frombuffer(data, numpy.uint8) if isinstance(data, (bytes, bytearray)) else \
+            numpy.asarray(data, numpy.uint8)
+    return (data ^ _keystream(chan, len(data))).tobytes()
+
+# Dewhiten a 2D uint8 array with one candidate packet per row
+# chan may be a single channel or an array with one channel per row
+def le_dewhiten_batch(data, chan):
+    data = numpy.asarray(data, numpy.uint8)
+    nbytes = data.shape[1]
+    if nbytes > WHITENING_TABLE_LEN:
+        table = numpy.stack([_keystream(c, nbytes) for c in range(40)])
+    else:
+        table = whitening_keystream[:, :nbytes]
+    if numpy.ndim(chan) == 0:
+        return data ^ table[chan]
+    else:
+        return data ^ table[numpy.asarray(chan)]
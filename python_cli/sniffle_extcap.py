@@ -38,7 +38,7 @@ import signal
 import traceback
 from serial.tools.list_ports import comports
 from sniffle.constants import BLE_ADV_AA
-from sniffle.sniffle_hw import make_sniffle_hw, SniffleHW, PacketMessage, SnifferMode, PhyMode
+from sniffle.sniffle_hw import make_sniffle_hw, is_sdr_serport, SniffleHW, PacketMessage, SnifferMode, PhyMode
 from sniffle.packet_decoder import (DataMessage, AdvaMessage, AdvDirectIndMessage,
                             ScanRspMessage, AdvExtIndMessage, str_mac)
 from sniffle.pcap import PcapBleWriter
@@ -443,7 +443,8 @@ class SniffleExtcapPlugin():
         if self.args.fifo is not None:
             self.logger.info('Opening capture output FIFO')
             self.captureStream = open(self.args.fifo, 'wb', buffering=0)
-            self.pcapWriter = PcapBleWriter(self.captureStream)
+            self.pcapWriter = PcapBleWriter(self.captureStream,
+                                            nanosecond=is_sdr_serport(self.args.serport))
 
         if self.controlReadStream:
             # start a thread to read control messages
@@ -0,0 +1,90 @@
+import numpy
+import pytest
+
+from sniffle.channelizer import PolyphaseChannelizer, FastConvChannelizer
+
+def _noise(n, seed=0):
+    rng = numpy.random.default_rng(seed)
+    return (rng.normal(0, 1, n) + 1j * rng.normal(0, 1, n)).astype(numpy.complex64)
+
+# Chunk sizes that aren't multiples of the channel count, including empty chunks
+def _chunks(samples, seed=0):
+    cuts = numpy.sort(numpy.random.default_rng(seed).integers(0, len(samples), 20))
+    return numpy.split(samples, cuts)
+
+def _run(chan, chunks, chans=None):
+    out = [chan.process(c, chans) for c in chunks]
+    out.append(chan.flush(chans))
+    chan.close()
+    return numpy.concatenate(out, axis=1)
+
+def test_polyphase_chunked_matches_single_call():
+    samples = _noise(24 * 5000 + 7)
+    whole = _run(PolyphaseChannelizer(24, workers=3), [samples])
+    chunked = _run(PolyphaseChannelizer(24, workers=3), _chunks(samples))
+    assert whole.shape == (24, 5000)
+    numpy.testing.assert_array_equal(chunked, whole)
+
+    # Batching of branches across workers doesn't change results
+    single = _run(PolyphaseChannelizer(24, workers=1), _chunks(samples, 1))
+    numpy.testing.assert_array_equal(single, whole)
+
+@pytest.mark.parametrize('backend', ['fft', 'matrix'])
+@pytest.mark.parametrize('taps', [16, 33])
+def test_polyphase_backends_match_direct(backend, taps):
+    samples = _noise(48 * 3000 + 11)
+    direct = _run(PolyphaseChannelizer(48, taps, workers=2), _chunks(samples))
+    other = _run(PolyphaseChannelizer(48, taps, workers=2, backend=backend), _chunks(samples, 1))
+    # Single precision coefficients, so only close
+    numpy.testing.assert_allclose(other, direct, rtol=0, atol=1e-5 * numpy.abs(direct).max())
+
+def test_polyphase_unknown_backend():
+    with pytest.raises(ValueError):
+        PolyphaseChannelizer(8, backend='nope')
+
+def _tone_level(chan, rel_freq):
+    n = chan.channel_count
+    tone = numpy.exp(2j * numpy.pi * rel_freq / n * numpy.arange(n * 4000)).astype(numpy.complex64)
+    out = _run(chan, [tone])
+    return numpy.abs(out[0, 100:]).mean()
+
+# With the passband widened to the channel edges (as for 2M PHY), a transition band
+# can still be given separately
+def test_polyphase_rel_trans():
+    assert _tone_level(PolyphaseChannelizer(16, workers=1), 0.45) < 0.1
+    for rel_freq in [0, 0.3, 0.4, 0.45]:
+        level = _tone_level(PolyphaseChannelizer(16, chan_rel_bw=1.0, chan_rel_trans=0.2, workers=1),
+                            rel_freq)
+        assert abs(level - 1) < 0.05
+
+@pytest.mark.parametrize('fs', [61.44e6, 122.88e6])
+def test_fast_conv_chunked_matches_single_call(fs):
+    num_chans = 24 if fs == 61.44e6 else 48
+    samples = _noise(300000)
+    whole = _run(FastConvChannelizer(fs, num_chans), [samples])
+    # Every input is accounted for once flushed
+    assert whole.shape == (num_chans, -(-len(samples) * 2e6 // fs))
+    chunked = _run(FastConvChannelizer(fs, num_chans), _chunks(samples))
+    numpy.testing.assert_allclose(chunked, whole, rtol=0, atol=1e-6 * numpy.abs(whole).max())
+
+    # Channels left out are zero, the rest unchanged
+    chans = [0, 3, num_chans - 1]
+    subset = _run(FastConvChannelizer(fs, num_chans), _chunks(samples, 1), chans)
+    numpy.testing.assert_allclose(subset[chans], whole[chans], rtol=0,
+                                  atol=1e-6 * numpy.abs(whole).max())
+    assert not subset[[i for i in range(num_chans) if i not in chans]].any()
+
+# A tone at a channel's centre comes out of that channel only, with its amplitude,
+# and aligned with the input (the filter is zero-phase)
+@pytest.mark.parametrize('rel_chan', [0, 5, -7])
+def test_fast_conv_tone(rel_chan):
+    fs = 61.44e6
+    chan = FastConvChannelizer(fs, 24)
+    t = numpy.arange(200000) / fs
+    tone = numpy.exp(2j * numpy.pi * rel_chan * 2e6 * t).astype(numpy.complex64)
+    out = _run(chan, [tone])
+    idx = chan.chan_idx(rel_chan)
+    expected = numpy.exp(2j * numpy.pi * rel_chan * 2e6 * numpy.arange(out.shape[1]) / 2e6)
+    numpy.testing.assert_allclose(out[idx, 100:-100], expected[100:-100], atol=1e-3)
+    others = numpy.delete(out, idx, axis=0)
+    assert numpy.abs(others[:, 100:-100]).max() < 1e-3
@@ -0,0 +1,100 @@
+import numpy
+import pytest
+
+from sniffle.coding_ble import (fec_ble_encode, fec_ble_encode_int, fec_ble_decode_soft,
+                                fec_ble_decode_viterbi, pattern_map_p4, pattern_unmap_p4,
+                                pattern_unmap_p4_soft, pack_bits, unpack_bits)
+
+# Per-bit implementations that the lookup tables replaced
+def _pack_bits_loop(bits):
+    output = bytearray((len(bits) + 7) // 8)
+    for i, b in enumerate(bits):
+        output[i >> 3] |= b << (i & 0x7)
+    return bytes(output)
+
+def _pattern_map_loop(data):
+    lut = [0b1100, 0b0011]
+    output = bytearray(len(data) * 4)
+    for i, b in enumerate(data):
+        for j in range(4):
+            output[i*4 + j] = lut[(b >> (j*2)) & 0x1] | (lut[(b >> (j*2 + 1)) & 0x1] << 4)
+    return bytes(output)
+
+def _pattern_unmap_loop(data):
+    lut = [1, 1, 1, 1, 0, 1, 1, 1, 0, 0, 0, 1, 0, 0, 0, 0]
+    out_bits = bytearray(len(data) * 2)
+    for i, b in enumerate(data):
+        out_bits[2*i] = lut[b & 0xF]
+        out_bits[2*i + 1] = lut[b >> 4]
+    return _pack_bits_loop(out_bits)
+
+def _random_bytes(n, seed=0):
+    return numpy.random.default_rng(seed).integers(0, 256, n, numpy.uint8).tobytes()
+
+# Coded bits of data as +1/-1, in transmission order
+def _coded_signs(data):
+    return unpack_bits(fec_ble_encode(data)).astype(numpy.float32) * 2 - 1
+
+def test_tables_match_loops():
+    data = bytes(range(256)) + _random_bytes(100)
+    assert pattern_map_p4(data) == _pattern_map_loop(data)
+    assert pattern_unmap_p4(data) == _pattern_unmap_loop(data)
+    for n in [0, 1, 7, 8, 9, 100]:
+        bits = numpy.random.default_rng(n).integers(0, 2, n)
+        assert pack_bits(bits) == _pack_bits_loop(bits.tolist())
+
+def test_pattern_unmap_inverts_map():
+    data = _random_bytes(64)
+    assert pattern_unmap_p4(pattern_map_p4(data)) == data
+
+def test_viterbi_round_trip():
+    data = _random_bytes(255)
+    assert fec_ble_decode_viterbi(fec_ble_encode(data)) == data
+
+# S=2 decodes the coded bits directly, S=8 after soft pattern demapping
+@pytest.mark.parametrize('s', [2, 8])
+def test_soft_round_trip(s):
+    data = _random_bytes(64, seed=s)
+    if s == 2:
+        soft = _coded_signs(data)
+    else:
+        soft = pattern_unmap_p4_soft(unpack_bits(pattern_map_p4(fec_ble_encode(data))) * 2. - 1)
+    noise = numpy.random.default_rng(s).normal(0, 0.3, len(soft))
+    assert pack_bits(fec_ble_decode_soft(soft + noise)) == data
+
+def test_soft_corrects_bit_errors():
+    data = _random_bytes(64)
+    soft = _coded_signs(data)
+    # Isolated errors, spaced well beyond the constraint length
+    soft[5::24] *= -1
+    assert pack_bits(fec_ble_decode_soft(soft)) == data
+
+    # Weak errors are outvoted by confident correct bits
+    soft = _coded_signs(data)
+    soft[3::6] *= -0.2
+    assert pack_bits(fec_ble_decode_soft(soft)) == data
+
+def test_soft_batch_matches_rows():
+    rows = [_random_bytes(32, seed=i) for i in range(6)]
+    soft = numpy.stack([_coded_signs(d) for d in rows])
+    soft[:, 7::20] *= -1
+    decoded = fec_ble_decode_soft(soft.reshape(2, 3, -1))
+    assert decoded.shape == (2, 3, 32 * 8)
+    for d, bits in zip(rows, decoded.reshape(6, -1)):
+        assert pack_bits(bits) == d
+
+# Coded bits as +1/-1 for the bits of value (LSB first), followed by the three TERM bits
+def _terminated_signs(value, nbits):
+    coded = fec_ble_encode_int(value, nbits + 3)
+    return numpy.array([(coded >> i) & 1 for i in range(2 * (nbits + 3))], numpy.float32) * 2 - 1
+
+# Step boundaries fall anywhere relative to the TERM bits
+@pytest.mark.parametrize('nbits', [13, 14, 15, 16, 17, 29, 30, 31])
+def test_terminated_round_trip(nbits):
+    value = int(numpy.random.default_rng(nbits).integers(0, 1 << nbits))
+    soft = _terminated_signs(value, nbits)
+    # Errors close to the end, only corrected by forcing all three TERM bits to zero
+    soft[[-10, -7, -4]] *= -1
+    bits = fec_ble_decode_soft(soft, terminated=True)
+    assert len(bits) == nbits + 3
+    assert sum(int(b) << i for i, b in enumerate(bits)) == value
@@ -0,0 +1,63 @@
+import numpy
+import pytest
+
+from sniffle.constants import BLE_ADV_CRCI
+from sniffle.crc_ble import rbit24, crc_ble_reverse, crc_ble_reverse_batch, crc_ble_check_batch
+
+CRCI_REV = rbit24(BLE_ADV_CRCI)
+MAX_LEN = 2 + 255 # header and longest body
+
+# Rows of random bytes with lengths from 0 up to the full padded width, and the
+# per-row CRCs as crc_ble_reverse computes them
+def _rows(width, count=64, seed=0):
+    rng = numpy.random.default_rng(seed)
+    data = rng.integers(0, 256, (count, width), numpy.uint8)
+    lengths = rng.integers(0, width + 1, count)
+    lengths[:3] = [0, width, min(1, width)]
+    expected = [crc_ble_reverse(CRCI_REV, data[i, :n].tobytes()) for i, n in enumerate(lengths)]
+    return data, lengths, expected
+
+@pytest.mark.parametrize('slice_by', [3, 4, 8, 16])
+@pytest.mark.parametrize('width', [0, 1, 7, 8, 9, 100, MAX_LEN])
+def test_reverse_batch_matches_scalar(width, slice_by):
+    data, lengths, expected = _rows(width, seed=width)
+    crcs = crc_ble_reverse_batch(CRCI_REV, data, lengths, slice_by)
+    assert crcs.tolist() == expected
+
+def test_reverse_batch_ignores_padding():
+    data, lengths, expected = _rows(MAX_LEN)
+    for i, n in enumerate(lengths):
+        data[i, n:] = 0xFF - data[i, n:]
+    assert crc_ble_reverse_batch(CRCI_REV, data, lengths).tolist() == expected
+
+# Packets with their CRCs appended, as received
+def _packets(count=64, seed=1):
+    rng = numpy.random.default_rng(seed)
+    data = rng.integers(0, 256, (count, MAX_LEN + 3), numpy.uint8)
+    body_lens = rng.integers(0, MAX_LEN + 1, count)
+    body_lens[:2] = [0, MAX_LEN]
+    for i, n in enumerate(body_lens):
+        crc = crc_ble_reverse(CRCI_REV, data[i, :n].tobytes())
+        data[i, n:n+3] = [crc & 0xFF, (crc >> 8) & 0xFF, crc >> 16]
+    return data, body_lens + 3
+
+def test_check_batch_accepts_valid():
+    data, lengths = _packets()
+    assert crc_ble_check_batch(CRCI_REV, data, lengths).all()
+
+def test_check_batch_rejects_invalid():
+    data, lengths = _packets()
+    rng = numpy.random.default_rng(2)
+    bad = numpy.arange(0, len(data), 2)
+    for i in bad:
+        # Flip one bit anywhere in the body or CRC
+        pos = rng.integers(0, lengths[i] * 8)
+        data[i, pos // 8] ^= 1 << (pos % 8)
+    valid = crc_ble_check_batch(CRCI_REV, data, lengths)
+    assert not valid[bad].any()
+    assert valid[1::2].all()
+
+    # Wrong CRC init, and rows too short to hold a CRC
+    assert not crc_ble_check_batch(CRCI_REV ^ 1, data[1::2], lengths[1::2]).any()
+    assert not crc_ble_check_batch(CRCI_REV, data, numpy.minimum(lengths, 2)).any()
+    assert not crc_ble_check_batch(CRCI_REV, data[:, :0], numpy.zeros(len(data), int)).any()
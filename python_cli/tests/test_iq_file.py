@@ -0,0 +1,121 @@
+import json
+
+import numpy
+import pytest
+
+from sniffle.iq_file import IQFileSource, sigmf_meta_path, parse_datetime_ns
+
+def _iq(n, seed=0):
+    rng = numpy.random.default_rng(seed)
+    return rng.uniform(-1, 1, (n, 2))
+
+def _write_meta(file_name, glob, capture=None):
+    meta = {'global': glob, 'captures': [capture] if capture else []}
+    with open(sigmf_meta_path(file_name), 'w') as f:
+        json.dump(meta, f)
+
+def _read_all(src, chunk=1000):
+    out = []
+    while True:
+        samples = src.read(chunk)
+        if samples is None:
+            return numpy.concatenate(out) if out else numpy.zeros(0, numpy.complex64)
+        out.append(samples.copy())
+
+# Raw integer samples and the complex values they should read back as
+def _raw(fmt, n):
+    rng = numpy.random.default_rng(1)
+    if fmt == 'cs16':
+        raw = rng.integers(-32768, 32768, (n, 2)).astype(numpy.int16)
+        iq = raw / 32768
+    elif fmt == 'cs8':
+        raw = rng.integers(-128, 128, (n, 2)).astype(numpy.int8)
+        iq = raw / 128
+    elif fmt == 'cu8':
+        raw = rng.integers(0, 256, (n, 2)).astype(numpy.uint8)
+        iq = (raw - 127.5) / 128
+    else:
+        raw = _iq(n).astype(numpy.float32)
+        iq = raw
+    return raw, iq[:, 0] + 1j * iq[:, 1]
+
+@pytest.mark.parametrize('fmt', ['cf32', 'cs16', 'cs8', 'cu8'])
+def test_formats_by_extension(tmp_path, fmt):
+    file_name = str(tmp_path / ('capture.' + fmt))
+    raw, expected = _raw(fmt, 2500)
+    raw.tofile(file_name)
+    src = IQFileSource(file_name)
+    assert src.fmt == fmt
+    assert src.total_samples == 2500
+    samples = _read_all(src, 700)
+    assert samples.dtype == numpy.complex64
+    numpy.testing.assert_allclose(samples, expected, rtol=0, atol=1e-6)
+
+def test_cf32_zero_copy(tmp_path):
+    file_name = str(tmp_path / 'capture.raw')
+    _iq(100).astype(numpy.float32).tofile(file_name)
+    src = IQFileSource(file_name)
+    assert src.fmt == 'cf32'
+    assert isinstance(src.read(50).base, numpy.memmap)
+
+def test_out_buffer(tmp_path):
+    file_name = str(tmp_path / 'capture.cs16')
+    raw, expected = _raw('cs16', 100)
+    raw.tofile(file_name)
+    out = numpy.zeros(64, numpy.complex64)
+    samples = IQFileSource(file_name).read(64, out)
+    assert numpy.shares_memory(samples, out)
+    numpy.testing.assert_allclose(out, expected[:64], rtol=0, atol=1e-6)
+
+# fmt argument, then sidecar datatype, then extension
+def test_format_precedence(tmp_path):
+    file_name = str(tmp_path / 'capture.cs8')
+    raw, expected = _raw('cs16', 100)
+    raw.tofile(file_name)
+    assert IQFileSource(file_name).fmt == 'cs8'
+    _write_meta(file_name, {'core:datatype': 'ci16_le'})
+    src = IQFileSource(file_name)
+    assert src.fmt == 'cs16'
+    numpy.testing.assert_allclose(_read_all(src), expected, rtol=0, atol=1e-6)
+    assert IQFileSource(file_name, 'cu8').fmt == 'cu8'
+
+    _write_meta(file_name, {'core:datatype': 'ri16_le'})
+    with pytest.raises(ValueError):
+        IQFileSource(file_name)
+    with pytest.raises(ValueError):
+        IQFileSource(file_name, 'cs4')
+
+def test_sigmf_meta(tmp_path):
+    file_name = str(tmp_path / 'capture.sigmf-data')
+    _iq(10).astype(numpy.float32).tofile(file_name)
+    _write_meta(file_name, {'core:datatype': 'cf32_le', 'core:sample_rate': 61440000},
+                {'core:sample_start': 0, 'core:frequency': 2.426e9,
+                 'core:datetime': '2024-05-01T12:00:00.123456789Z'})
+    assert sigmf_meta_path(file_name) == str(tmp_path / 'capture.sigmf-meta')
+    assert IQFileSource(file_name).meta == {'fmt': 'cf32', 'fs': 61.44e6, 'center_freq': 2.426e9,
+                                            'start_time_ns': 1714564800123456789}
+
+@pytest.mark.parametrize('dt,expected', [
+    ('2024-05-01T12:00:00Z', 1714564800000000000),
+    ('2024-05-01T12:00:00', 1714564800000000000),
+    ('2024-05-01T12:00:00.5Z', 1714564800500000000),
+    ('2024-05-01T12:00:00.000000001Z', 1714564800000000001),
+    ('2024-05-01T12:00:00.1234567891Z', 1714564800123456789),
+    ('2024-05-01T14:00:00.25+02:00', 1714564800250000000),
+    ('2024-05-01T07:30:00-0430', 1714564800000000000),
+])
+def test_parse_datetime(dt, expected):
+    assert parse_datetime_ns(dt) == expected
+
+def test_parse_datetime_invalid():
+    with pytest.raises(ValueError):
+        parse_datetime_ns('May 1 2024')
+
+@pytest.mark.parametrize('fmt', ['cf32', 'cs16'])
+def test_start_stop(tmp_path, fmt):
+    file_name = str(tmp_path / ('capture.' + fmt))
+    raw, expected = _raw(fmt, 1000)
+    raw.tofile(file_name)
+    for start, stop in [(0, None), (100, None), (100, 650), (0, 5000), (999, None), (1000, None)]:
+        samples = _read_all(IQFileSource(file_name, start=start, stop=stop), 128)
+        numpy.testing.assert_allclose(samples, expected[start:stop], rtol=0, atol=1e-6)
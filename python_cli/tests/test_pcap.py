@@ -0,0 +1,44 @@
+from io import BytesIO
+from struct import unpack
+
+import pytest
+
+from sniffle.constants import BLE_ADV_AA, BLE_ADV_CRCI
+from sniffle.crc_ble import crc_ble_reverse, rbit24
+from sniffle.pcap import PcapBleWriter, PcapBleReader, PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC
+
+# ADV_NONCONN_IND with a random AdvA and flags
+BODY = bytes([0x02, 0x09, 0x11, 0x22, 0x33, 0x44, 0x55, 0xC6, 0x02, 0x01, 0x06])
+TS_NS = 1714564800123456789
+
+def _write(nanosecond, ts_ns=TS_NS):
+    writer = PcapBleWriter(nanosecond=nanosecond)
+    crc_rev = crc_ble_reverse(rbit24(BLE_ADV_CRCI), BODY)
+    writer.write_packet_ns(ts_ns, BLE_ADV_AA, 37, -50, BODY, crc_rev=crc_rev)
+    writer.write_packet_ns(ts_ns + 1, BLE_ADV_AA, 38, -60, BODY, crc_rev=crc_rev)
+    writer.output.seek(0)
+    return writer.output
+
+@pytest.mark.parametrize('nanosecond', [True, False])
+def test_round_trip(nanosecond):
+    stream = _write(nanosecond)
+    magic, = unpack('<I', stream.getvalue()[:4])
+    assert magic == (PCAP_MAGIC_NSEC if nanosecond else PCAP_MAGIC_USEC)
+
+    reader = PcapBleReader(stream)
+    assert reader.nanosecond == nanosecond
+    pkts = list(reader)
+    assert [p.chan for p in pkts] == [37, 38]
+    assert [p.rssi for p in pkts] == [-50, -60]
+    assert all(bytes(p.body) == BODY and not p.crc_err for p in pkts)
+    if nanosecond:
+        # Sub-microsecond timestamps survive, including a 1 ns step
+        assert [p.ts_ns for p in pkts] == [TS_NS, TS_NS + 1]
+    else:
+        assert [p.ts_ns for p in pkts] == [TS_NS // 1000 * 1000] * 2
+
+def test_bad_magic():
+    data = bytearray(_write(True).getvalue())
+    data[:4] = b'\x00\x00\x00\x00'
+    with pytest.raises(ValueError):
+        PcapBleReader(BytesIO(bytes(data)))
@@ -0,0 +1,83 @@
+import numpy
+import pytest
+import scipy.signal
+
+from sniffle.resampler import PolyphaseResampler
+
+RATIOS = [(2, 1), (25, 32), (25, 768), (25, 1536), (3, 7)]
+
+def _noise(n, seed=0):
+    rng = numpy.random.default_rng(seed)
+    return (rng.normal(0, 1, n) + 1j * rng.normal(0, 1, n)).astype(numpy.complex64)
+
+# Odd chunk sizes, including empty chunks
+def _chunks(samples, seed=0):
+    cuts = numpy.sort(numpy.random.default_rng(seed).integers(0, len(samples), 30))
+    return numpy.split(samples, cuts)
+
+def _feed(resampler, chunks):
+    return numpy.concatenate([resampler.feed(c).copy() for c in chunks])
+
+@pytest.mark.parametrize('up,down', RATIOS)
+def test_chunked_matches_single_call(up, down):
+    samples = _noise(40000)
+    whole = _feed(PolyphaseResampler(up, down), [samples])
+    # Each output is produced once its newest input has arrived
+    assert len(whole) == -(-len(samples) * up // down)
+    chunked = _feed(PolyphaseResampler(up, down), _chunks(samples))
+    numpy.testing.assert_allclose(chunked, whole, rtol=0, atol=1e-5 * numpy.abs(whole).max())
+
+# The previous implementation, running upfirdn over padding, history and the whole chunk
+class _UpfirdnResampler:
+    def __init__(self, up, down):
+        ref = PolyphaseResampler(up, down)
+        self.up, self.down = ref.up, ref.down
+        self.filt_coeffs = ref.filt_coeffs
+        self.state_len = ref.filt_multiple + self.down // up
+        self.state = numpy.zeros(self.state_len, numpy.complex64)
+        self.adjust = 0
+        self.pad_lut = [self._compute_pad(i) for i in range(1 - self.down, self.down)]
+
+    def feed(self, samples):
+        pad_samples = self.pad_lut[self.adjust + self.down - 1]
+        samples2 = numpy.concatenate([numpy.zeros(pad_samples, self.state.dtype), self.state, samples])
+        resamp = scipy.signal.upfirdn(self.filt_coeffs, samples2, self.up, self.down)
+        self.state = samples2[-self.state_len:]
+        start_idx = ((pad_samples + self.state_len) * self.up + self.adjust + self.down - 1) // self.down
+        end_idx = (len(samples2) * self.up + self.down - 1) // self.down
+        self.adjust = end_idx * self.down - len(samples2) * self.up
+        return resamp[start_idx:end_idx]
+
+    def _compute_pad(self, adjust):
+        for i in range(self.down):
+            if ((i + self.state_len) * self.up + adjust) % self.down == 0:
+                return i
+
+@pytest.mark.parametrize('up,down', RATIOS)
+def test_matches_upfirdn(up, down):
+    samples = _noise(40000, 1)
+    expected = _feed(_UpfirdnResampler(up, down), _chunks(samples))
+    out = _feed(PolyphaseResampler(up, down), _chunks(samples, 1))
+    numpy.testing.assert_allclose(out, expected, rtol=0, atol=1e-5 * numpy.abs(expected).max())
+
+def test_output_len_and_out_buffer():
+    resampler = PolyphaseResampler(25, 32)
+    expected = _feed(PolyphaseResampler(25, 32), _chunks(_noise(20000)))
+    out = numpy.empty(len(expected) + 10, numpy.complex64)
+    pos = 0
+    for chunk in _chunks(_noise(20000)):
+        n = resampler.output_len(len(chunk))
+        res = resampler.feed(chunk, out[pos:])
+        assert len(res) == n
+        assert numpy.shares_memory(res, out) or n == 0
+        pos += n
+    numpy.testing.assert_array_equal(out[:pos], expected)
+    with pytest.raises(ValueError):
+        resampler.feed(_noise(1000), out[:10])
+
+def test_reset():
+    samples = _noise(5000)
+    resampler = PolyphaseResampler(25, 32)
+    first = _feed(resampler, _chunks(samples))
+    resampler.reset()
+    numpy.testing.assert_array_equal(_feed(resampler, _chunks(samples)), first)
@@ -0,0 +1,194 @@
+from struct import pack
+
+import numpy
+import pytest
+
+from sniffle.sdr_utils import (ExactSyncDetector, MultiSyncDetector, HammingSyncDetector,
+                               fm_demod2, FMDemodulator, EnergyGate)
+
+AAS = [0x8E89BED6, 0x50654A5B, 0x12345678, 0xAF9A9C3E]
+
+def _bits(data: bytes):
+    return numpy.unpackbits(numpy.frombuffer(data, numpy.uint8), bitorder='little')
+
+# Random symbols with the given bit sequences placed at symbol positions, each
+# symbol repeated samps_per_sym times as in demodulator output
+def _symbols(nsyms, placed, samps_per_sym=2, seed=0):
+    syms = numpy.random.default_rng(seed).integers(0, 2, nsyms, numpy.uint8)
+    for pos, bits in placed:
+        syms[pos:pos + len(bits)] = bits
+    return numpy.repeat(syms, samps_per_sym)
+
+@pytest.mark.parametrize('samps_per_sym', [1, 2])
+def test_multi_sync_every_offset(samps_per_sym):
+    for pos in range(40, 56):
+        aa = AAS[pos % len(AAS)]
+        samples = _symbols(160, [(pos, _bits(pack('<I', aa)))], samps_per_sym, seed=pos)
+        indices, aas = MultiSyncDetector(AAS, samps_per_sym).feed_multi(samples)
+        assert list(zip(indices, aas)) == [(pos * samps_per_sym, aa)]
+
+def test_multi_sync_matches_exact():
+    rng = numpy.random.default_rng(1)
+    placed = [(int(p), _bits(pack('<I', AAS[k % len(AAS)])))
+              for k, p in enumerate(sorted(rng.choice(numpy.arange(0, 20000, 50), 60, False)))]
+    # Shifted by a sample, so each AA is first seen at the second sampling phase
+    samples = numpy.roll(_symbols(20032, placed), 1)
+
+    indices, aas = MultiSyncDetector(AAS).feed_multi(samples)
+    assert len(indices) >= len(placed)
+    for aa in AAS:
+        exact = ExactSyncDetector(pack('<I', aa)).feed(samples)
+        assert indices[aas == aa].tolist() == exact
+
+    # An AA cut off by the end of the buffer isn't reported
+    pos = placed[0][0] * 2 + 1
+    assert pos not in MultiSyncDetector(AAS).feed(samples[:pos + 62])
+    assert pos in MultiSyncDetector(AAS).feed(samples[:pos + 64])
+
+def _sync(aa):
+    # Preamble alternates, ending opposite to the first AA bit
+    return (b'\x55' if aa & 1 else b'\xAA') + pack('<I', aa)
+
+@pytest.mark.parametrize('samps_per_sym', [1, 2])
+def test_hamming_every_offset(samps_per_sym):
+    syncs = [_sync(aa) for aa in AAS]
+    for pos in range(40, 56):
+        k = pos % len(syncs)
+        samples = _symbols(200, [(pos, _bits(syncs[k]))], samps_per_sym, seed=pos)
+        indices, words, errs = HammingSyncDetector(syncs, samps_per_sym).feed_multi(samples)
+        assert indices.tolist() == [pos * samps_per_sym]
+        assert words.tolist() == [int.from_bytes(syncs[k], 'little')]
+        assert errs.tolist() == [0]
+
+@pytest.mark.parametrize('max_errors', [0, 1, 3, 6])
+def test_hamming_error_limit(max_errors):
+    sync = _sync(AAS[0])
+    rng = numpy.random.default_rng(max_errors)
+    for nerr in [max_errors, max_errors + 1]:
+        bits = _bits(sync)
+        bits[rng.choice(len(bits), nerr, False)] ^= 1
+        samples = _symbols(200, [(77, bits)], 1, seed=nerr)
+        indices, _, errs = HammingSyncDetector(sync, 1, max_errors=max_errors).feed_multi(samples)
+        if nerr <= max_errors:
+            assert indices.tolist() == [77]
+            assert errs.tolist() == [nerr]
+        else:
+            assert len(indices) == 0
+
+# Matches at adjacent sampling phases are one sync, kept at the phase with fewest errors
+def test_hamming_cluster_dedup():
+    sync = _sync(AAS[1])
+    samples = _symbols(200, [(60, _bits(sync)), (140, _bits(sync))], 2)
+    det = HammingSyncDetector(sync, 2, max_errors=2)
+    indices, _, errs = det.feed_multi(samples)
+    assert indices.tolist() == [120, 280]
+    assert errs.tolist() == [0, 0]
+
+    # Errors on the first phase only
+    samples[2*64] ^= 1
+    samples[2*150] ^= 1
+    samples[2*152] ^= 1
+    indices, _, errs = det.feed_multi(samples)
+    assert indices.tolist() == [121, 281]
+    assert errs.tolist() == [0, 0]
+
+def test_hamming_multiple_syncs():
+    syncs = [_sync(aa) for aa in AAS]
+    placed = [(100 + 80*k, _bits(s)) for k, s in enumerate(syncs)]
+    samples = _symbols(500, placed, 2)
+    indices, words, _ = HammingSyncDetector(syncs, 2, max_errors=2).feed_multi(samples)
+    assert indices.tolist() == [p * 2 for p, _ in placed]
+    assert words.tolist() == [int.from_bytes(s, 'little') for s in syncs]
+
+def _noise(n, seed=0, power=1.):
+    rng = numpy.random.default_rng(seed)
+    return ((rng.normal(0, 1, n) + 1j * rng.normal(0, 1, n)) * numpy.sqrt(power / 2)).astype(numpy.complex64)
+
+# Random chunk boundaries, including empty chunks
+def _chunks(signal, seed=0):
+    cuts = numpy.sort(numpy.random.default_rng(seed).integers(0, len(signal), 12))
+    return numpy.split(signal, cuts)
+
+def test_fm_demod_matches_fm_demod2():
+    signal = _noise(5000)
+    # Zero samples give NaN and infinite outputs, which must match as well
+    signal[[0, 1000, 1001, 4999]] = 0
+    with numpy.errstate(invalid='ignore'):
+        expected = fm_demod2(signal)
+        expected_bits = expected > 0
+
+    # Products are formed in a different order, so results differ by float32 rounding
+    demod = FMDemodulator()
+    out = numpy.concatenate([demod.feed(c).copy() for c in _chunks(signal)])
+    numpy.testing.assert_allclose(out, expected, rtol=1e-4, atol=1e-5)
+
+    demod = FMDemodulator()
+    bits = numpy.concatenate([demod.feed_bits(c).copy() for c in _chunks(signal, 1)])
+    numpy.testing.assert_array_equal(bits, expected_bits)
+
+def test_fm_demod_out_buffer():
+    signal = _noise(1000)
+    out = numpy.full(1010, -1., numpy.float32)
+    demod = FMDemodulator()
+    demod.feed(signal[:400], out=out[:400])
+    demod.feed(signal[400:], out=out[400:1000])
+    numpy.testing.assert_allclose(out[:1000], fm_demod2(signal), rtol=1e-4, atol=1e-5)
+    assert (out[1000:] == -1).all()
+
+# Noise with 20 dB bursts at the given (start, stop) sample ranges
+def _bursts(n, bursts, seed=0):
+    signal = _noise(n, seed)
+    for start, stop in bursts:
+        signal[start:stop] += _noise(stop - start, seed + 1, 100.)
+    return signal
+
+def _covered(spans, offset, n):
+    mask = numpy.zeros(n, bool)
+    for start, stop in spans:
+        mask[max(offset + start, 0):offset + stop] = True
+    return mask
+
+# Spans are padded whole blocks, merged where the padding overlaps
+# Bursts are 20 dB up, so a higher threshold keeps the odd noise block out
+def test_energy_gate_padding():
+    gate = EnergyGate(thresh_db=10.)
+    pad = gate.pad_blocks * gate.block_len
+    gate.feed(_noise(1 << 16, 1))
+    spans = gate.feed(_bursts(1 << 16, [(10000, 12000), (12100, 13000), (40016, 40100)]))
+    assert spans == [(9984 - pad, 13024 + pad), (40000 - pad, 40128 + pad)]
+    assert gate.bursts == 2
+
+# A burst at the end of one chunk owes padding to the next, and a burst at the start of
+# a chunk reaches back into the previous one
+def test_energy_gate_chunk_edges():
+    gate = EnergyGate(thresh_db=10.)
+    pad = gate.pad_blocks * gate.block_len
+    gate.feed(_noise(1 << 16, 1))
+    n = 1 << 14
+    spans = gate.feed(_bursts(n, [(n - 40, n)]))
+    assert spans == [(n - 64 - pad, n)]
+    spans = gate.feed(_bursts(n, [(n - 64, n)], seed=2))
+    assert spans == [(-pad, pad), (n - 64 - pad, n)]
+    spans = gate.feed(_bursts(n, [(0, 10)], seed=4))
+    assert spans == [(-pad, 32 + pad)]
+    assert gate.bursts == 2
+
+def test_energy_gate_chunking():
+    bursts = [(int(s), int(s) + 700) for s in range(3000, 200000, 9000)]
+    signal = _bursts(200000, bursts)
+    warmup = _noise(1 << 16, 5)
+
+    gate = EnergyGate()
+    gate.feed(warmup)
+    whole = _covered(gate.feed(signal), 0, len(signal))
+
+    gate = EnergyGate()
+    gate.feed(warmup)
+    chunked = numpy.zeros(len(signal), bool)
+    pos = 0
+    for chunk in numpy.split(signal, numpy.arange(1024, len(signal), 5120)):
+        chunked |= _covered(gate.feed(chunk), pos, len(signal))
+        pos += len(chunk)
+    numpy.testing.assert_array_equal(chunked, whole)
+    for start, stop in bursts:
+        assert whole[start:stop].all()
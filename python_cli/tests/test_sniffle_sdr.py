@@ -0,0 +1,134 @@
+import json
+import os
+import shutil
+from collections import Counter
+
+import numpy
+import pytest
+
+from sniffle.constants import BLE_ADV_CRCI
+from sniffle.errors import SourceDone
+from sniffle.iq_file import sigmf_meta_path
+from sniffle.sdr_bench import make_capture
+from sniffle.sniffle_sdr import SniffleSDR, SniffleFileSDR, parse_file_spec
+
+FS = 61.44e6
+
+def _decode(file_name, cfo_comp=True, timing_recovery=True, **kwargs):
+    sdr = SniffleFileSDR(file_name, **kwargs)
+    sdr.setup_sniffer()
+    sdr.cmd_cfo_comp(cfo_comp)
+    sdr.cmd_timing_recovery(timing_recovery)
+    pkts = []
+    while True:
+        try:
+            p = sdr.recv_and_decode()
+        except SourceDone:
+            break
+        if p is not None:
+            pkts.append((p.chan, bytes(p.body), p.ts_ns))
+    return pkts
+
+@pytest.fixture(scope='module')
+def capture(tmp_path_factory):
+    file_name = str(tmp_path_factory.mktemp('iq') / 'adv.sigmf-data')
+    make_capture(file_name, FS, 0.05, advertisers=4, interval=0.01)
+    # A start time, so that timestamps are comparable across decodes
+    meta_name = sigmf_meta_path(file_name)
+    with open(meta_name) as f:
+        meta = json.load(f)
+    meta['captures'][0]['core:datetime'] = '2024-05-01T12:00:00Z'
+    with open(meta_name, 'w') as f:
+        json.dump(meta, f)
+    return file_name
+
+@pytest.mark.parametrize('start', [0, 1000000])
+def test_segmented_timestamps_match_sequential(capture, start):
+    sequential = _decode(capture, fast=True, start=start)
+    segmented = _decode(capture, start=start, segment_len=0.01, segment_workers=2)
+    assert len(sequential) > 0
+    assert segmented == sequential
+
+def test_segment_error_reaches_caller(capture, tmp_path):
+    # Segment processes open the file themselves, so they fail once it's gone
+    file_name = str(tmp_path / 'gone.sigmf-data')
+    shutil.copy(capture, file_name)
+    shutil.copy(sigmf_meta_path(capture), sigmf_meta_path(file_name))
+    sdr = SniffleFileSDR(file_name, segment_len=0.01, segment_workers=2)
+    sdr.setup_sniffer()
+    os.remove(file_name)
+    with pytest.raises(FileNotFoundError):
+        while True:
+            sdr.recv_and_decode()
+    with pytest.raises(SourceDone):
+        sdr.recv_and_decode()
+
+# Advertisers with offsets up to 50 kHz apart, whose bursts mix in the burst offset estimate
+# Without timing recovery retries, packets only received with bits sliced at zero show up
+@pytest.mark.parametrize('seed', [0, 3])
+def test_cfo_comp_keeps_uncompensated_packets(tmp_path, seed):
+    file_name = str(tmp_path / 'cfo.sigmf-data')
+    make_capture(file_name, FS, 0.1, advertisers=8, interval=0.02, seed=seed)
+    plain = Counter((chan, body) for chan, body, _ in
+                    _decode(file_name, cfo_comp=False, timing_recovery=False))
+    comp = Counter((chan, body) for chan, body, _ in
+                   _decode(file_name, cfo_comp=True, timing_recovery=False))
+    assert len(plain) > 0
+    assert not plain - comp
+
+# Reads num_chunks chunks of complex noise, channelized into fs / 2 MHz channels
+class _NoiseSDR(SniffleSDR):
+    def __init__(self, num_chunks, fs=8e6, chan=38, **kwargs):
+        super().__init__(fs, 10, chan=chan, chunk_size=1 << 16, **kwargs)
+        self.chunks_left = num_chunks
+        rng = numpy.random.default_rng(0)
+        self.noise = (rng.normal(0, 0.01, 1 << 17) + 1j * rng.normal(0, 0.01, 1 << 17)).astype(numpy.complex64)
+
+    def source_read(self, buffers):
+        if self.chunks_left == 0:
+            return False
+        self.chunks_left -= 1
+        buffers[0][:] = self.noise[:len(buffers[0])]
+        return True
+
+# Kills a demodulation worker process with chunks still to be demodulated
+class _KilledWorkerSDR(_NoiseSDR):
+    def source_read(self, buffers):
+        if self.chunks_left == 3:
+            proc = self.demod.procs[-1]
+            proc.kill()
+            proc.join()
+        return super().source_read(buffers)
+
+def test_dead_demod_worker_reaches_caller():
+    # 28 MHz around channel 5 takes in channels 37 and 38, one per worker
+    sdr = _KilledWorkerSDR(6, fs=28e6, chan=5, demod_backend='process', demod_workers=2)
+    sdr.setup_sniffer()
+    with pytest.raises(RuntimeError, match='Demodulation worker exited with code'):
+        while True:
+            sdr.recv_and_decode()
+    with pytest.raises(SourceDone):
+        sdr.recv_and_decode()
+
+# Changing channel/AA resets the processors to that AA, so connections are tracked anew
+def test_track_aa_after_chan_aa_phy():
+    aa = 0x50654A5B
+    sdr = _NoiseSDR(0, all_chan=True)
+    sdr.cmd_track_aa(aa, BLE_ADV_CRCI)
+    sdr.cmd_chan_aa_phy(37)
+    sdr._apply_config()
+    assert aa not in sdr.chan_processors[5].targets
+    sdr.cmd_track_aa(aa, BLE_ADV_CRCI)
+    sdr._apply_config()
+    assert aa in sdr.chan_processors[5].targets
+    assert sdr.tracked_aas == [aa]
+
+def test_parse_file_spec():
+    assert parse_file_spec('/tmp/capture.cs8') == ('/tmp/capture.cs8', {})
+    assert parse_file_spec('a.sigmf-data?fs=61.44e6&chan=17&fmt=cs16&fast=1&start=100&stop=200'
+                           '&segment_len=0.5&segment_workers=4') == ('a.sigmf-data', {
+        'fs': 61.44e6, 'chan': 17, 'fmt': 'cs16', 'fast': True, 'start': 100, 'stop': 200,
+        'segment_len': 0.5, 'segment_workers': 4})
+    for bad in ['a?fs', 'a?rate=2', 'a?chan=x']:
+        with pytest.raises(ValueError):
+            parse_file_spec(bad)
@@ -0,0 +1,48 @@
+import numpy
+import pytest
+
+from sniffle.whitening_ble import (le_dewhiten, le_dewhiten_batch, whitening_bitstream,
+                                   whitening_index, WHITENING_TABLE_LEN)
+
+# Per-bit LFSR sequence walk, as the keystream table was previously applied
+def _dewhiten_bitwise(data, chan):
+    dw = []
+    idx = whitening_index[chan]
+    for b in data:
+        o = 0
+        for i in range(8):
+            bit = ((b >> i) & 1) ^ whitening_bitstream[idx]
+            idx = (idx + 1) % len(whitening_bitstream)
+            o |= bit << i
+        dw.append(o)
+    return bytes(dw)
+
+@pytest.mark.parametrize('nbytes', [0, 1, 37, WHITENING_TABLE_LEN, WHITENING_TABLE_LEN + 300])
+def test_dewhiten_matches_bitwise(nbytes):
+    rng = numpy.random.default_rng(nbytes)
+    data = rng.integers(0, 256, nbytes, numpy.uint8).tobytes()
+    for chan in range(40):
+        assert le_dewhiten(data, chan) == _dewhiten_bitwise(data, chan)
+
+def test_dewhiten_is_involution():
+    data = bytes(range(256))
+    for chan in range(40):
+        assert le_dewhiten(le_dewhiten(data, chan), chan) == data
+
+# Rows hold packets of different lengths, padded with junk, as ble_pkt_extract builds them
+@pytest.mark.parametrize('width', [1, 40, WHITENING_TABLE_LEN, WHITENING_TABLE_LEN + 7])
+def test_dewhiten_batch_matches_scalar(width):
+    rng = numpy.random.default_rng(width)
+    data = rng.integers(0, 256, (80, width), numpy.uint8)
+    lengths = rng.integers(0, width + 1, 80)
+    chans = numpy.arange(80) % 40
+
+    out = le_dewhiten_batch(data, chans)
+    assert out.shape == data.shape
+    for row, chan, n in zip(range(80), chans, lengths):
+        assert out[row, :n].tobytes() == le_dewhiten(data[row, :n].tobytes(), chan)
+
+    for chan in range(40):
+        out = le_dewhiten_batch(data, chan)
+        for row, n in zip(range(80), lengths):
+            assert out[row, :n].tobytes() == le_dewhiten(data[row, :n].tobytes(), chan)